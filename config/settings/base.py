@@ -23,6 +23,10 @@ EXPORT_DIR = f"{ROOT_DIR}/exports"
 
 IMPORT_DIR = f"{ROOT_DIR}/imports"
 
+# Cache of the dataframes loaded from fluxIAE exports, which contain personal data.
+# Disabled unless a directory private to the user running the imports is given.
+FLUXIAE_SNAPSHOTS_DIR = os.environ.get("FLUXIAE_SNAPSHOTS_DIR")
+
 # General.
 # ------------------------------------------------------------------------------
 
@@ -343,6 +347,11 @@ BOOTSTRAP4 = {
 # Base Adresse Nationale (BAN).
 # https://adresse.data.gouv.fr/faq
 API_BAN_BASE_URL = "https://api-adresse.data.gouv.fr"
+# Number of addresses sent in each request to the CSV endpoint, and timeout of these requests in seconds.
+API_BAN_BATCH_GEOCODING_SIZE = 5000
+API_BAN_BATCH_GEOCODING_TIMEOUT = 600
+# Geocoding results are cached in database and fetched again after this number of days.
+API_BAN_GEOCODING_CACHE_TTL_DAYS = 90
 
 # https://api.gouv.fr/api/api-geo.html#doc_tech
 API_GEO_BASE_URL = "https://geo.api.gouv.fr"
@@ -499,7 +508,7 @@ METABASE_DRY_RUN_ROWS_PER_QUERYSET = 1000
 # Useful to troobleshoot whether the script runs a deluge of SQL requests.
 METABASE_SHOW_SQL_REQUESTS = False
 
-# Set how many rows are inserted at a time in metabase database.
+# Set how many rows are extracted at a time from itou database.
 # A bigger number makes the script faster until a certain point,
 # but it also increases RAM usage.
 # -- Bench results for self.populate_approvals()
@@ -512,6 +521,19 @@ METABASE_SHOW_SQL_REQUESTS = False
 # by batch of 1000 => 5s
 METABASE_INSERT_BATCH_SIZE = 100
 
+# How many tables populate_metabase_itou builds at the same time, each in its own process,
+# and in how many primary key ranges its biggest tables are split to be loaded in parallel.
+METABASE_EXTRACTION_CONCURRENCY = 1
+METABASE_EXTRACTION_SHARDS = 1
+
+# Build new metabase tables as UNLOGGED tables, which load faster, and set them back to LOGGED
+# just before they are switched with the current tables.
+METABASE_UNLOGGED_NEW_TABLES = False
+
+# Rows are streamed into metabase database with `COPY ... FROM STDIN`,
+# the in-memory buffer is sent (and committed) every time it reaches this size in bytes.
+METABASE_COPY_BUFFER_SIZE = 8 * 1024 * 1024
+
 # Embedding signed Metabase dashboard
 METABASE_SITE_URL = "https://stats.inclusion.beta.gouv.fr"
 METABASE_SECRET_KEY = os.environ.get("METABASE_SECRET_KEY", "")
@@ -1,11 +1,13 @@
 from django.contrib import admin
+from django.contrib.auth import get_permission_codename
 from django.urls import path
 from django.urls.base import reverse
 from django.utils.html import format_html
 
 from itou.approvals import models
 from itou.approvals.admin_forms import ApprovalAdminForm
-from itou.approvals.admin_views import manually_add_approval, manually_refuse_approval
+from itou.approvals.admin_views import export_approvals, manually_add_approval, manually_refuse_approval
+from itou.approvals.export import CSV, XLSX
 from itou.job_applications.models import JobApplication
 
 
@@ -116,6 +118,8 @@ class ApprovalAdmin(admin.ModelAdmin):
         JobApplicationInline,
     )
 
+    actions = ("export_as_xlsx", "export_as_csv")
+
     def save_model(self, request, obj, form, change):
         if not obj.pk:
             obj.created_by = request.user
@@ -127,6 +131,23 @@ class ApprovalAdmin(admin.ModelAdmin):
     is_valid.boolean = True
     is_valid.short_description = "En cours de validité"
 
+    def has_export_permission(self, request):
+        """
+        Exports contain personal data of job seekers: they require a dedicated permission.
+        """
+        codename = get_permission_codename("export", self.opts)
+        return request.user.has_perm(f"{self.opts.app_label}.{codename}")
+
+    @admin.action(
+        description="Exporter les PASS IAE sélectionnés et leurs suspensions (Excel)", permissions=["export"]
+    )
+    def export_as_xlsx(self, request, queryset):
+        return export_approvals(queryset, XLSX)
+
+    @admin.action(description="Exporter les PASS IAE sélectionnés (CSV compressé)", permissions=["export"])
+    def export_as_csv(self, request, queryset):
+        return export_approvals(queryset, CSV)
+
     def manually_add_approval(self, request, job_application_id):
         """
         Custom admin view to manually add an approval.
@@ -270,3 +291,18 @@ class PoleEmploiApprovalAdmin(admin.ModelAdmin):
 
     is_valid.boolean = True
     is_valid.short_description = "En cours de validité"
+
+
+@admin.register(models.PoleEmploiApprovalImport)
+class PoleEmploiApprovalImportAdmin(admin.ModelAdmin):
+    list_display = (
+        "pk",
+        "file_name",
+        "count_inserted",
+        "count_updated",
+        "count_canceled",
+        "count_rejected",
+        "created_at",
+    )
+    readonly_fields = list_display
+    date_hierarchy = "created_at"
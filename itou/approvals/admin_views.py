@@ -7,15 +7,18 @@ https://docs.djangoproject.com/en/dev/ref/contrib/admin/#adding-views-to-admin-s
 https://github.com/django/django/blob/master/django/contrib/admin/templates/admin/change_form.html
 """
 
+import tempfile
+
 from django.contrib import admin, messages
 from django.contrib.auth import get_permission_codename
 from django.core.exceptions import PermissionDenied
 from django.db import transaction
-from django.http import HttpResponseRedirect
+from django.http import FileResponse, HttpResponseRedirect, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse
 
 from itou.approvals.admin_forms import ManuallyAddApprovalForm
+from itou.approvals.export import CSV, get_export_filename, iter_csv_gz, write_xlsx
 from itou.approvals.models import Approval
 from itou.job_applications.models import JobApplication, JobApplicationWorkflow
 from itou.utils.emails import get_email_text_template
@@ -138,3 +141,23 @@ def manually_refuse_approval(
         **admin_site.each_context(request),
     }
     return render(request, template_name, context)
+
+
+def export_approvals(queryset, export_format):
+    """
+    Response of the export actions of the approvals admin.
+    """
+    filename = get_export_filename(export_format)
+
+    if export_format == CSV:
+        # Rows are sent as they are read from the database.
+        response = StreamingHttpResponse(iter_csv_gz(approvals=queryset), content_type="application/gzip")
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
+        return response
+
+    # An XLSX file can only be sent once complete: write it to a temporary file
+    # rather than in memory. `FileResponse` closes (thus deletes) it.
+    xlsx_file = tempfile.TemporaryFile()
+    write_xlsx(xlsx_file, approvals=queryset)
+    xlsx_file.seek(0)
+    return FileResponse(xlsx_file, as_attachment=True, filename=filename)
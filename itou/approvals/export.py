@@ -1,6 +1,9 @@
+import csv
 import datetime
+import io
 import logging
 import time
+import zlib
 
 from django.conf import settings
 from openpyxl import Workbook
@@ -9,7 +12,7 @@ from openpyxl.utils import get_column_letter
 from itou.job_applications.models import JobApplication, Suspension
 
 
-# XLS export of approvals
+# XLS and CSV exports of approvals
 # Currently used by admin site and admin command (export_approvals)
 
 logger = logging.getLogger(__name__)
@@ -48,37 +51,42 @@ FIELDS_WS2 = [
 CELL_WIDTH = 50
 
 DATE_FMT = "%d-%m-%Y"
-EXPORT_FORMATS = ["stream", "file"]
+
+XLSX = "xlsx"
+CSV = "csv"
+EXPORT_FORMATS = [XLSX, CSV]
+
+# Size of the CSV data compressed at once when streaming a gzip CSV export.
+CSV_CHUNK_SIZE = 64 * 1024
 
 
 def _format_date(dt):
     return dt.strftime(DATE_FMT) if dt else ""
 
 
-def _format_pass_worksheet(wb):
+def _log_export(rows, description):
     """
-    Export of all approvals
+    Pass rows through and log their number once all of them have been written.
     """
-    logger.info("Loading approvals data...")
-
-    ws = wb.active
-    current_dt = datetime.datetime.now()
-    ws.title = "Export PASS IAE " + current_dt.strftime(DATE_FMT)
-
-    # Start timer
     start_counter = time.perf_counter()
+    export_count = 0
+    for export_count, row in enumerate(rows, 1):
+        yield row
+    logger.info("Exported %s %s in %.2f sec.", export_count, description, time.perf_counter() - start_counter)
+
 
+def _iter_pass_rows(approvals=None):
+    """
+    Rows of worksheet 1: all approvals, or only `approvals` if given.
+    """
     job_applications = JobApplication.objects.exclude(approval=None).select_related(
         "job_seeker", "approval", "to_siae"
     )
+    if approvals is not None:
+        job_applications = job_applications.filter(approval__in=approvals)
 
-    # Write header row
-    for idx, cell_value in enumerate(FIELDS_WS1, 1):
-        ws.cell(1, idx).value = cell_value
-
-    # Write data rows
-    for row_idx, ja in enumerate(job_applications.iterator(), 2):
-        row = [
+    for ja in job_applications.iterator():
+        yield [
             ja.job_seeker.pole_emploi_id,
             ja.job_seeker.first_name,
             ja.job_seeker.last_name,
@@ -96,38 +104,18 @@ def _format_pass_worksheet(wb):
             _format_date(ja.hiring_start_at),
             _format_date(ja.hiring_end_at),
         ]
-        # Instead of using a temp array to store rows,
-        # writing rows one by one will avoid memory issues
-        for col_idx, cell_value in enumerate(row, 1):
-            ws.cell(row_idx, col_idx).value = cell_value
 
-    # Formating columns once (not in the loop)
-    for idx in range(len(FIELDS_WS1)):
-        ws.column_dimensions[get_column_letter(idx + 1)].width = CELL_WIDTH
-
-    export_count = job_applications.count()
-
-    logger.info("Exported %s approvals in %.2f sec.", export_count, time.perf_counter() - start_counter)
 
-
-def _format_suspended_pass_worksheet(wb):
+def _iter_suspended_pass_rows(approvals=None):
     """
-    Suspended approvals
+    Rows of worksheet 2: suspensions of all approvals, or only of `approvals` if given.
     """
-    logger.info("Loading suspension data...")
-    ws = wb.create_sheet("Suspensions PASS IAE")
+    suspensions = Suspension.objects.select_related("approval", "siae")
+    if approvals is not None:
+        suspensions = suspensions.filter(approval__in=approvals)
 
-    # Start timer
-    start_counter = time.perf_counter()
-
-    suspensions = Suspension.objects.all().select_related("approval", "created_by")
-
-    # Write header row
-    for idx, cell_value in enumerate(FIELDS_WS2, 1):
-        ws.cell(1, idx).value = cell_value
-
-    for idx, s in enumerate(suspensions.iterator(), 2):
-        row = [
+    for s in suspensions.iterator():
+        yield [
             s.approval.number,
             _format_date(s.start_at),
             _format_date(s.end_at),
@@ -135,44 +123,94 @@ def _format_suspended_pass_worksheet(wb):
             s.siae.siret,
             s.siae.name,
         ]
-        for col_idx, cell_value in enumerate(row, 1):
-            ws.cell(idx, col_idx).value = cell_value
 
-    # Formating columns once (not in the loop)
+
+def _write_worksheet(wb, title, fields, rows):
+    ws = wb.create_sheet(title)
+    # Write-only worksheets must be formatted before any row is written.
     # Was dynamic, but fixed width also does the job and
     # makes code simpler
-    for idx in range(len(FIELDS_WS2)):
+    for idx in range(len(fields)):
         ws.column_dimensions[get_column_letter(idx + 1)].width = CELL_WIDTH
+    ws.append(fields)
+    # Rows are flushed to a temporary file as they are appended:
+    # memory usage doesn't depend on the number of rows.
+    for row in rows:
+        ws.append(row)
 
-    export_count = suspensions.count()
-    logger.info("Exported %s suspensions in %.2f sec.", export_count, time.perf_counter() - start_counter)
+
+def write_xlsx(file, approvals=None):
+    """
+    Write the approvals export to `file` (a path or a file object), in a write-only workbook.
+    """
+    wb = Workbook(write_only=True)
+    current_dt = datetime.datetime.now()
+    logger.info("Loading approvals data...")
+    _write_worksheet(
+        wb,
+        "Export PASS IAE " + current_dt.strftime(DATE_FMT),
+        FIELDS_WS1,
+        _log_export(_iter_pass_rows(approvals), "approvals"),
+    )
+    logger.info("Loading suspension data...")
+    _write_worksheet(
+        wb,
+        "Suspensions PASS IAE",
+        FIELDS_WS2,
+        _log_export(_iter_suspended_pass_rows(approvals), "suspensions"),
+    )
+    wb.save(file)
 
 
-def export_approvals(tmp_file=None):
+def iter_csv_gz(approvals=None):
     """
-    Main entry point. Currently used by admin site and an admin command:
+    Yield the gzip compressed CSV export of worksheet 1 as rows are read from the database,
+    e.g. for a `StreamingHttpResponse`.
+    """
+    # `16 + MAX_WBITS` produces the gzip container instead of a raw zlib stream.
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(FIELDS_WS1)
+
+    for row in _log_export(_iter_pass_rows(approvals), "approvals"):
+        writer.writerow(row)
+        if buffer.tell() >= CSV_CHUNK_SIZE:
+            chunk = compressor.compress(buffer.getvalue().encode("utf-8"))
+            buffer.seek(0)
+            buffer.truncate()
+            if chunk:
+                yield chunk
+
+    yield compressor.compress(buffer.getvalue().encode("utf-8")) + compressor.flush()
+
+
+def get_export_filename(export_format):
+    suffix = datetime.datetime.now().strftime("%d%m%Y_%H%M%S")
+    extension = "csv.gz" if export_format == CSV else "xlsx"
+    return f"export_pass_iae_{suffix}.{extension}"
+
+
+def export_approvals(export_format=XLSX):
+    """
+    Main entry point of the admin command:
         $ itou/approvals/management/commands/export_approvals.py
 
-    `tmp_file` can be either:
-        * 'None':     management command usage => save result as a file
-        * valid file: admin site usage => file will be bundled in a HTTP response object
+    The admin site streams the same exports, see `admin_views.export_approvals`.
+
+    `export_format` can be either:
+        * XLSX: approvals and their suspensions in 2 worksheets
+        * CSV: gzip compressed CSV of approvals only
 
-    Returns:  a valid filename for HTTP streaming (inline attachment) or storage
+    Returns: the path of the export file
     """
-    wb = Workbook()
-    _format_pass_worksheet(wb)
-    _format_suspended_pass_worksheet(wb)
+    path = f"{settings.EXPORT_DIR}/{get_export_filename(export_format)}"
 
-    current_dt = datetime.datetime.now()
-    suffix = current_dt.strftime("%d%m%Y_%H%M%S")
-    filename = f"export_pass_iae_{suffix}.xlsx"
-
-    # No streaming: management command usage
-    if not tmp_file:
-        path = f"{settings.EXPORT_DIR}/{filename}"
-        wb.save(path)
-        return path
-
-    # Admin usage: Save tmp file for stream purposes
-    wb.save(tmp_file.name)
-    return filename
+    if export_format == CSV:
+        with open(path, "wb") as f:
+            for chunk in iter_csv_gz():
+                f.write(chunk)
+    else:
+        write_xlsx(path)
+
+    return path
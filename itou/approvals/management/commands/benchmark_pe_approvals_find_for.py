@@ -0,0 +1,67 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from itou.approvals.models import PoleEmploiApproval
+from itou.users.models import User
+
+
+class Command(BaseCommand):
+    """
+    Measure the response time of `PoleEmploiApproval.objects.find_for()`.
+
+    Meant to be run on a database holding the national volume of Pôle emploi approvals,
+    e.g. after a change of the indexes of the table.
+
+    Searched job seekers are a random sample of existing approvals, plus as many
+    unknown job seekers since most searches don't match any approval.
+
+    To run the command:
+        django-admin benchmark_pe_approvals_find_for --sample-size=1000
+    """
+
+    help = "Report the response times of PoleEmploiApproval.objects.find_for()."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sample-size", type=int, default=1000, help="Number of existing approvals searched.")
+
+    def get_job_seekers(self, sample_size, count):
+        # `ORDER BY random()` would read the whole table.
+        sample_percentage = min(100, 2 * 100 * sample_size / max(count, 1))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT pole_emploi_id, birthdate FROM {PoleEmploiApproval._meta.db_table}
+                TABLESAMPLE BERNOULLI(%s) LIMIT %s
+                """,
+                [sample_percentage, sample_size],
+            )
+            rows = cursor.fetchall()
+        job_seekers = [User(pole_emploi_id=pole_emploi_id, birthdate=birthdate) for pole_emploi_id, birthdate in rows]
+        # Unknown job seekers.
+        job_seekers += [
+            User(pole_emploi_id=pole_emploi_id[::-1], birthdate=birthdate) for pole_emploi_id, birthdate in rows
+        ]
+        return job_seekers
+
+    def handle(self, sample_size, **options):
+        count = PoleEmploiApproval.objects.count()
+        self.stdout.write(f"{count} Pôle emploi approvals in the database.")
+
+        durations = []
+        for job_seeker in self.get_job_seekers(sample_size, count):
+            start = time.perf_counter()
+            list(PoleEmploiApproval.objects.find_for(job_seeker))
+            durations.append((time.perf_counter() - start) * 1000)
+
+        if len(durations) < 2:
+            self.stdout.write("Not enough approvals to report response times.")
+            return
+
+        percentiles = statistics.quantiles(durations, n=100)
+        self.stdout.write(f"{len(durations)} searches.")
+        self.stdout.write(f"p50: {percentiles[49]:.2f} ms")
+        self.stdout.write(f"p99: {percentiles[98]:.2f} ms")
+        self.stdout.write(f"max: {max(durations):.2f} ms")
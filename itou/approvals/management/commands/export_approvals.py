@@ -1,6 +1,6 @@
 from django.core.management.base import BaseCommand
 
-from itou.approvals.export import export_approvals
+from itou.approvals.export import EXPORT_FORMATS, XLSX, export_approvals
 
 
 class Command(BaseCommand):
@@ -11,13 +11,17 @@ class Command(BaseCommand):
     * named 'export_pass_iae_MMDDYYY_HHMINSEC.xslx' (datetime of export)
     * put in the 'exports' folder
 
-    There is no optional argument at the moment.
+    With `--format=csv`, approvals are exported without their suspensions
+    to a gzip compressed 'export_pass_iae_MMDDYYY_HHMINSEC.csv.gz' file.
     """
 
     help = "Export the content of the Approvals from the database into an xlsx file."
 
-    def handle(self, **options):
+    def add_arguments(self, parser):
+        parser.add_argument("--format", dest="export_format", choices=EXPORT_FORMATS, default=XLSX)
+
+    def handle(self, export_format, **options):
         self.stdout.write("Exporting approvals / PASS IAE")
-        result = export_approvals()
+        result = export_approvals(export_format=export_format)
         self.stdout.write("Approvals / PASS IAE export file written to:")
         self.stdout.write(result)
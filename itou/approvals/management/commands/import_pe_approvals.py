@@ -1,13 +1,19 @@
-import datetime
+import collections
+import csv
+import io
+import itertools
 import logging
 import os
 
+import numpy as np
+import openpyxl
 import pandas as pd
 from django.core.management.base import BaseCommand
+from django.db import connection, transaction
 from django.utils import timezone
 from tqdm import tqdm
 
-from itou.approvals.models import PoleEmploiApproval
+from itou.approvals.models import PoleEmploiApproval, PoleEmploiApprovalImport
 
 
 class Command(BaseCommand):
@@ -20,6 +26,13 @@ class Command(BaseCommand):
 
     To populate the database:
         django-admin import_pe_approvals --file-path=/tmp/2020_02_12_base_agrements_aura.xlsx
+
+    Each file contains all the approvals known by Pôle emploi. Only differences with the previous import
+    are applied: unknown approvals are inserted, known approvals whose values changed are updated
+    and known approvals that have been canceled are deleted. Each import is recorded as a `PoleEmploiApprovalImport`.
+
+    Rejected rows are written with the reason of their rejection in a CSV file,
+    by default next to the imported file: /tmp/2020_02_12_base_agrements_aura_rejected.csv
     """
 
     help = "Import the content of the Pole emploi's approvals xlsx file into the database."
@@ -29,6 +42,28 @@ class Command(BaseCommand):
     # Otherwise it would be too easy.
     FALLBACK_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
 
+    # Rows are copied into a temporary table before being merged into `PoleEmploiApproval`.
+    STAGING_TABLE_NAME = "pe_approvals_staging"
+    STAGING_COLUMNS = [
+        "pe_structure_code",
+        "pole_emploi_id",
+        "number",
+        "first_name",
+        "last_name",
+        "birth_name",
+        "birthdate",
+        "start_at",
+        "end_at",
+    ]
+    # Number of rows cleaned and sent to the database at once.
+    CHUNK_SIZE = 5000
+    # Hash of the imported values of an approval, to detect approvals that changed since the previous import.
+    # Existing approvals were fingerprinted by the `0022_poleemploiapproval_import_fingerprint` migration.
+    FINGERPRINT_SQL = (
+        "md5(concat_ws('|', pe_structure_code, pole_emploi_id, first_name, last_name, birth_name, "
+        "birthdate, start_at, end_at))"
+    )
+
     def add_arguments(self, parser):
         parser.add_argument(
             "--file-path",
@@ -37,6 +72,12 @@ class Command(BaseCommand):
             action="store",
             help="Absolute path of the XLSX file to import",
         )
+        parser.add_argument(
+            "--rejected-rows-file-path",
+            dest="rejected_rows_file_path",
+            action="store",
+            help="Absolute path of the CSV file listing rejected rows, defaults to a file next to the imported one",
+        )
         parser.add_argument("--dry-run", dest="dry_run", action="store_true", help="Only print data to import")
 
     def set_logger(self, verbosity):
@@ -53,151 +94,245 @@ class Command(BaseCommand):
         if verbosity > 1:
             self.logger.setLevel(logging.DEBUG)
 
-    def parse_date(self, value):
+    def parse_dates(self, values):
         """
         In some of the XLS files provided, there are find two date formats.
+        Values matching none of them are parsed as `NaT`.
+        """
+        if pd.api.types.is_datetime64_any_dtype(values):
+            return values
+        values = values.astype(str).str.strip()
+        dates = pd.to_datetime(values, format=self.DATE_FORMAT, errors="coerce")
+        fallback_dates = pd.to_datetime(values, format=self.FALLBACK_DATE_FORMAT, errors="coerce")
+        return dates.fillna(fallback_dates)
+
+    def iter_chunks(self, rows, header):
+        while True:
+            chunk = list(itertools.islice(rows, self.CHUNK_SIZE))
+            if not chunk:
+                return
+            # Without `dtype=object`, pandas infers the type of each column from the values of the chunk,
+            # e.g. a column of codes having an empty cell would become a column of floats.
+            yield pd.DataFrame(chunk, columns=header, dtype=object)
+
+    def clean_strings(self, values):
+        """
+        Cells are read with the type they have in the file: numbers (e.g. structure codes)
+        are converted back to strings without any decimal part, and missing values to empty strings.
+        """
+        values = values.map(
+            lambda value: str(int(value)) if isinstance(value, float) and value.is_integer() else value
+        )
+        return values.fillna("").astype(str).str.strip()
+
+    def clean_chunk(self, df, now):
+        """
+        Clean a chunk of rows with column operations.
+
+        Return the approvals to import with their values ordered as in `STAGING_COLUMNS`
+        and the rejected rows along with the reason of their rejection.
+        """
+        approvals = pd.DataFrame(
+            {
+                "pe_structure_code": self.clean_strings(df.CODE_STRUCT_AFFECT_BENE),
+                # This is known as "Identifiant Pôle emploi".
+                "pole_emploi_id": self.clean_strings(df.ID_REGIONAL_BENE),
+                "number": self.clean_strings(df.NUM_AGR_DEC).str.replace(" ", ""),
+                "first_name": self.clean_strings(df.PRENOM_BENE),
+                "last_name": self.clean_strings(df.NOM_USAGE_BENE),
+                "birth_name": self.clean_strings(df.NOM_NAISS_BENE),
+                "birthdate": self.parse_dates(df.DATE_NAISS_BENE),
+                "start_at": self.parse_dates(df.DATE_DEB),
+                "end_at": self.parse_dates(df.DATE_FIN),
+            },
+            columns=self.STAGING_COLUMNS,
+        )
+
+        # Pôle emploi sends us the year in a two-digit format ("14/03/68")
+        # but strptime() will set it in the future:
+        # >>> datetime.datetime.strptime("14/03/68", "%d/%m/%y").date()
+        # datetime.date(2068, 3, 14)
+        is_in_the_future = approvals.birthdate.dt.year > now.year
+        approvals.loc[is_in_the_future, "birthdate"] -= pd.DateOffset(years=100)
+
+        names = approvals[["first_name", "last_name", "birth_name"]]
+        # The first matching reason is reported.
+        rejection_reasons = {
+            "invalid CODE_STRUCT_AFFECT_BENE": ~approvals.pe_structure_code.str.len().isin([4, 5]),
+            # First 7 chars should be digits and the last one alphanumeric.
+            "invalid ID_REGIONAL_BENE": ~approvals.pole_emploi_id.str.fullmatch(r"\d{7}[0-9A-Za-z]"),
+            "invalid NUM_AGR_DEC": ~approvals.number.str.len().isin([12, 15]),
+            "double spaces in names": names.apply(lambda name: name.str.contains("  ")).any(axis=1),
+            "invalid dates": approvals[["birthdate", "start_at", "end_at"]].isna().any(axis=1),
+        }
+        reasons = pd.Series(
+            np.select(list(rejection_reasons.values()), list(rejection_reasons.keys()), default=""),
+            index=df.index,
+        )
+        is_rejected = reasons != ""
+        rejected_rows = df[is_rejected].assign(reason=reasons[is_rejected])
+
+        return approvals[~is_rejected], rejected_rows
+
+    def create_staging_table(self, cursor):
+        """
+        The staging table has the types of `approvals_poleemploiapproval` but none of its constraints,
+        and is dropped at the end of the transaction.
+        """
+        cursor.execute(
+            f"CREATE TEMPORARY TABLE {self.STAGING_TABLE_NAME} ON COMMIT DROP AS "
+            f"SELECT {', '.join(self.STAGING_COLUMNS)} FROM {PoleEmploiApproval._meta.db_table} WITH NO DATA"
+        )
+        # `row_number` is filled by `COPY` in the order of the rows in the file.
+        cursor.execute(
+            f"ALTER TABLE {self.STAGING_TABLE_NAME} ADD COLUMN row_number serial, ADD COLUMN fingerprint text"
+        )
+
+    def copy_to_staging_table(self, cursor, approvals):
+        buffer = io.StringIO()
+        # Quoting every value ensures empty strings are not read as NULL by `COPY`.
+        approvals.to_csv(buffer, header=False, index=False, quoting=csv.QUOTE_ALL, date_format="%Y-%m-%d")
+        buffer.seek(0)
+        cursor.copy_expert(
+            f"COPY {self.STAGING_TABLE_NAME} ({', '.join(self.STAGING_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+            buffer,
+        )
+
+    def merge_staging_table(self, cursor, created_at):
+        """
+        Apply the differences between the staged approvals and the known ones, matched by number.
+        Return the number of inserted, updated and canceled (i.e. deleted) approvals.
         """
-        value = str(value).strip()
-        try:
-            return datetime.datetime.strptime(value, self.DATE_FORMAT).date()
-        except ValueError:
-            return datetime.datetime.strptime(value, self.FALLBACK_DATE_FORMAT).date()
+        staging_table_name = self.STAGING_TABLE_NAME
+        table_name = PoleEmploiApproval._meta.db_table
 
-    def handle(self, file_path, dry_run=False, **options):
+        # A number can be found several times in the same file, keep its last row.
+        cursor.execute(
+            f"DELETE FROM {staging_table_name} AS a USING {staging_table_name} AS b "
+            f"WHERE a.number = b.number AND a.row_number < b.row_number"
+        )
+        cursor.execute(f"UPDATE {staging_table_name} SET fingerprint = {self.FINGERPRINT_SQL}")
+        cursor.execute(f"ANALYZE {staging_table_name}")
+
+        # Same start and end dates means that the approval has been canceled: it is deleted if it was
+        # known, and never stored otherwise, so that it can't put its holder in a waiting period.
+        cursor.execute(
+            f"DELETE FROM {table_name} USING {staging_table_name} "
+            f"WHERE {table_name}.number = {staging_table_name}.number "
+            f"AND {staging_table_name}.start_at = {staging_table_name}.end_at"
+        )
+        count_canceled = cursor.rowcount
+        cursor.execute(f"DELETE FROM {staging_table_name} WHERE start_at = end_at")
+
+        assignments = [
+            f"{column} = {staging_table_name}.{column}" for column in self.STAGING_COLUMNS if column != "number"
+        ]
+        assignments.append(f"import_fingerprint = {staging_table_name}.fingerprint")
+        cursor.execute(
+            f"UPDATE {table_name} SET {', '.join(assignments)} FROM {staging_table_name} "
+            f"WHERE {table_name}.number = {staging_table_name}.number "
+            f"AND {table_name}.import_fingerprint <> {staging_table_name}.fingerprint"
+        )
+        count_updated = cursor.rowcount
+
+        columns = ", ".join(self.STAGING_COLUMNS)
+        cursor.execute(
+            f"INSERT INTO {table_name} ({columns}, import_fingerprint, created_at) "
+            f"SELECT {columns}, fingerprint, %s FROM {staging_table_name} "
+            f"ON CONFLICT (number) DO NOTHING",
+            [created_at],
+        )
+        count_inserted = cursor.rowcount
+
+        return count_inserted, count_updated, count_canceled
+
+    def handle(self, file_path, rejected_rows_file_path=None, dry_run=False, **options):
 
         self.set_logger(options.get("verbosity"))
 
         now = timezone.now().date()
 
         count_before = PoleEmploiApproval.objects.count()
-        count_canceled_approvals = 0
-        unique_approval_suffixes = {}
+        count_rejected_rows = 0
+        unique_approval_suffixes = collections.Counter()
 
-        file_size_in_bytes = os.path.getsize(file_path)
-        self.stdout.write(f"Opening a {file_size_in_bytes >> 20} MB file… (this will take some time)")
+        if not rejected_rows_file_path:
+            rejected_rows_file_path = f"{os.path.splitext(file_path)[0]}_rejected.csv"
 
-        bulk_create_queue = []
-        chunk_size = 5000
+        file_size_in_bytes = os.path.getsize(file_path)
+        self.stdout.write(f"Opening a {file_size_in_bytes >> 20} MB file…")
 
-        df = pd.read_excel(file_path)
-        df["DATE_HISTO"] = pd.to_datetime(df.DATE_HISTO, format=self.DATE_FORMAT)
-        df.sort_values("DATE_HISTO")
-        first_approval_date = df.iloc[0].DATE_HISTO.strftime(self.DATE_FORMAT)
-        last_approval_date = df.iloc[-1].DATE_HISTO.strftime(self.DATE_FORMAT)
+        # The read-only mode streams the rows of the file instead of loading all of them in memory.
+        workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        worksheet = workbook.active
+        rows = worksheet.iter_rows(values_only=True)
+        header = next(rows)
+        # The dimensions of the sheet are read from its metadata, which may be missing.
+        total_rows = worksheet.max_row - 1 if worksheet.max_row else None
 
         self.stdout.write("Ready.")
-        self.stdout.write(f"Importing up to {len(df)} approvals from {first_approval_date} to {last_approval_date}")
-
-        pbar = tqdm(total=len(df))
-        for idx, row in df.iterrows():
-            pbar.update(1)
-
-            if idx == 0:
-                # Skip XLSX header.
-                continue
-
-            CODE_STRUCT_AFFECT_BENE = str(row["CODE_STRUCT_AFFECT_BENE"])
-            assert len(CODE_STRUCT_AFFECT_BENE) in [4, 5]
-
-            # This is known as "Identifiant Pôle emploi".
-            ID_REGIONAL_BENE = str(row["ID_REGIONAL_BENE"]).strip()
-            if len(ID_REGIONAL_BENE) < 8:
-                self.logger.debug("-" * 80)
-                self.logger.debug("Bad format for ID_REGIONAL_BENE (PE ID) found, skipping…")
-                self.logger.debug("%s", ID_REGIONAL_BENE)
-                continue
-            # Check the format of ID_REGIONAL_BENE.
-            # First 7 chars should be digits.
-            assert ID_REGIONAL_BENE[:7].isdigit()
-            # Last char should be alphanumeric.
-            assert ID_REGIONAL_BENE[7:].isalnum()
-
-            NOM_USAGE_BENE = row["NOM_USAGE_BENE"].strip()
-            assert "  " not in NOM_USAGE_BENE
-            # max length 29
-
-            PRENOM_BENE = row["PRENOM_BENE"].strip()
-            assert "  " not in PRENOM_BENE
-            # max length 13
-
-            NOM_NAISS_BENE = row["NOM_NAISS_BENE"].strip()
-            assert "  " not in NOM_NAISS_BENE
-            # max length 25
-
-            NUM_AGR_DEC = row["NUM_AGR_DEC"].strip().replace(" ", "")
-            assert " " not in NUM_AGR_DEC
-            if len(NUM_AGR_DEC) not in [12, 15]:
-                self.stderr.write("-" * 80)
-                self.stderr.write("Invalid number, skipping…")
-                self.stderr.write(CODE_STRUCT_AFFECT_BENE)
-                self.stderr.write(ID_REGIONAL_BENE)
-                self.stderr.write(NOM_USAGE_BENE)
-                self.stderr.write(PRENOM_BENE)
-                self.stderr.write(NOM_NAISS_BENE)
-                self.stderr.write(NUM_AGR_DEC)
-                continue
-
-            # Keep track of unique suffixes added by PE at the end of a 12 chars number
-            # that increases the length to 15 chars.
-            if len(NUM_AGR_DEC) > 12:
-                suffix = NUM_AGR_DEC[12:]
-                unique_approval_suffixes[suffix] = unique_approval_suffixes.get(suffix, 0) + 1
-
-            DATE_DEB_AGR_DEC = self.parse_date(row["DATE_DEB"])
-            DATE_FIN_AGR_DEC = self.parse_date(row["DATE_FIN"])
-            DATE_NAISS_BENE = self.parse_date(row["DATE_NAISS_BENE"])
-
-            # Same start and end dates means that the approval has been canceled.
-            if DATE_DEB_AGR_DEC == DATE_FIN_AGR_DEC:
-                count_canceled_approvals += 1
-                self.logger.debug("-" * 80)
-                self.logger.debug("Canceled approval found, skipping…")
-                self.logger.debug("%s - %s - %s", NUM_AGR_DEC, NOM_USAGE_BENE, PRENOM_BENE)
-                continue
-
-            # Pôle emploi sends us the year in a two-digit format ("14/03/68")
-            # but strptime() will set it in the future:
-            # >>> datetime.datetime.strptime("14/03/68", "%d/%m/%y").date()
-            # datetime.date(2068, 3, 14)
-            if DATE_NAISS_BENE.year > now.year:
-                str_d = DATE_NAISS_BENE.strftime("%Y-%m-%d")
-                # Replace the first 2 digits by "19".
-                str_d = f"19{str_d[2:]}"
-                DATE_NAISS_BENE = datetime.datetime.strptime(str_d, "%Y-%m-%d")
-
-            if not dry_run:
-                pe_approval = PoleEmploiApproval()
-                pe_approval.pe_structure_code = CODE_STRUCT_AFFECT_BENE
-                pe_approval.pole_emploi_id = ID_REGIONAL_BENE
-                pe_approval.number = NUM_AGR_DEC
-                pe_approval.first_name = PRENOM_BENE
-                pe_approval.last_name = NOM_USAGE_BENE
-                pe_approval.birth_name = NOM_NAISS_BENE
-                pe_approval.birthdate = DATE_NAISS_BENE
-                pe_approval.start_at = DATE_DEB_AGR_DEC
-                pe_approval.end_at = DATE_FIN_AGR_DEC
-                bulk_create_queue.append(pe_approval)
-                if len(bulk_create_queue) > chunk_size:
-                    # Setting the ignore_conflicts parameter to True tells the
-                    # database to ignore failure to insert any rows that fail
-                    # constraints such as duplicate unique values.
-                    # This allows us to update the database when a new source
-                    # file is available.
-                    PoleEmploiApproval.objects.bulk_create(bulk_create_queue, ignore_conflicts=True)
-                    bulk_create_queue = []
+        self.stdout.write(f"Importing up to {total_rows} approvals")
+
+        first_approval_date = None
+        last_approval_date = None
+        pe_approval_import = PoleEmploiApprovalImport(file_name=os.path.basename(file_path))
+
+        pbar = tqdm(total=total_rows)
+        with open(rejected_rows_file_path, "w", newline="") as rejected_rows_file, transaction.atomic():
+            with connection.cursor() as cursor:
+                if not dry_run:
+                    self.create_staging_table(cursor)
+
+                for df in self.iter_chunks(rows, header):
+                    pbar.update(len(df))
+
+                    approval_dates = self.parse_dates(df.DATE_HISTO).dropna()
+                    if not approval_dates.empty:
+                        first_approval_date = min(first_approval_date or approval_dates.min(), approval_dates.min())
+                        last_approval_date = max(last_approval_date or approval_dates.max(), approval_dates.max())
+
+                    approvals, rejected_rows = self.clean_chunk(df, now)
+
+                    # pandas writes the header even for an empty dataframe.
+                    if not rejected_rows.empty:
+                        rejected_rows.to_csv(rejected_rows_file, header=count_rejected_rows == 0, index=False)
+                        count_rejected_rows += len(rejected_rows)
+
+                    # Keep track of unique suffixes added by PE at the end of a 12 chars number
+                    # that increases the length to 15 chars.
+                    unique_approval_suffixes.update(approvals.number.str[12:][approvals.number.str.len() > 12])
+
+                    if not dry_run:
+                        self.copy_to_staging_table(cursor, approvals)
+
+                if not dry_run:
+                    (
+                        pe_approval_import.count_inserted,
+                        pe_approval_import.count_updated,
+                        pe_approval_import.count_canceled,
+                    ) = self.merge_staging_table(cursor, created_at=pe_approval_import.created_at)
+                    pe_approval_import.count_rejected = count_rejected_rows
+                    pe_approval_import.save()
+                    # Drop the staging table right away rather than on commit, in case of an outer transaction.
+                    cursor.execute(f"DROP TABLE {self.STAGING_TABLE_NAME}")
 
         pbar.close()
-
-        # Create any remaining objects.
-        if not dry_run and bulk_create_queue:
-            PoleEmploiApproval.objects.bulk_create(bulk_create_queue, ignore_conflicts=True)
+        workbook.close()
 
         count_after = PoleEmploiApproval.objects.count()
 
         self.stdout.write("-" * 80)
+        if first_approval_date:
+            self.stdout.write(
+                f"Approvals from {first_approval_date.strftime(self.DATE_FORMAT)} "
+                f"to {last_approval_date.strftime(self.DATE_FORMAT)}"
+            )
         self.stdout.write(f"Before: {count_before}")
         self.stdout.write(f"After: {count_after}")
-        self.stdout.write(f"New objects: {count_after - count_before} (in case of dry run this will always be zero)")
-        self.stdout.write(f"Skipped {count_canceled_approvals} canceled approvals")
-        self.stdout.write(f"Unique suffixes: {unique_approval_suffixes}")
+        self.stdout.write("In case of dry run, the following counts will always be zero:")
+        self.stdout.write(f"New objects: {pe_approval_import.count_inserted}")
+        self.stdout.write(f"Updated objects: {pe_approval_import.count_updated}")
+        self.stdout.write(f"Canceled objects: {pe_approval_import.count_canceled}")
+        self.stdout.write(f"Rejected {count_rejected_rows} invalid rows, see {rejected_rows_file_path}")
+        self.stdout.write(f"Unique suffixes: {dict(unique_approval_suffixes)}")
         self.stdout.write("Done.")
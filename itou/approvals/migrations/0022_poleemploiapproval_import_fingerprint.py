@@ -0,0 +1,66 @@
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("approvals", "0021_approval_create_employee_record"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="poleemploiapproval",
+            name="import_fingerprint",
+            field=models.CharField(blank=True, editable=False, max_length=32, verbose_name="Empreinte d'import"),
+        ),
+        migrations.CreateModel(
+            name="PoleEmploiApprovalImport",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("file_name", models.CharField(max_length=255, verbose_name="Nom du fichier")),
+                ("count_inserted", models.PositiveIntegerField(default=0, verbose_name="Agréments créés")),
+                ("count_updated", models.PositiveIntegerField(default=0, verbose_name="Agréments mis à jour")),
+                ("count_canceled", models.PositiveIntegerField(default=0, verbose_name="Agréments annulés")),
+                ("count_rejected", models.PositiveIntegerField(default=0, verbose_name="Lignes rejetées")),
+                (
+                    "created_at",
+                    models.DateTimeField(default=django.utils.timezone.now, verbose_name="Date d'import"),
+                ),
+            ],
+            options={
+                "verbose_name": "Import d'agréments Pôle emploi",
+                "verbose_name_plural": "Imports d'agréments Pôle emploi",
+                "ordering": ["-created_at"],
+            },
+        ),
+        # Fingerprint existing approvals so that the next import only updates the ones that changed.
+        # Must match `import_pe_approvals.Command.FINGERPRINT_SQL`.
+        migrations.RunSQL(
+            """
+            update approvals_poleemploiapproval set import_fingerprint = md5(concat_ws(
+                '|', pe_structure_code, pole_emploi_id, first_name, last_name, birth_name, birthdate, start_at, end_at
+            ))
+            """,
+            migrations.RunSQL.noop,
+        ),
+        # One import per day on which approvals were created, as previously computed by `get_import_dates()`
+        # with `TruncDate`, i.e. in the local timezone and not in UTC.
+        migrations.RunSQL(
+            [
+                (
+                    """
+                    insert into approvals_poleemploiapprovalimport (
+                        file_name, count_inserted, count_updated, count_canceled, count_rejected, created_at
+                    )
+                    select '', count(*), 0, 0, 0, min(created_at)
+                    from approvals_poleemploiapproval
+                    group by (created_at at time zone %s)::date
+                    """,
+                    [settings.TIME_ZONE],
+                )
+            ],
+            migrations.RunSQL.noop,
+        ),
+    ]
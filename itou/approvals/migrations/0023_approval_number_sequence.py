@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.db import migrations
+
+
+def seed_number_sequence(apps, schema_editor):
+    """
+    Start the sequence after the greatest "PASS IAE" number issued so far.
+    """
+    prefix = settings.ASP_ITOU_PREFIX
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT max(substr(number, %(start)s)::integer)
+            FROM approvals_approval
+            WHERE left(number, %(length)s) = %(prefix)s AND substr(number, %(start)s) ~ '^[0-9]{7}$'
+            """,
+            {"prefix": prefix, "length": len(prefix), "start": len(prefix) + 1},
+        )
+        last_number = cursor.fetchone()[0]
+        if last_number:
+            cursor.execute("SELECT setval('approvals_approval_number_seq', %s)", [last_number])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("approvals", "0022_poleemploiapproval_import_fingerprint"),
+    ]
+
+    operations = [
+        # See `Approval.get_next_number()`.
+        migrations.RunSQL(
+            sql="CREATE SEQUENCE approvals_approval_number_seq OWNED BY approvals_approval.number;",
+            reverse_sql="DROP SEQUENCE approvals_approval_number_seq;",
+        ),
+        migrations.RunPython(seed_number_sequence, migrations.RunPython.noop),
+    ]
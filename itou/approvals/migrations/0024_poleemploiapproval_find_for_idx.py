@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("approvals", "0023_approval_number_sequence"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="poleemploiapproval",
+            name="pe_id_and_birthdate_idx",
+        ),
+        migrations.AddIndex(
+            model_name="poleemploiapproval",
+            index=models.Index(fields=["pole_emploi_id", "birthdate", "-start_at"], name="pe_approval_find_for_idx"),
+        ),
+    ]
@@ -0,0 +1,20 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("approvals", "0024_poleemploiapproval_find_for_idx"),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name="approval",
+            options={
+                "ordering": ["-created_at"],
+                "permissions": [("export_approval", "Can export PASS IAE")],
+                "verbose_name": "PASS IAE",
+                "verbose_name_plural": "PASS IAE",
+            },
+        ),
+    ]
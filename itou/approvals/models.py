@@ -1,6 +1,7 @@
 import datetime
 import logging
 import time
+from collections import defaultdict
 
 from dateutil.relativedelta import relativedelta
 from django.conf import settings
@@ -8,8 +9,8 @@ from django.contrib.postgres.constraints import ExclusionConstraint
 from django.contrib.postgres.fields import RangeBoundary, RangeOperators
 from django.core.exceptions import ValidationError
 from django.core.validators import MinLengthValidator
-from django.db import models
-from django.db.models import Count, Q
+from django.db import connection, models
+from django.db.models import F, Q, Sum, Value
 from django.db.models.functions import TruncDate
 from django.utils import timezone
 from django.utils.functional import cached_property, classproperty
@@ -138,6 +139,9 @@ class Approval(CommonApprovalMixin):
     # This prefix is used by the ASP system to identify itou as the issuer of a number.
     ASP_ITOU_PREFIX = settings.ASP_ITOU_PREFIX
 
+    # PostgreSQL sequence of "PASS IAE" numbers, see `get_next_number()`.
+    NUMBER_SEQUENCE_NAME = "approvals_approval_number_seq"
+
     # The period of time during which it is possible to prolong a PASS IAE.
     IS_OPEN_TO_PROLONGATION_BOUNDARIES_MONTHS = 3
 
@@ -178,6 +182,7 @@ class Approval(CommonApprovalMixin):
         verbose_name = "PASS IAE"
         verbose_name_plural = "PASS IAE"
         ordering = ["-created_at"]
+        permissions = [("export_approval", "Can export PASS IAE")]
 
     def __str__(self):
         return self.number
@@ -188,7 +193,6 @@ class Approval(CommonApprovalMixin):
         already_exists = bool(self.pk)
 
         if not self.number:
-            # `get_next_number` will lock rows until the end of the transaction.
             self.number = self.get_next_number()
 
         if not already_exists:
@@ -339,23 +343,40 @@ class Approval(CommonApprovalMixin):
             - YEAR WITHOUT CENTURY is equal to the start year of the `JobApplication.hiring_start_at`
             - A max of 99999 approvals could be issued by year
             - We would have gone beyond, we would never have thought we could go that far
+
+        NUMBER is taken from a PostgreSQL sequence (seeded with the last number issued, see migration
+        `0023_approval_number_sequence`) so that concurrent hirings don't wait for each other's transaction.
+        A number taken by a transaction which is rolled back is never reused.
+
+        Numbers inserted explicitly (fixtures, tests…) don't move the sequence forward:
+        when the number taken is already used, the sequence skips to the greatest number used.
         """
-        last_itou_approval = (
-            Approval.objects
-            # select_for_update() returns a queryset that will lock rows until the end of the transaction.
-            # The lock is active for the duration of the transaction (see settings.ATOMIC_REQUESTS).
-            .select_for_update()
-            .filter(number__startswith=Approval.ASP_ITOU_PREFIX)
-            .order_by("number")
-            .last()
-        )
-        if last_itou_approval:
-            raw_number = last_itou_approval.number.removeprefix(Approval.ASP_ITOU_PREFIX)
-            next_number = int(raw_number) + 1
-            if next_number > 9999999:
-                raise RuntimeError("The maximum number of PASS IAE has been reached.")
-            return f"{Approval.ASP_ITOU_PREFIX}{next_number:07d}"
-        return f"{Approval.ASP_ITOU_PREFIX}0000001"
+        prefix = Approval.ASP_ITOU_PREFIX
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT nextval(%s)", [Approval.NUMBER_SEQUENCE_NAME])
+            next_number = cursor.fetchone()[0]
+            if Approval.objects.filter(number=f"{prefix}{next_number:07d}").exists():
+                cursor.execute(
+                    f"""
+                    SELECT setval(%(sequence)s, greatest(%(number)s, (
+                        SELECT max(substr(number, %(start)s)::integer)
+                        FROM {Approval._meta.db_table}
+                        WHERE left(number, %(length)s) = %(prefix)s AND substr(number, %(start)s) ~ '^[0-9]{{7}}$'
+                    )))
+                    """,
+                    {
+                        "sequence": Approval.NUMBER_SEQUENCE_NAME,
+                        "number": next_number,
+                        "prefix": prefix,
+                        "length": len(prefix),
+                        "start": len(prefix) + 1,
+                    },
+                )
+                cursor.execute("SELECT nextval(%s)", [Approval.NUMBER_SEQUENCE_NAME])
+                next_number = cursor.fetchone()[0]
+        if next_number > 9999999:
+            raise RuntimeError("The maximum number of PASS IAE has been reached.")
+        return f"{prefix}{next_number:07d}"
 
     @staticmethod
     def get_default_end_date(start_at):
@@ -399,6 +420,18 @@ class SuspensionQuerySet(models.QuerySet):
         now = timezone.now().date()
         return self.filter(end_at__lt=now)
 
+    def overlapping(self, start_at, end_at):
+        """
+        Suspensions overlapping the `[start_at, end_at]` period.
+
+        The period is compared with the `daterange` expression of the `exclude_overlapping_suspensions`
+        constraint so that the GiST index of the constraint can be used.
+        """
+        bounds = RangeBoundary(inclusive_lower=True, inclusive_upper=True)
+        return self.alias(period=DateRange("start_at", "end_at", bounds)).filter(
+            period__overlap=DateRange(Value(start_at), Value(end_at), bounds)
+        )
+
 
 class Suspension(models.Model):
     """
@@ -567,8 +600,8 @@ class Suspension(models.Model):
             # This check is enforced by a constraint at the database level but
             # still required here to avoid a 500 server error "IntegrityError"
             # during form validation.
-            if self.get_overlapping_suspensions().exists():
-                overlap = self.get_overlapping_suspensions().first()
+            overlap = self.get_overlapping_suspensions().first()
+            if overlap:
                 raise ValidationError(
                     {
                         "start_at": (
@@ -595,12 +628,11 @@ class Suspension(models.Model):
         return self.approval.start_at <= self.start_at <= self.approval.end_at
 
     def get_overlapping_suspensions(self):
-        args = {
-            "end_at__gte": self.start_at,
-            "start_at__lte": self.end_at,
-            "approval": self.approval,
-        }
-        return self._meta.model.objects.exclude(pk=self.pk).filter(**args)
+        return (
+            self._meta.model.objects.filter(approval=self.approval)
+            .overlapping(self.start_at, self.end_at)
+            .exclude(pk=self.pk)
+        )
 
     def can_be_handled_by_siae(self, siae):
         """
@@ -654,6 +686,18 @@ class ProlongationQuerySet(models.QuerySet):
     def not_in_progress(self):
         return self.exclude(self.in_progress_lookup)
 
+    def overlapping(self, start_at, end_at):
+        """
+        Prolongations overlapping the `[start_at, end_at)` period.
+
+        The period is compared with the `daterange` expression of the `exclude_overlapping_prolongations`
+        constraint so that the GiST index of the constraint can be used.
+        """
+        bounds = RangeBoundary(inclusive_lower=True, inclusive_upper=False)
+        return self.alias(period=DateRange("start_at", "end_at", bounds)).filter(
+            period__overlap=DateRange(Value(start_at), Value(end_at), bounds)
+        )
+
 
 class ProlongationManager(models.Manager):
     def get_cumulative_duration_for(self, approval, reason=None):
@@ -664,10 +708,8 @@ class ProlongationManager(models.Manager):
         kwargs = {"approval": approval}
         if reason:
             kwargs["reason"] = reason
-        duration = datetime.timedelta(0)
-        for prolongation in self.filter(**kwargs):
-            duration += prolongation.duration
-        return duration
+        duration = self.filter(**kwargs).aggregate(duration=Sum(F("end_at") - F("start_at")))["duration"]
+        return duration or datetime.timedelta(0)
 
 
 class Prolongation(models.Model):
@@ -865,8 +907,8 @@ class Prolongation(models.Model):
             # This check is enforced by a constraint at the database level but
             # still required here to avoid a 500 server error "IntegrityError"
             # during form validation.
-            if self.get_overlapping_prolongations().exists():
-                overlap = self.get_overlapping_prolongations().first()
+            overlap = self.get_overlapping_prolongations().first()
+            if overlap:
                 raise ValidationError(
                     (
                         f"La période chevauche une prolongation déjà existante pour ce PASS IAE "
@@ -905,12 +947,11 @@ class Prolongation(models.Model):
         return cumulative_duration > self.MAX_CUMULATIVE_DURATION[self.reason]["duration"]
 
     def get_overlapping_prolongations(self):
-        filter_args = {
-            "start_at__lte": self.end_at,  # Inclusive start.
-            "end_at__gt": self.start_at,  # Exclusive end.
-            "approval": self.approval,
-        }
-        return self._meta.model.objects.exclude(pk=self.pk).filter(**filter_args)
+        return (
+            self._meta.model.objects.filter(approval=self.approval)
+            .overlapping(self.start_at, self.end_at)
+            .exclude(pk=self.pk)
+        )
 
     @staticmethod
     def get_start_at(approval):
@@ -943,16 +984,15 @@ class PoleEmploiApprovalManager(models.Manager):
             …
         ]
 
-        It used to be used in the admin but it slowed it down.
         It's still used from time to time in django-admin shell.
+        Each import is recorded by the `import_pe_approvals` admin command,
+        so that approvals do not need to be grouped by creation date.
         """
         return list(
-            self
-            # Remove default `Meta.ordering` to avoid an extra field being added to the GROUP BY clause.
-            .order_by()
-            .annotate(import_date=TruncDate("created_at"))
+            PoleEmploiApprovalImport.objects.annotate(import_date=TruncDate("created_at"))
+            .order_by("import_date")
             .values_list("import_date", flat=True)
-            .annotate(c=Count("id"))
+            .distinct()
         )
 
     def find_for(self, user):
@@ -1042,6 +1082,9 @@ class PoleEmploiApproval(CommonApprovalMixin):
     last_name = models.CharField("Nom", max_length=150)
     birth_name = models.CharField("Nom de naissance", max_length=150)
     birthdate = models.DateField(verbose_name="Date de naissance", default=timezone.localdate)
+    # Hash of the values of the approval in the last imported file,
+    # used by the `import_pe_approvals` admin command to update only approvals that changed.
+    import_fingerprint = models.CharField("Empreinte d'import", max_length=32, blank=True, editable=False)
 
     objects = PoleEmploiApprovalManager.from_queryset(CommonApprovalQuerySet)()
 
@@ -1049,7 +1092,12 @@ class PoleEmploiApproval(CommonApprovalMixin):
         verbose_name = "Agrément Pôle emploi"
         verbose_name_plural = "Agréments Pôle emploi"
         ordering = ["-start_at"]
-        indexes = [models.Index(fields=["pole_emploi_id", "birthdate"], name="pe_id_and_birthdate_idx")]
+        indexes = [
+            # Matches `PoleEmploiApprovalManager.find_for()` filters and ordering.
+            # Searches on `number__startswith` use the `varchar_pattern_ops` index
+            # created by Django for the unique `number` field.
+            models.Index(fields=["pole_emploi_id", "birthdate", "-start_at"], name="pe_approval_find_for_idx"),
+        ]
 
     def __str__(self):
         return self.number
@@ -1110,6 +1158,27 @@ class PoleEmploiApproval(CommonApprovalMixin):
         return f"{self.number[:5]} {self.number[5:7]} {self.number[7:]}"
 
 
+class PoleEmploiApprovalImport(models.Model):
+    """
+    Store each import of a Pôle emploi's approvals file done with the `import_pe_approvals` admin command.
+    """
+
+    file_name = models.CharField("Nom du fichier", max_length=255)
+    count_inserted = models.PositiveIntegerField("Agréments créés", default=0)
+    count_updated = models.PositiveIntegerField("Agréments mis à jour", default=0)
+    count_canceled = models.PositiveIntegerField("Agréments annulés", default=0)
+    count_rejected = models.PositiveIntegerField("Lignes rejetées", default=0)
+    created_at = models.DateTimeField("Date d'import", default=timezone.now)
+
+    class Meta:
+        verbose_name = "Import d'agréments Pôle emploi"
+        verbose_name_plural = "Imports d'agréments Pôle emploi"
+        ordering = ["-created_at"]
+
+    def __str__(self):
+        return f"{self.file_name} ({self.created_at:%d/%m/%Y})"
+
+
 class ApprovalsWrapper:
     """
     Wrapper that manipulates both `Approval` and `PoleEmploiApproval` models.
@@ -1163,13 +1232,16 @@ class ApprovalsWrapper:
         )
     )
 
-    def __init__(self, user=None, number=None):
+    def __init__(self, user=None, number=None, approvals=None, pe_approvals=None):
+        """
+        `approvals` and `pe_approvals` are the already fetched approvals of `user`, see `for_users()`.
+        """
 
         self.user = user
         self.number = number
         self.latest_approval = None
         if user:
-            self.merged_approvals = self._merge_approvals_for_user()
+            self.merged_approvals = self._merge_approvals_for_user(approvals=approvals, pe_approvals=pe_approvals)
         elif number:
             self.merged_approvals = self._merge_approvals_for_number()
         else:
@@ -1192,27 +1264,65 @@ class ApprovalsWrapper:
         self.has_valid = self.status == self.VALID
         self.has_in_waiting_period = self.status == self.IN_WAITING_PERIOD
 
-    def _merge_approvals_for_user(self):
+    @classmethod
+    def for_users(cls, users):
+        """
+        Build the wrappers of many users at once with 2 SQL queries instead of up to 3 per user,
+        e.g. for lists and exports, and cache them in the `approvals_wrapper` property of each user.
+
+        Returns a dict of wrappers by user id.
+        """
+        job_seekers = [user for user in users if user.is_job_seeker]
+
+        approvals_by_user_id = defaultdict(list)
+        for approval in Approval.objects.filter(user__in={user.pk for user in job_seekers}).order_by("-start_at"):
+            approvals_by_user_id[approval.user_id].append(approval)
+
+        # Same matching as `PoleEmploiApprovalManager.find_for()`, done in memory.
+        pole_emploi_ids = {user.pole_emploi_id for user in job_seekers if user.pole_emploi_id and user.birthdate}
+        pe_approvals_by_key = defaultdict(list)
+        if pole_emploi_ids:
+            for pe_approval in PoleEmploiApproval.objects.filter(pole_emploi_id__in=pole_emploi_ids).order_by(
+                "-start_at"
+            ):
+                pe_approvals_by_key[(pe_approval.pole_emploi_id, pe_approval.birthdate)].append(pe_approval)
+
+        wrappers = {}
+        for user in job_seekers:
+            if user.pk not in wrappers:
+                wrappers[user.pk] = cls(
+                    user,
+                    approvals=approvals_by_user_id[user.pk],
+                    pe_approvals=pe_approvals_by_key[(user.pole_emploi_id, user.birthdate)],
+                )
+            # Fill the `cached_property`.
+            user.approvals_wrapper = wrappers[user.pk]
+        return wrappers
+
+    def _merge_approvals_for_user(self, approvals=None, pe_approvals=None):
         """
         Returns a list of merged unique `Approval` and `PoleEmploiApproval` objects.
         """
-        approvals = Approval.objects.filter(user=self.user).order_by("-start_at")
+        if approvals is None:
+            approvals = list(Approval.objects.filter(user=self.user).order_by("-start_at"))
 
         # If an ongoing PASS IAE exists, consider it's the latest valid approval
         # even if a PoleEmploiApproval is more recent.
-        if approvals.valid().exists():
+        if any(approval.is_valid() for approval in approvals):
             return approvals
 
-        today = datetime.date.today()
-        approvals_numbers = [approval.number for approval in approvals] if approvals else []
+        if pe_approvals is None:
+            pe_approvals = PoleEmploiApproval.objects.find_for(self.user)
 
-        pe_approvals = (
-            PoleEmploiApproval.objects.find_for(self.user)
-            .filter(start_at__lte=today)
-            .exclude(number__in=approvals_numbers)
-        )
+        today = datetime.date.today()
+        approvals_numbers = {approval.number for approval in approvals}
+        pe_approvals = [
+            pe_approval
+            for pe_approval in pe_approvals
+            if pe_approval.start_at <= today and pe_approval.number not in approvals_numbers
+        ]
 
-        merged_approvals = list(approvals) + list(pe_approvals)
+        merged_approvals = approvals + pe_approvals
         return self.sort_approvals(merged_approvals)
 
     def _merge_approvals_for_number(self):
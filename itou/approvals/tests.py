@@ -1,25 +1,36 @@
+import csv
 import datetime
+import gzip
+import importlib
+import io
+import os
+import tempfile
 from unittest import mock
 
+import openpyxl
 from dateutil.relativedelta import relativedelta
 from django.conf import settings
 from django.contrib.auth.models import Permission
 from django.contrib.contenttypes.models import ContentType
 from django.core import mail
 from django.core.exceptions import ValidationError
-from django.db import IntegrityError
+from django.core.management import call_command
+from django.db import IntegrityError, connection
 from django.template.defaultfilters import title
 from django.test import TestCase
 from django.urls import reverse
 from django.utils import timezone
 
 from itou.approvals.admin_forms import ApprovalAdminForm
+from itou.approvals.export import FIELDS_WS1
 from itou.approvals.factories import ApprovalFactory, PoleEmploiApprovalFactory, ProlongationFactory, SuspensionFactory
+from itou.approvals.management.commands.import_pe_approvals import Command as ImportPoleEmploiApprovalsCommand
 from itou.approvals.models import (
     Approval,
     ApprovalsWrapper,
     CommonApprovalMixin,
     PoleEmploiApproval,
+    PoleEmploiApprovalImport,
     Prolongation,
     Suspension,
 )
@@ -235,46 +246,43 @@ class ApprovalModelTest(TestCase):
             approval.save()
 
     def test_get_next_number(self):
-
-        # No pre-existing objects.
-        expected_number = f"{Approval.ASP_ITOU_PREFIX}0000001"
-        next_number = Approval.get_next_number()
-        self.assertEqual(next_number, expected_number)
-
-        # With pre-existing objects.
-        ApprovalFactory(number=f"{Approval.ASP_ITOU_PREFIX}0000040")
-        expected_number = f"{Approval.ASP_ITOU_PREFIX}0000041"
-        next_number = Approval.get_next_number()
-        self.assertEqual(next_number, expected_number)
-        Approval.objects.all().delete()
-
-        # With pre-existing Pôle emploi approval.
+        prefix = Approval.ASP_ITOU_PREFIX
+        seed_number_sequence = importlib.import_module(
+            "itou.approvals.migrations.0023_approval_number_sequence"
+        ).seed_number_sequence
+
+        def set_sequence(value):
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT setval(%s, %s)", [Approval.NUMBER_SEQUENCE_NAME, value])
+
+        # The sequence is seeded with the greatest number issued, other numbers are ignored.
+        ApprovalFactory(number=f"{prefix}0000040")
+        ApprovalFactory(number=f"{prefix}0000038")
         ApprovalFactory(number="625741810182")
-        expected_number = f"{Approval.ASP_ITOU_PREFIX}0000001"
-        next_number = Approval.get_next_number()
-        self.assertEqual(next_number, expected_number)
+        seed_number_sequence(apps=None, schema_editor=mock.Mock(connection=connection))
+        self.assertEqual(Approval.get_next_number(), f"{prefix}0000041")
+        self.assertEqual(Approval.get_next_number(), f"{prefix}0000042")
+
+        # A number already used, e.g. loaded from fixtures, is skipped
+        # along with all the numbers up to the greatest one used.
+        ApprovalFactory(number=f"{prefix}0000043")
+        ApprovalFactory(number=f"{prefix}0000050")
+        self.assertEqual(Approval.get_next_number(), f"{prefix}0000051")
         Approval.objects.all().delete()
 
-        # With various pre-existing objects.
-        ApprovalFactory(number=f"{Approval.ASP_ITOU_PREFIX}8888882")
-        ApprovalFactory(number="625741810182")
-        expected_number = f"{Approval.ASP_ITOU_PREFIX}8888883"
-        next_number = Approval.get_next_number()
-        self.assertEqual(next_number, expected_number)
-        Approval.objects.all().delete()
+        # The sequence is not moved backward.
+        self.assertEqual(Approval.get_next_number(), f"{prefix}0000052")
 
         demo_prefix = "XXXXX"
         with mock.patch.object(Approval, "ASP_ITOU_PREFIX", demo_prefix):
-            ApprovalFactory(number=f"{demo_prefix}0044440")
-            expected_number = f"{demo_prefix}0044441"
-            next_number = Approval.get_next_number()
-            self.assertEqual(next_number, expected_number)
-            Approval.objects.all().delete()
+            self.assertEqual(Approval.get_next_number(), f"{demo_prefix}0000053")
 
-        ApprovalFactory(number=f"{Approval.ASP_ITOU_PREFIX}9999999")
+        set_sequence(9999999)
         with self.assertRaises(RuntimeError):
-            next_number = Approval.get_next_number()
-        Approval.objects.all().delete()
+            Approval.get_next_number()
+
+        # Leave room for the approvals of the other tests.
+        set_sequence(1)
 
     def test_is_valid(self):
 
@@ -546,6 +554,273 @@ class PoleEmploiApprovalManagerTest(TestCase):
         self.assertEqual(search_results.first(), pe_approval)
         PoleEmploiApproval.objects.all().delete()
 
+    def assertNoSequentialScan(self, queryset):
+        """
+        The planner prefers sequential scans on the small tables of the test database:
+        disable them so that the plan falls back to one only when no index can be used.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute("SET enable_seqscan = off")
+            try:
+                plan = queryset.explain()
+            finally:
+                cursor.execute("RESET enable_seqscan")
+        self.assertNotIn("Seq Scan", plan)
+
+    def test_lookups_use_indexes(self):
+        user = JobSeekerFactory()
+        PoleEmploiApprovalFactory(pole_emploi_id=user.pole_emploi_id, birthdate=user.birthdate)
+        # `find_for()`.
+        self.assertNoSequentialScan(PoleEmploiApproval.objects.find_for(user))
+        # `ApprovalsWrapper.for_users()`.
+        self.assertNoSequentialScan(PoleEmploiApproval.objects.filter(pole_emploi_id__in=[user.pole_emploi_id]))
+        # `ApprovalsWrapper._merge_approvals_for_number()`.
+        self.assertNoSequentialScan(
+            PoleEmploiApproval.objects.filter(number__startswith="625741810182", start_at__lte=datetime.date.today())
+        )
+
+    def test_get_import_dates(self):
+        PoleEmploiApprovalImport.objects.create(created_at=timezone.make_aware(datetime.datetime(2020, 2, 23, 10)))
+        PoleEmploiApprovalImport.objects.create(created_at=timezone.make_aware(datetime.datetime(2020, 4, 8, 10)))
+        PoleEmploiApprovalImport.objects.create(created_at=timezone.make_aware(datetime.datetime(2020, 4, 8, 15)))
+        self.assertEqual(
+            PoleEmploiApproval.objects.get_import_dates(), [datetime.date(2020, 2, 23), datetime.date(2020, 4, 8)]
+        )
+
+
+class ImportPoleEmploiApprovalsCommandTest(TestCase):
+    """
+    Test the `import_pe_approvals` management command.
+    """
+
+    HEADER = [
+        "CODE_STRUCT_AFFECT_BENE",
+        "ID_REGIONAL_BENE",
+        "NUM_AGR_DEC",
+        "PRENOM_BENE",
+        "NOM_USAGE_BENE",
+        "NOM_NAISS_BENE",
+        "DATE_NAISS_BENE",
+        "DATE_DEB",
+        "DATE_FIN",
+        "DATE_HISTO",
+    ]
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.file_path = os.path.join(tmp_dir.name, "base_agrements.xlsx")
+
+    def get_row(self, user, number, start_at, end_at):
+        """
+        Helper method returning a row of the file as Pôle emploi sends it.
+        """
+        return [
+            "62010",
+            user.pole_emploi_id,
+            number,
+            "JEAN",
+            "DUPONT",
+            "DUPONT",
+            user.birthdate.strftime("%d/%m/%y"),
+            start_at.strftime("%d/%m/%y"),
+            end_at.strftime("%d/%m/%y"),
+            start_at.strftime("%d/%m/%y"),
+        ]
+
+    def import_rows(self, rows):
+        """
+        Helper method importing an XLSX file made of `rows` and returning the resulting import.
+        """
+        workbook = openpyxl.Workbook(write_only=True)
+        worksheet = workbook.create_sheet()
+        worksheet.append(self.HEADER)
+        for row in rows:
+            worksheet.append(row)
+        workbook.save(self.file_path)
+        call_command("import_pe_approvals", file_path=self.file_path, stdout=io.StringIO(), stderr=io.StringIO())
+        return PoleEmploiApprovalImport.objects.latest("created_at")
+
+    def test_import_file(self):
+        user = JobSeekerFactory()
+        row = [
+            62010,
+            user.pole_emploi_id,
+            "625741810182",
+            "JEAN",
+            'D\'ARTAGNAN, "LE JEUNE"',
+            # Empty strings must not be copied as NULL.
+            None,
+            user.birthdate.strftime("%d/%m/%y"),
+            datetime.datetime(2021, 1, 1),
+            datetime.datetime(2023, 1, 1),
+            "01/01/21",
+        ]
+        rejected_row = [62010, user.pole_emploi_id, "6257418", "JEAN", "DUPONT", "DUPONT", "14/03/68", "", "", ""]
+
+        pe_approval_import = self.import_rows([row, rejected_row])
+
+        self.assertEqual(pe_approval_import.count_inserted, 1)
+        self.assertEqual(pe_approval_import.count_rejected, 1)
+        pe_approval = PoleEmploiApproval.objects.get()
+        self.assertEqual(pe_approval.pe_structure_code, "62010")
+        self.assertEqual(pe_approval.pole_emploi_id, user.pole_emploi_id)
+        self.assertEqual(pe_approval.number, "625741810182")
+        self.assertEqual(pe_approval.first_name, "JEAN")
+        self.assertEqual(pe_approval.last_name, 'D\'ARTAGNAN, "LE JEUNE"')
+        self.assertEqual(pe_approval.birth_name, "")
+        self.assertEqual(pe_approval.birthdate, user.birthdate)
+        self.assertEqual(pe_approval.start_at, datetime.date(2021, 1, 1))
+        self.assertEqual(pe_approval.end_at, datetime.date(2023, 1, 1))
+
+        with open(self.file_path.replace(".xlsx", "_rejected.csv"), newline="") as f:
+            [rejected_row] = csv.DictReader(f)
+        self.assertEqual(rejected_row["NUM_AGR_DEC"], "6257418")
+        self.assertEqual(rejected_row["reason"], "invalid NUM_AGR_DEC")
+
+    def test_clean_chunk(self):
+        command = ImportPoleEmploiApprovalsCommand()
+        rows = [
+            # Numeric cells and dates in the "%d/%m/%y" format with a two-digit year of the previous century.
+            (62010, "1234567A", 625741810182, "JEAN", "DUPONT", "DUPONT", "14/03/68", "01/01/21", "01/01/23", None),
+            # Numeric cell read as a float, date cells and a missing name.
+            (
+                6201.0,
+                "1234567B",
+                "625741810183 ABC",
+                "JEAN",
+                "DUPONT",
+                None,
+                datetime.datetime(1990, 5, 1),
+                datetime.datetime(2021, 1, 1),
+                datetime.datetime(2023, 1, 1),
+                None,
+            ),
+            (None, "1234567C", "625741810184", "JEAN", "DUPONT", "DUPONT", "14/03/68", "01/01/21", "01/01/23", None),
+            (62010, "1234567", "625741810185", "JEAN", "DUPONT", "DUPONT", "14/03/68", "01/01/21", "01/01/23", None),
+            (62010, "1234567E", "6257418", "JEAN", "DUPONT", "DUPONT", "14/03/68", "01/01/21", "01/01/23", None),
+            (
+                62010,
+                "1234567F",
+                "625741810187",
+                "JEAN  LUC",
+                "DUPONT",
+                "DUPONT",
+                "14/03/68",
+                "01/01/21",
+                "01/01/23",
+                None,
+            ),
+            (62010, "1234567G", "625741810188", "JEAN", "DUPONT", "DUPONT", "14/03/68", "31/02/21", "01/01/23", None),
+            # Missing cells at the end of the row.
+            (62010, "1234567H", "625741810189", "JEAN", "DUPONT", "DUPONT", "14/03/68", "01/01/21"),
+        ]
+        [df] = command.iter_chunks(iter(rows), self.HEADER)
+
+        approvals, rejected_rows = command.clean_chunk(df, now=datetime.date(2021, 12, 1))
+
+        self.assertEqual(
+            approvals[["pe_structure_code", "pole_emploi_id", "number", "birth_name"]].values.tolist(),
+            [["62010", "1234567A", "625741810182", "DUPONT"], ["6201", "1234567B", "625741810183ABC", ""]],
+        )
+        self.assertEqual(approvals.birthdate.dt.date.tolist(), [datetime.date(1968, 3, 14), datetime.date(1990, 5, 1)])
+        self.assertEqual(approvals.start_at.dt.date.tolist(), [datetime.date(2021, 1, 1)] * 2)
+        self.assertEqual(approvals.end_at.dt.date.tolist(), [datetime.date(2023, 1, 1)] * 2)
+        self.assertEqual(
+            rejected_rows.reason.tolist(),
+            [
+                "invalid CODE_STRUCT_AFFECT_BENE",
+                "invalid ID_REGIONAL_BENE",
+                "invalid NUM_AGR_DEC",
+                "double spaces in names",
+                "invalid dates",
+                "invalid dates",
+            ],
+        )
+
+    def test_canceled_approvals(self):
+        start_at = timezone.now().date() - relativedelta(years=1)
+        user = JobSeekerFactory()
+        PoleEmploiApprovalFactory(
+            pole_emploi_id=user.pole_emploi_id, birthdate=user.birthdate, number="625741810182", start_at=start_at
+        )
+        other_user = JobSeekerFactory()
+
+        pe_approval_import = self.import_rows(
+            [
+                # Known approval canceled since the previous import.
+                self.get_row(user, "625741810182", start_at, start_at),
+                # Unknown approval already canceled.
+                self.get_row(other_user, "625741810183", start_at, start_at),
+            ]
+        )
+
+        self.assertEqual(pe_approval_import.count_inserted, 0)
+        self.assertEqual(pe_approval_import.count_updated, 0)
+        self.assertEqual(pe_approval_import.count_canceled, 1)
+        self.assertFalse(PoleEmploiApproval.objects.exists())
+        # A canceled approval must not put its holder in a waiting period.
+        for job_seeker in [user, other_user]:
+            with self.subTest(job_seeker=job_seeker):
+                self.assertEqual(ApprovalsWrapper(job_seeker).status, ApprovalsWrapper.NONE_FOUND)
+
+    def test_import_differences(self):
+        start_at = datetime.date(2021, 1, 1)
+        end_at = datetime.date(2023, 1, 1)
+        user, other_user = JobSeekerFactory(), JobSeekerFactory()
+
+        pe_approval_import = self.import_rows(
+            [
+                self.get_row(user, "625741810182", start_at, end_at - relativedelta(months=6)),
+                # The last row of a number found several times is kept.
+                self.get_row(user, "625741810182", start_at, end_at),
+                self.get_row(user, "625741810183", start_at, end_at),
+                self.get_row(other_user, "625741810184", start_at, end_at),
+                # Rejected because of its invalid number.
+                self.get_row(other_user, "6257418", start_at, end_at),
+            ]
+        )
+
+        self.assertEqual(pe_approval_import.file_name, "base_agrements.xlsx")
+        self.assertEqual(pe_approval_import.count_inserted, 3)
+        self.assertEqual(pe_approval_import.count_updated, 0)
+        self.assertEqual(pe_approval_import.count_canceled, 0)
+        self.assertEqual(pe_approval_import.count_rejected, 1)
+        pe_approval = PoleEmploiApproval.objects.get(number="625741810182")
+        self.assertEqual(pe_approval.pole_emploi_id, user.pole_emploi_id)
+        self.assertEqual(pe_approval.birthdate, user.birthdate)
+        self.assertEqual(pe_approval.start_at, start_at)
+        self.assertEqual(pe_approval.end_at, end_at)
+        self.assertEqual(pe_approval.created_at, pe_approval_import.created_at)
+
+        pe_approval_import = self.import_rows(
+            [
+                # The end date changed.
+                self.get_row(user, "625741810182", start_at, end_at + relativedelta(months=6)),
+                # Nothing changed.
+                self.get_row(user, "625741810183", start_at, end_at),
+                # Canceled.
+                self.get_row(other_user, "625741810184", start_at, start_at),
+                # New.
+                self.get_row(other_user, "625741810185", start_at, end_at),
+            ]
+        )
+
+        self.assertEqual(PoleEmploiApprovalImport.objects.count(), 2)
+        self.assertEqual(pe_approval_import.count_inserted, 1)
+        self.assertEqual(pe_approval_import.count_updated, 1)
+        self.assertEqual(pe_approval_import.count_canceled, 1)
+        self.assertEqual(pe_approval_import.count_rejected, 0)
+        self.assertQuerysetEqual(
+            PoleEmploiApproval.objects.order_by("number").values_list("number", "end_at"),
+            [
+                ("625741810182", end_at + relativedelta(months=6)),
+                ("625741810183", end_at),
+                ("625741810185", end_at),
+            ],
+            transform=tuple,
+        )
+
 
 class ApprovalsWrapperTest(TestCase):
     """
@@ -597,6 +872,41 @@ class ApprovalsWrapperTest(TestCase):
         self.assertEqual(approvals_wrapper.merged_approvals[1], pe_approval_2)
         self.assertEqual(approvals_wrapper.merged_approvals[2], approval)
 
+    def test_for_users(self):
+        user_with_approvals = JobSeekerFactory()
+        ApprovalFactory(
+            user=user_with_approvals, start_at=datetime.date(2016, 12, 20), end_at=datetime.date(2018, 12, 20)
+        )
+        PoleEmploiApprovalFactory(
+            pole_emploi_id=user_with_approvals.pole_emploi_id,
+            birthdate=user_with_approvals.birthdate,
+            start_at=datetime.date(2018, 12, 20),
+            end_at=datetime.date(2020, 12, 20),
+        )
+        # Same `pole_emploi_id` but another birthdate: not matched.
+        PoleEmploiApprovalFactory(
+            pole_emploi_id=user_with_approvals.pole_emploi_id,
+            birthdate=user_with_approvals.birthdate - relativedelta(years=1),
+            start_at=datetime.date(2019, 12, 20),
+            end_at=datetime.date(2021, 12, 20),
+        )
+        user_with_valid_approval = JobSeekerFactory()
+        ApprovalFactory(user=user_with_valid_approval)
+        user_without_approval = JobSeekerFactory()
+        prescriber = UserFactory(is_prescriber=True)
+        users = [user_with_approvals, user_with_valid_approval, user_without_approval, prescriber]
+
+        with self.assertNumQueries(2):
+            wrappers = ApprovalsWrapper.for_users(users)
+            for user in users[:3]:
+                self.assertIs(user.approvals_wrapper, wrappers[user.pk])
+
+        self.assertNotIn(prescriber.pk, wrappers)
+        for user in users[:3]:
+            self.assertEqual(wrappers[user.pk].merged_approvals, ApprovalsWrapper(user).merged_approvals)
+        self.assertEqual(len(wrappers[user_with_approvals.pk].merged_approvals), 2)
+        self.assertEqual(wrappers[user_without_approval.pk].merged_approvals, [])
+
     def test_merge_approvals_timeline_case2(self):
 
         user = JobSeekerFactory()
@@ -828,6 +1138,38 @@ class AutomaticApprovalAdminViewsTest(TestCase):
             response, "adminform", "number", [ApprovalAdminForm.ERROR_NUMBER_CANNOT_BE_CHANGED % approval.number]
         )
 
+    def test_export_actions(self):
+        user = UserFactory(is_staff=True)
+        content_type = ContentType.objects.get_for_model(Approval)
+        permission = Permission.objects.get(content_type=content_type, codename="view_approval")
+        user.user_permissions.add(permission)
+        self.client.login(username=user.email, password=DEFAULT_PASSWORD)
+
+        job_app = JobApplicationWithApprovalFactory(state=JobApplicationWorkflow.STATE_ACCEPTED)
+        JobApplicationWithApprovalFactory(state=JobApplicationWorkflow.STATE_ACCEPTED)
+        url = reverse("admin:approvals_approval_changelist")
+        post_data = {"_selected_action": [job_app.approval.pk]}
+
+        # Exports require a dedicated permission.
+        for action in ["export_as_csv", "export_as_xlsx"]:
+            response = self.client.post(url, data={**post_data, "action": action})
+            self.assertFalse(response.has_header("Content-Disposition"))
+
+        permission = Permission.objects.get(content_type=content_type, codename="export_approval")
+        user.user_permissions.add(permission)
+
+        response = self.client.post(url, data={**post_data, "action": "export_as_csv"})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        rows = list(csv.reader(io.StringIO(gzip.decompress(b"".join(response.streaming_content)).decode())))
+        self.assertEqual(rows[0], FIELDS_WS1)
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1][FIELDS_WS1.index("numero_pass_iae")], job_app.approval.number)
+
+        response = self.client.post(url, data={**post_data, "action": "export_as_xlsx"})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(".xlsx", response["Content-Disposition"])
+
 
 class CustomApprovalAdminViewsTest(TestCase):
     """
@@ -1166,6 +1508,10 @@ class ProlongationManagerTest(TestCase):
         expected_duration = datetime.timedelta(days=prolongation1_days + prolongation2_days)
         self.assertEqual(expected_duration, Prolongation.objects.get_cumulative_duration_for(approval))
 
+    def test_get_cumulative_duration_for_no_prolongation(self):
+        approval = ApprovalFactory()
+        self.assertEqual(datetime.timedelta(0), Prolongation.objects.get_cumulative_duration_for(approval))
+
     def test_get_cumulative_duration_for_rqth(self):
         """
         It should return the cumulative duration of all prolongations of the given approval
@@ -1442,6 +1788,12 @@ class ProlongationModelTest(TestCase):
         self.assertTrue(valid_prolongation.get_overlapping_prolongations().exists())
         self.assertTrue(initial_prolongation, valid_prolongation.get_overlapping_prolongations().exists())
 
+        # A prolongation that starts the day initial_prolongation ends, as allowed by
+        # the `exclude_overlapping_prolongations` constraint.
+        valid_prolongation.start_at = initial_prolongation.end_at
+        valid_prolongation.end_at = initial_prolongation.end_at + relativedelta(days=10)
+        self.assertFalse(valid_prolongation.get_overlapping_prolongations().exists())
+
     def test_has_reached_max_cumulative_duration_for_complete_training(self):
 
         approval = ApprovalFactory()
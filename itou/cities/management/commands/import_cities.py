@@ -4,10 +4,12 @@ import os
 
 from django.contrib.gis.geos import GEOSGeometry
 from django.core.management.base import BaseCommand
+from django.db import transaction
 from django.template.defaultfilters import slugify
 
 from itou.cities.models import City
 from itou.common_apps.address.departments import DEPARTMENTS, department_from_postcode
+from itou.utils.models import bulk_upsert
 
 
 CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -58,18 +60,13 @@ class Command(BaseCommand):
 
         self.set_logger(options.get("verbosity"))
 
+        cities = []
+
         with open(CITIES_JSON_FILE, "r") as raw_json_data:
 
             json_data = json.load(raw_json_data)
-            total_len = len(json_data)
-            last_progress = 0
-
-            for i, item in enumerate(json_data):
 
-                progress = int((100 * i) / total_len)
-                if progress > last_progress + 5:
-                    self.stdout.write(f"Creating cities… {progress}%")
-                    last_progress = progress
+            for item in json_data:
 
                 name = item["nom"]
                 post_codes = item["codesPostaux"]
@@ -108,17 +105,28 @@ class Command(BaseCommand):
                 self.logger.debug(department)
                 self.logger.debug(coords)
 
-                if not dry_run:
-                    City.objects.update_or_create(
+                cities.append(
+                    City(
                         slug=slug,
-                        defaults={
-                            "department": department,
-                            "name": name,
-                            "post_codes": post_codes,
-                            "code_insee": code_insee,
-                            "coords": coords,
-                        },
+                        department=department,
+                        name=name,
+                        post_codes=post_codes,
+                        code_insee=code_insee,
+                        coords=coords,
                     )
+                )
+
+        self.stdout.write(f"{len(cities)} cities found.")
+
+        if not dry_run:
+            with transaction.atomic():
+                upserted_codes_insee = bulk_upsert(
+                    City,
+                    cities,
+                    unique_field="code_insee",
+                    update_fields=["slug", "department", "name", "post_codes", "coords"],
+                )
+            self.stdout.write(f"{len(upserted_codes_insee)} cities created or updated.")
 
         self.stdout.write("-" * 80)
         self.stdout.write("Done.")
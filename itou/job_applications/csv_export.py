@@ -1,5 +1,10 @@
 import csv
 
+from django.db.models import Exists, OuterRef
+
+from itou.approvals.models import ApprovalsWrapper
+from itou.eligibility.models import EligibilityDiagnosis
+
 
 JOB_APPLICATION_CSV_HEADERS = [
     "Nom candidat",
@@ -55,9 +60,19 @@ def _get_selected_jobs(job_application):
 
 
 def _get_eligibility_status(job_application):
+    """
+    Same result as `job_seeker.has_valid_diagnosis()` but computed from the annotations
+    of `generate_csv_export` to avoid querying diagnoses for each row.
+    """
     eligibility = "non"
+    approvals_wrapper = job_application.job_seeker.approvals_wrapper
+    if approvals_wrapper.has_valid_pole_emploi_eligibility_diagnosis:
+        eligibility = "oui"
+    # A diagnosis is considered valid for the duration of an approval.
+    elif approvals_wrapper.has_valid and job_application.job_seeker_has_diagnosis:
+        eligibility = "oui"
     # Eligibility diagnoses made by SIAE are ignored.
-    if job_application.job_seeker.has_valid_diagnosis():
+    elif job_application.job_seeker_has_valid_prescriber_diagnosis:
         eligibility = "oui"
 
     return eligibility
@@ -111,7 +126,18 @@ def generate_csv_export(job_applications, stream):
     The stream can be for instance an http response, a string (io.StringIO()) or a file
     """
 
-    rows = [_job_application_as_dict(job_application) for job_application in job_applications.iterator()]
+    diagnoses = EligibilityDiagnosis.objects.filter(job_seeker=OuterRef("job_seeker"))
+    # Not using `iterator()` which would ignore `prefetch_related()`.
+    job_applications = list(
+        job_applications.annotate(
+            job_seeker_has_diagnosis=Exists(diagnoses),
+            job_seeker_has_valid_prescriber_diagnosis=Exists(diagnoses.valid().by_author_kind_prescriber()),
+        )
+    )
+    # Fetch the approvals of all job seekers at once.
+    ApprovalsWrapper.for_users([job_application.job_seeker for job_application in job_applications])
+
+    rows = [_job_application_as_dict(job_application) for job_application in job_applications]
 
     writer = csv.DictWriter(stream, quoting=csv.QUOTE_ALL, fieldnames=JOB_APPLICATION_CSV_HEADERS)
 
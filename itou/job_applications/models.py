@@ -6,7 +6,20 @@ from dateutil.relativedelta import relativedelta
 from django.conf import settings
 from django.core import mail
 from django.db import models
-from django.db.models import BooleanField, Case, Count, Exists, Max, OuterRef, Q, Subquery, When
+from django.db.models import (
+    BooleanField,
+    Case,
+    Count,
+    DurationField,
+    Exists,
+    ExpressionWrapper,
+    F,
+    Max,
+    OuterRef,
+    Q,
+    Subquery,
+    When,
+)
 from django.db.models.functions import Greatest, TruncMonth
 from django.urls import reverse
 from django.utils import timezone
@@ -141,6 +154,33 @@ class JobApplicationQuerySet(models.QuerySet):
     def with_last_change(self):
         return self.annotate(last_change=Greatest("created_at", Max("logs__timestamp")))
 
+    def with_transition_dates(self):
+        """
+        Annotate the date of the latest hiring and the time elapsed between the creation and the latest
+        processing or answer (acceptance or refusal).
+
+        Everything is computed by the database, which avoids prefetching and walking all transition logs.
+        Job applications can go through the same transition more than once, the latest one is used.
+        """
+
+        def latest_log_timestamp(**filters):
+            logs = JobApplicationTransitionLog.objects.filter(job_application=OuterRef("pk"), **filters)
+            return Subquery(logs.order_by("-timestamp").values("timestamp")[:1])
+
+        def time_spent_since_creation(timestamp):
+            return ExpressionWrapper(timestamp - F("created_at"), output_field=DurationField())
+
+        answered_states = [JobApplicationWorkflow.STATE_ACCEPTED, JobApplicationWorkflow.STATE_REFUSED]
+        return self.annotate(
+            hiring_date=latest_log_timestamp(transition=JobApplicationWorkflow.TRANSITION_ACCEPT),
+            time_spent_from_new_to_processing=time_spent_since_creation(
+                latest_log_timestamp(transition=JobApplicationWorkflow.TRANSITION_PROCESS)
+            ),
+            time_spent_from_new_to_accepted_or_refused=time_spent_since_creation(
+                latest_log_timestamp(to_state__in=answered_states)
+            ),
+        )
+
     def with_is_pending_for_too_long(self):
         freshness_limit = timezone.now() - relativedelta(weeks=self.model.WEEKS_BEFORE_CONSIDERED_OLD)
         pending_states = JobApplicationWorkflow.PENDING_STATES
@@ -207,6 +207,22 @@ class JobApplicationQuerySetTest(TestCase):
         last_change = job_app.logs.order_by("-timestamp").first()
         self.assertEqual(qs.last_change, last_change.timestamp)
 
+    def test_with_transition_dates(self):
+        job_app = JobApplicationSentByJobSeekerFactory()
+        qs = JobApplication.objects.with_transition_dates().get(pk=job_app.pk)
+        self.assertIsNone(qs.hiring_date)
+        self.assertIsNone(qs.time_spent_from_new_to_processing)
+        self.assertIsNone(qs.time_spent_from_new_to_accepted_or_refused)
+
+        job_app.process()
+        job_app.accept(user=job_app.to_siae.members.first())
+        qs = JobApplication.objects.with_transition_dates().get(pk=job_app.pk)
+        process_log = job_app.logs.get(transition=JobApplicationWorkflow.TRANSITION_PROCESS)
+        accept_log = job_app.logs.get(transition=JobApplicationWorkflow.TRANSITION_ACCEPT)
+        self.assertEqual(qs.hiring_date, accept_log.timestamp)
+        self.assertEqual(qs.time_spent_from_new_to_processing, process_log.timestamp - job_app.created_at)
+        self.assertEqual(qs.time_spent_from_new_to_accepted_or_refused, accept_log.timestamp - job_app.created_at)
+
     def test_with_is_pending_for_too_long(self):
         freshness_limit = timezone.now() - relativedelta(weeks=JobApplication.WEEKS_BEFORE_CONSIDERED_OLD)
 
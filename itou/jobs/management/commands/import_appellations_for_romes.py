@@ -3,8 +3,10 @@ import logging
 import os
 
 from django.core.management.base import BaseCommand
+from django.db import transaction
 
 from itou.jobs.models import Appellation, Rome
+from itou.utils.models import bulk_upsert
 
 
 CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -47,24 +49,13 @@ class Command(BaseCommand):
 
         self.set_logger(options.get("verbosity"))
 
+        appellations = []
+
         with open(JSON_FILE, "r") as raw_json_data:
 
             json_data = json.load(raw_json_data)
-            total_len = len(json_data)
-            last_progress = 0
-
-            for i, item in enumerate(json_data):
-
-                progress = int((100 * i) / total_len)
-                if progress > last_progress + 5:
-                    self.stdout.write(f"Creating job's appellations… {progress}%")
-                    last_progress = progress
-
-                code_rome = item
-
-                rome = Rome.objects.get(code=code_rome)
 
-                appellations_for_rome = json_data[code_rome]
+            for code_rome, appellations_for_rome in json_data.items():
 
                 self.logger.debug("-" * 80)
                 self.logger.debug(code_rome)
@@ -80,8 +71,26 @@ class Command(BaseCommand):
                     self.logger.debug(code)
                     self.logger.debug(name)
 
-                    if not dry_run:
-                        Appellation.objects.update_or_create(code=code, defaults={"name": name, "rome": rome})
+                    appellations.append(Appellation(code=code, name=name, rome_id=code_rome))
+
+        self.stdout.write(f"{len(appellations)} appellations found.")
+
+        # Fail early rather than on the foreign key constraint.
+        unknown_codes_rome = {a.rome_id for a in appellations} - set(Rome.objects.values_list("code", flat=True))
+        if unknown_codes_rome:
+            raise Rome.DoesNotExist(f"Unknown ROMEs: {sorted(unknown_codes_rome)}, please run import_romes first.")
+
+        if not dry_run:
+            with transaction.atomic():
+                # `full_text` is kept up to date by a trigger (see migrations) fired only on
+                # inserted or updated rows, i.e. once per changed appellation in the whole import.
+                upserted_codes = bulk_upsert(
+                    Appellation,
+                    appellations,
+                    unique_field="code",
+                    update_fields=["name", "rome"],
+                )
+            self.stdout.write(f"{len(upserted_codes)} appellations created or updated.")
 
         self.stdout.write("-" * 80)
         self.stdout.write("Done.")
@@ -3,8 +3,10 @@ import logging
 import os
 
 from django.core.management.base import BaseCommand
+from django.db import transaction
 
 from itou.jobs.models import Rome
+from itou.utils.models import bulk_upsert
 
 
 CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -47,20 +49,15 @@ class Command(BaseCommand):
 
         self.set_logger(options.get("verbosity"))
 
+        romes = []
+
         with open(JSON_FILE, "r") as raw_json_data:
 
             json_data = json.load(raw_json_data)
-            total_len = len(json_data)
-            last_progress = 0
 
             RIASEC_DICT = dict(Rome.RIASEC_CHOICES)
 
-            for i, item in enumerate(json_data):
-
-                progress = int((100 * i) / total_len)
-                if progress > last_progress + 5:
-                    self.stdout.write(f"Creating ROME appellations… {progress}%")
-                    last_progress = progress
+            for item in json_data:
 
                 code = item["code"]
                 name = item["libelle"]
@@ -81,16 +78,27 @@ class Command(BaseCommand):
                 self.logger.debug(RIASEC_DICT[riasec_minor])
                 self.logger.debug(code_isco)
 
-                if not dry_run:
-                    Rome.objects.update_or_create(
+                romes.append(
+                    Rome(
                         code=code,
-                        defaults={
-                            "name": name,
-                            "riasec_major": riasec_major,
-                            "riasec_minor": riasec_minor,
-                            "code_isco": code_isco,
-                        },
+                        name=name,
+                        riasec_major=riasec_major,
+                        riasec_minor=riasec_minor,
+                        code_isco=code_isco,
                     )
+                )
+
+        self.stdout.write(f"{len(romes)} ROMEs found.")
+
+        if not dry_run:
+            with transaction.atomic():
+                upserted_codes = bulk_upsert(
+                    Rome,
+                    romes,
+                    unique_field="code",
+                    update_fields=["name", "riasec_major", "riasec_minor", "code_isco"],
+                )
+            self.stdout.write(f"{len(upserted_codes)} ROMEs created or updated.")
 
         self.stdout.write("-" * 80)
         self.stdout.write("Done.")
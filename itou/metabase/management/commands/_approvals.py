@@ -3,7 +3,11 @@ from datetime import datetime
 from django.conf import settings
 
 from itou.approvals.models import Approval, PoleEmploiApproval
-from itou.metabase.management.commands._utils import get_department_and_region_columns, get_hiring_siae
+from itou.metabase.management.commands._utils import (
+    cached_per_object,
+    get_department_and_region_columns,
+    get_hiring_siae,
+)
 from itou.prescribers.models import PrescriberOrganization
 
 
@@ -17,6 +21,7 @@ CODE_SAFIR_TO_PE_ORG = {
 }
 
 
+@cached_per_object
 def get_siae_from_approval(approval):
     if isinstance(approval, PoleEmploiApproval):
         return None
@@ -29,6 +34,7 @@ def get_siae_from_approval(approval):
     return get_hiring_siae(approval.user)
 
 
+@cached_per_object
 def get_siae_or_pe_org_from_approval(approval):
     if isinstance(approval, Approval):
         return get_siae_from_approval(approval)
@@ -95,3 +101,6 @@ TABLE_COLUMNS += get_department_and_region_columns(
     comment_suffix=(" de la structure qui a embauché si PASS IAE ou du PE qui a délivré l agrément si Agrément PE"),
     custom_fn=get_siae_or_pe_org_from_approval,
 )
+
+# Columns metabase dashboards filter or join on, indexed once the table is loaded.
+TABLE_INDEXES = [["id_structure"], ["type_structure"], ["département_structure_ou_org_pe"], ["date_début"]]
@@ -1,5 +1,9 @@
+import datetime
+import io
+
 import psycopg2
 from django.conf import settings
+from psycopg2 import sql
 
 
 class MetabaseDatabaseCursor:
@@ -27,3 +31,73 @@ class MetabaseDatabaseCursor:
             self.cursor.close()
         if self.connection:
             self.connection.close()
+
+
+# Characters which have a special meaning in the text format of `COPY`.
+# See https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.2
+COPY_ESCAPED_CHARACTERS = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def format_copy_value(value):
+    """
+    Serialize a python value as expected by the text format of `COPY`.
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, datetime.timedelta):
+        # `str(timedelta)` outputs e.g. "2 days, 1:00:00" which PostgreSQL does not understand.
+        return f"{value.days} days {value.seconds} seconds {value.microseconds} microseconds"
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return str(value).translate(COPY_ESCAPED_CHARACTERS)
+
+
+class MetabaseCopyWriter:
+    """
+    Stream rows into a table through `COPY ... FROM STDIN`.
+
+    Rows are serialized into an in-memory buffer which is sent to the database
+    and committed as soon as it grows bigger than `buffer_size` bytes,
+    so that the metabase db stays available throughout the script.
+
+    Usage:
+
+        with MetabaseDatabaseCursor() as (cur, conn):
+            with MetabaseCopyWriter(cur, conn, table_name="z_new_foo", column_names=["a", "b"]) as writer:
+                writer.write_row([1, "bar"])
+    """
+
+    def __init__(self, cur, conn, table_name, column_names, buffer_size=None):
+        self.cur = cur
+        self.conn = conn
+        self.buffer_size = buffer_size or settings.METABASE_COPY_BUFFER_SIZE
+        self.buffer = io.StringIO()
+        self.rows_in_buffer = 0
+        self.copy_query = sql.SQL("COPY {table_name} ({fields}) FROM STDIN").format(
+            table_name=sql.Identifier(table_name),
+            fields=sql.SQL(",").join([sql.Identifier(name) for name in column_names]),
+        )
+
+    def write_row(self, values):
+        self.buffer.write("\t".join([format_copy_value(value) for value in values]))
+        self.buffer.write("\n")
+        self.rows_in_buffer += 1
+        if self.buffer.tell() >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows_in_buffer == 0:
+            return
+        self.buffer.seek(0)
+        self.cur.copy_expert(self.copy_query.as_string(self.conn), self.buffer)
+        self.conn.commit()
+        self.buffer = io.StringIO()
+        self.rows_in_buffer = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        # Do not send a partial buffer when something went wrong, the whole table will be dropped anyway.
+        if exc_type is None:
+            self.flush()
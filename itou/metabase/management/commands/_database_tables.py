@@ -1,9 +1,14 @@
 """
 Helper methods for manipulating tables used by both populate_metabase_itou and populate_metabase_fluxiae scripts.
 """
+import hashlib
+import json
+
+from django.conf import settings
 from psycopg2 import sql
+from tqdm import tqdm
 
-from itou.metabase.management.commands._database_psycopg2 import MetabaseDatabaseCursor
+from itou.metabase.management.commands._database_psycopg2 import MetabaseCopyWriter, MetabaseDatabaseCursor
 
 
 def get_new_table_name(table_name):
@@ -27,6 +32,37 @@ def get_dry_table_name(table_name):
     return f"z_dry_{table_name}"
 
 
+def get_create_table_sql():
+    """
+    New tables can be built as UNLOGGED tables: they are much faster to load as they skip the write-ahead log,
+    and are set back to LOGGED by `finalize_new_table` just before they are switched.
+    """
+    if settings.METABASE_UNLOGGED_NEW_TABLES:
+        return sql.SQL("CREATE UNLOGGED TABLE")
+    return sql.SQL("CREATE TABLE")
+
+
+def finalize_new_table(cur, table_name, indexes=None):
+    """
+    Prepare the new version of a table to be queried by metabase users, before it is switched:
+    make it LOGGED, build its indexes then gather its statistics for the query planner.
+
+    `indexes` is a list of indexes, each index being a list of column names.
+    """
+    new_table_name = get_new_table_name(table_name)
+    if settings.METABASE_UNLOGGED_NEW_TABLES:
+        cur.execute(sql.SQL("ALTER TABLE {} SET LOGGED").format(sql.Identifier(new_table_name)))
+    for columns in indexes or []:
+        # Let PostgreSQL name the index: names must be unique in the whole database
+        # and the previous version of the table still has its own indexes.
+        cur.execute(
+            sql.SQL("CREATE INDEX ON {} ({})").format(
+                sql.Identifier(new_table_name), sql.SQL(",").join([sql.Identifier(c) for c in columns])
+            )
+        )
+    cur.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(new_table_name)))
+
+
 def switch_table_atomically(table_name):
     with MetabaseDatabaseCursor() as (cur, conn):
         cur.execute(
@@ -46,3 +82,258 @@ def switch_table_atomically(table_name):
         # Dry run tables are periodically dropped by wet runs.
         cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(get_dry_table_name(table_name))))
         conn.commit()
+
+
+# Metadata table storing, for each table populated by populate_metabase_itou, the columns spec it was built with
+# and the date of its last extraction. It is used by the incremental mode.
+SYNC_STATE_TABLE_NAME = "z_sync_state"
+
+
+def get_columns_hash(table_columns):
+    """
+    Fingerprint of a table structure: any change of column name, type or comment changes it.
+    """
+    spec = [[c["name"], c["type"], c["comment"]] for c in table_columns]
+    return hashlib.sha256(json.dumps(spec).encode()).hexdigest()
+
+
+def does_table_exist(cur, table_name):
+    cur.execute("SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = %s)", [table_name])
+    return cur.fetchone()[0]
+
+
+def create_sync_state_table(cur):
+    cur.execute(
+        sql.SQL(
+            "CREATE TABLE IF NOT EXISTS {} "
+            "(table_name varchar PRIMARY KEY, columns_hash varchar, high_water_mark timestamptz)"
+        ).format(sql.Identifier(SYNC_STATE_TABLE_NAME))
+    )
+
+
+def get_sync_state(cur, table_name):
+    """
+    Return a `(columns_hash, high_water_mark)` tuple, or None if the table has never been synced.
+    """
+    create_sync_state_table(cur)
+    cur.execute(
+        sql.SQL("SELECT columns_hash, high_water_mark FROM {} WHERE table_name = %s").format(
+            sql.Identifier(SYNC_STATE_TABLE_NAME)
+        ),
+        [table_name],
+    )
+    return cur.fetchone()
+
+
+def set_sync_state(cur, table_name, columns_hash, high_water_mark):
+    create_sync_state_table(cur)
+    cur.execute(
+        sql.SQL(
+            "INSERT INTO {} (table_name, columns_hash, high_water_mark) VALUES (%s, %s, %s) "
+            "ON CONFLICT (table_name) DO UPDATE "
+            "SET columns_hash = EXCLUDED.columns_hash, high_water_mark = EXCLUDED.high_water_mark"
+        ).format(sql.Identifier(SYNC_STATE_TABLE_NAME)),
+        [table_name, columns_hash, high_water_mark],
+    )
+
+
+def get_table_versions(cur, table_names):
+    """
+    Return a `{table_name: version}` dict for those of the given names which are existing tables.
+
+    A table gets a new version each time it is rebuilt, since the new table replacing it has a new oid,
+    and each time it is updated in place by the incremental mode of populate_metabase_itou.
+    """
+    create_sync_state_table(cur)
+    cur.execute(
+        sql.SQL(
+            "SELECT c.relname, c.oid::text || ':' || coalesce(s.high_water_mark::text, '') FROM pg_class c "
+            "LEFT JOIN {} s ON s.table_name = c.relname "
+            "WHERE c.relname = ANY(%s) AND c.relkind = 'r' AND pg_table_is_visible(c.oid)"
+        ).format(sql.Identifier(SYNC_STATE_TABLE_NAME)),
+        [sorted(table_names)],
+    )
+    return dict(cur.fetchall())
+
+
+# Metadata table storing, for each custom table built by `build_custom_tables`, the hash of its SQL request
+# and the versions of the tables it was built from. It is used to skip the tables which would not change.
+CUSTOM_TABLES_STATE_TABLE_NAME = "z_custom_tables_state"
+
+
+def create_custom_tables_state_table(cur):
+    cur.execute(
+        sql.SQL(
+            "CREATE TABLE IF NOT EXISTS {} (table_name varchar PRIMARY KEY, sql_hash varchar, upstream_versions text)"
+        ).format(sql.Identifier(CUSTOM_TABLES_STATE_TABLE_NAME))
+    )
+
+
+def get_custom_table_state(cur, table_name):
+    """
+    Return a `(sql_hash, upstream_versions)` tuple, or None if the table has never been built.
+    """
+    create_custom_tables_state_table(cur)
+    cur.execute(
+        sql.SQL("SELECT sql_hash, upstream_versions FROM {} WHERE table_name = %s").format(
+            sql.Identifier(CUSTOM_TABLES_STATE_TABLE_NAME)
+        ),
+        [table_name],
+    )
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return row[0], json.loads(row[1])
+
+
+def set_custom_table_state(cur, table_name, sql_hash, upstream_versions):
+    create_custom_tables_state_table(cur)
+    cur.execute(
+        sql.SQL(
+            "INSERT INTO {} (table_name, sql_hash, upstream_versions) VALUES (%s, %s, %s) "
+            "ON CONFLICT (table_name) DO UPDATE "
+            "SET sql_hash = EXCLUDED.sql_hash, upstream_versions = EXCLUDED.upstream_versions"
+        ).format(sql.Identifier(CUSTOM_TABLES_STATE_TABLE_NAME)),
+        [table_name, sql_hash, json.dumps(upstream_versions, sort_keys=True)],
+    )
+
+
+# Metadata table storing the steps completed by populate_metabase_fluxiae: which table was built from which
+# source file, with how many rows. It is used by the `--resume` option.
+RUN_MANIFEST_TABLE_NAME = "z_run_manifest"
+
+
+def create_run_manifest_table(cur):
+    cur.execute(
+        sql.SQL(
+            "CREATE TABLE IF NOT EXISTS {} (step varchar PRIMARY KEY, source_filename varchar, source_size bigint, "
+            "nrows bigint, completed_at timestamptz)"
+        ).format(sql.Identifier(RUN_MANIFEST_TABLE_NAME))
+    )
+
+
+def get_run_manifest(cur):
+    """
+    Return a `{step: (source_filename, source_size)}` dict of all the completed steps.
+    """
+    create_run_manifest_table(cur)
+    cur.execute(
+        sql.SQL("SELECT step, source_filename, source_size FROM {}").format(sql.Identifier(RUN_MANIFEST_TABLE_NAME))
+    )
+    return {step: (source_filename, source_size) for step, source_filename, source_size in cur.fetchall()}
+
+
+def set_run_manifest_step(cur, step, source_filename, source_size, nrows):
+    create_run_manifest_table(cur)
+    cur.execute(
+        sql.SQL(
+            "INSERT INTO {} (step, source_filename, source_size, nrows, completed_at) VALUES (%s, %s, %s, %s, now()) "
+            "ON CONFLICT (step) DO UPDATE SET source_filename = EXCLUDED.source_filename, "
+            "source_size = EXCLUDED.source_size, nrows = EXCLUDED.nrows, completed_at = EXCLUDED.completed_at"
+        ).format(sql.Identifier(RUN_MANIFEST_TABLE_NAME)),
+        [step, source_filename, source_size, nrows],
+    )
+
+
+# Values matching these patterns are stored as numbers, like pandas does when reading CSV files.
+# Integers are limited to 18 digits to always fit in a bigint.
+INTEGER_PATTERN = r"^-?[0-9]{1,18}$"
+FLOAT_PATTERN = r"^-?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?$"
+
+
+def convert_text_columns(cur, table_name, column_names):
+    """
+    Convert text columns into bigint or double precision columns when all their values allow it.
+    Types are detected in a single scan and all columns are converted with a single table rewrite.
+    """
+    checks = []
+    for column_name in column_names:
+        for pattern in [INTEGER_PATTERN, FLOAT_PATTERN]:
+            checks.append(
+                sql.SQL("bool_and({column_name} ~ {pattern})").format(
+                    column_name=sql.Identifier(column_name), pattern=sql.Literal(pattern)
+                )
+            )
+    cur.execute(sql.SQL("SELECT {} FROM {}").format(sql.SQL(",").join(checks), sql.Identifier(table_name)))
+    results = cur.fetchone()
+
+    alterations = []
+    for i, column_name in enumerate(column_names):
+        is_integer, is_float = results[2 * i], results[2 * i + 1]
+        if is_integer:
+            column_type = "bigint"
+        elif is_float or is_float is None:
+            # Columns without any value are float columns for pandas.
+            column_type = "double precision"
+        else:
+            continue
+        alterations.append(
+            sql.SQL("ALTER COLUMN {column_name} TYPE {column_type} USING {column_name}::{column_type}").format(
+                column_name=sql.Identifier(column_name), column_type=sql.SQL(column_type)
+            )
+        )
+
+    if alterations:
+        cur.execute(sql.SQL("ALTER TABLE {} {}").format(sql.Identifier(table_name), sql.SQL(",").join(alterations)))
+
+
+def store_rows(get_rows, table_name, dry_run, indexes=None, max_attempts=5):
+    """
+    Stream rows into database with `COPY`, with a bounded memory use whatever the number of rows.
+
+    `get_rows` should return an iterator whose first item is the list of column names, and next items the rows.
+    It is called again on each new attempt so that transient disconnections do not break the whole script.
+
+    All columns are loaded as text then converted into numbers when possible.
+    Return the number of rows stored.
+    """
+    if dry_run:
+        table_name = get_dry_table_name(table_name)
+    new_table_name = get_new_table_name(table_name)
+
+    print(f"Streaming {table_name} into database ...")
+
+    attempts = 0
+
+    while attempts < max_attempts:
+        try:
+            with MetabaseDatabaseCursor() as (cur, conn):
+                rows = get_rows()
+                column_names = next(rows)
+
+                cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(new_table_name)))
+                cur.execute(
+                    sql.SQL("{create_table} {new_table_name} ({fields_with_type})").format(
+                        create_table=get_create_table_sql(),
+                        new_table_name=sql.Identifier(new_table_name),
+                        fields_with_type=sql.SQL(",").join(
+                            [sql.SQL("{} text").format(sql.Identifier(name)) for name in column_names]
+                        ),
+                    )
+                )
+                conn.commit()
+
+                nrows = 0
+                with MetabaseCopyWriter(cur, conn, table_name=new_table_name, column_names=column_names) as writer:
+                    for row in tqdm(rows):
+                        writer.write_row(row)
+                        nrows += 1
+
+                convert_text_columns(cur, table_name=new_table_name, column_names=column_names)
+                conn.commit()
+                finalize_new_table(cur, table_name=table_name, indexes=indexes)
+                conn.commit()
+            break
+        except Exception as e:
+            # Catching all exceptions is a generally a code smell but we eventually reraise it so it's ok.
+            attempts += 1
+            print(f"Attempt #{attempts} failed with exception {repr(e)}.")
+            if attempts == max_attempts:
+                print("No more attemps left, giving up and raising the exception.")
+                raise
+            print("New attempt started...")
+
+    switch_table_atomically(table_name=table_name)
+    print(f"Stored {table_name} in database ({nrows} rows).")
+    print("")
+    return nrows
@@ -5,15 +5,17 @@ Helper methods for manipulating dataframes used by both populate_metabase_itou a
 import pandas as pd
 from tqdm import tqdm
 
+from itou.metabase.management.commands._database_psycopg2 import MetabaseDatabaseCursor
 from itou.metabase.management.commands._database_sqlalchemy import get_pg_engine
 from itou.metabase.management.commands._database_tables import (
+    finalize_new_table,
     get_dry_table_name,
     get_new_table_name,
     switch_table_atomically,
 )
 
 
-def store_df(df, table_name, dry_run, max_attempts=5):
+def store_df(df, table_name, dry_run, indexes=None, max_attempts=5):
     """
     Store dataframe in database.
 
@@ -61,6 +63,10 @@ def store_df(df, table_name, dry_run, max_attempts=5):
                 raise
             print("New attempt started...")
 
+    with MetabaseDatabaseCursor() as (cur, conn):
+        finalize_new_table(cur, table_name=table_name, indexes=indexes)
+        conn.commit()
+
     switch_table_atomically(table_name=table_name)
     print(f"Stored {table_name} in database ({len(df)} rows).")
     print("")
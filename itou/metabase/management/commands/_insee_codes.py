@@ -24,3 +24,6 @@ TABLE_COLUMNS = [
         "fn": lambda o: o.longitude,
     },
 ]
+
+# Columns metabase dashboards filter or join on, indexed once the table is loaded.
+TABLE_INDEXES = [["code_insee"]]
@@ -1,3 +1,5 @@
+from django.db.models import Q
+
 from itou.job_applications.models import JobApplication, JobApplicationWorkflow
 from itou.metabase.management.commands._utils import anonymize, get_choice, get_department_and_region_columns
 
@@ -57,46 +59,18 @@ def get_ja_sender_organization_safir(ja):
     return None
 
 
-def _get_ja_time_spent_in_transition(ja, logs):
-    # Some job applications have duplicate transitions.
-    # E.g. job application id:4db81292-ff51-4950-a8dc-cf7c9f94c67e
-    # has 2 almost identical "refuse" transitions.
-    # In which case we consider any of the duplicates.
-    if len(logs) >= 1:
-        new_timestamp = ja.created_at
-        transition_timestamp = logs[0].timestamp
-        assert transition_timestamp > new_timestamp
-        time_spent_in_transition = transition_timestamp - new_timestamp
-        return time_spent_in_transition
-    return None
-
-
-def get_ja_time_spent_from_new_to_processing(ja):
-    # Find the new=>processing transition log.
-    # We have to do all this in python to benefit from prefetch_related.
-    logs = [log for log in ja.logs.all() if log.transition == JobApplicationWorkflow.TRANSITION_PROCESS]
-    return _get_ja_time_spent_in_transition(ja, logs)
-
-
-def get_ja_time_spent_from_new_to_accepted_or_refused(ja):
-    # Find the *=>accepted or *=>refused transition log.
-    # We have to do all this in python to benefit from prefetch_related.
-    logs = [
-        log
-        for log in ja.logs.all()
-        if log.to_state in [JobApplicationWorkflow.STATE_ACCEPTED, JobApplicationWorkflow.STATE_REFUSED]
-    ]
-    return _get_ja_time_spent_in_transition(ja, logs)
-
-
-def get_ja_hiring_date(ja):
-    # We have to do all this in python to benefit from prefetch_related.
-    logs = [log for log in ja.logs.all() if log.transition == JobApplicationWorkflow.TRANSITION_ACCEPT]
-    # Job applications can be accepted more than once (e.g. 401b0ee1-d977-4338-b436-77839a9ed12c).
-    if len(logs) >= 1:
-        transition_timestamp = logs[0].timestamp
-        return transition_timestamp
-    return None
+def get_changed_job_applications_filter(since):
+    """
+    Match job applications whose row might have changed since given date,
+    either by themselves or through their transitions, their siae or their sender organization.
+    """
+    return (
+        Q(created_at__gte=since)
+        | Q(updated_at__gte=since)
+        | Q(logs__timestamp__gte=since)
+        | Q(to_siae__updated_at__gte=since)
+        | Q(sender_prescriber_organization__updated_at__gte=since)
+    )
 
 
 TABLE_COLUMNS = [
@@ -138,7 +112,8 @@ TABLE_COLUMNS = [
         "comment": (
             "Temps écoulé rétroactivement de état nouveau à état étude" " si la candidature est passée par ces états"
         ),
-        "fn": get_ja_time_spent_from_new_to_processing,
+        # Annotated by `JobApplicationQuerySet.with_transition_dates`.
+        "fn": lambda o: o.time_spent_from_new_to_processing,
     },
     {
         "name": "délai_de_réponse",
@@ -147,7 +122,8 @@ TABLE_COLUMNS = [
             "Temps écoulé rétroactivement de état nouveau à état accepté"
             " ou refusé si la candidature est passée par ces états"
         ),
-        "fn": get_ja_time_spent_from_new_to_accepted_or_refused,
+        # Annotated by `JobApplicationQuerySet.with_transition_dates`.
+        "fn": lambda o: o.time_spent_from_new_to_accepted_or_refused,
     },
     {
         "name": "motif_de_refus",
@@ -204,6 +180,20 @@ TABLE_COLUMNS += [
         "name": "date_embauche",
         "type": "date",
         "comment": "Date embauche le cas échéant",
-        "fn": get_ja_hiring_date,
+        # Annotated by `JobApplicationQuerySet.with_transition_dates`.
+        "fn": lambda o: o.hiring_date,
     },
 ]
+
+# Used by the incremental mode of populate_metabase_itou.
+INCREMENTAL_SPEC = {"key": "id_anonymisé", "changed_since": get_changed_job_applications_filter}
+
+# Columns metabase dashboards filter or join on, indexed once the table is loaded.
+TABLE_INDEXES = [
+    ["id_anonymisé"],
+    ["id_candidat_anonymisé"],
+    ["id_structure"],
+    ["type_structure"],
+    ["département_structure"],
+    ["date_candidature"],
+]
@@ -58,3 +58,6 @@ TABLE_COLUMNS += [
         "fn": lambda o: o.updated_at,
     },
 ]
+
+# Columns metabase dashboards filter or join on, indexed once the table is loaded.
+TABLE_INDEXES = [["id_employeur"], ["code_rome"], ["département_employeur"]]
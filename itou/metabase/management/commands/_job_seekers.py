@@ -2,12 +2,14 @@ from datetime import date, timedelta
 from functools import partial
 from operator import attrgetter
 
+from django.db.models import Q
 from django.utils import timezone
 
 from itou.eligibility.models import AdministrativeCriteria, EligibilityDiagnosis
 from itou.job_applications.models import JobApplicationWorkflow
 from itou.metabase.management.commands._utils import (
     anonymize,
+    cached_per_object,
     get_choice,
     get_department_and_region_columns,
     get_hiring_siae,
@@ -38,11 +40,27 @@ def get_user_signup_kind(user):
     raise ValueError("Unexpected job seeker creator kind")
 
 
+@cached_per_object
 def get_latest_diagnosis(job_seeker):
     assert job_seeker.is_job_seeker
-    if job_seeker.eligibility_diagnoses.count() == 0:
-        return None
-    return max(job_seeker.eligibility_diagnoses.all(), key=attrgetter("created_at"))
+    return max(job_seeker.eligibility_diagnoses.all(), key=attrgetter("created_at"), default=None)
+
+
+@cached_per_object
+def _get_latest_diagnosis_criteria_list(job_seeker):
+    latest_diagnosis = get_latest_diagnosis(job_seeker)
+    if latest_diagnosis:
+        # We have to do all this in python to benefit from prefetch_related.
+        return list(latest_diagnosis.administrative_criteria.all())
+    return None
+
+
+@cached_per_object
+def _get_latest_diagnosis_criteria_ids(job_seeker):
+    criteria_list = _get_latest_diagnosis_criteria_list(job_seeker)
+    if criteria_list is not None:
+        return {ac.id for ac in criteria_list}
+    return None
 
 
 def get_latest_diagnosis_author_sub_kind(job_seeker):
@@ -76,10 +94,9 @@ def _get_latest_diagnosis_criteria_by_level(job_seeker, level):
     Count criteria of given level for the latest diagnosis of
     given job seeker.
     """
-    latest_diagnosis = get_latest_diagnosis(job_seeker)
-    if latest_diagnosis:
-        # We have to do all this in python to benefit from prefetch_related.
-        return len([ac for ac in latest_diagnosis.administrative_criteria.all() if ac.level == level])
+    criteria_list = _get_latest_diagnosis_criteria_list(job_seeker)
+    if criteria_list is not None:
+        return len([ac for ac in criteria_list if ac.level == level])
     return None
 
 
@@ -98,10 +115,9 @@ def get_latest_diagnosis_criteria(job_seeker, criteria_id):
 
     Return 1 if present, 0 if absent and None if there is no diagnosis.
     """
-    latest_diagnosis = get_latest_diagnosis(job_seeker)
-    if latest_diagnosis:
-        # We have to do all this in python to benefit from prefetch_related.
-        return len([ac for ac in latest_diagnosis.administrative_criteria.all() if ac.id == criteria_id])
+    criteria_ids = _get_latest_diagnosis_criteria_ids(job_seeker)
+    if criteria_ids is not None:
+        return int(criteria_id in criteria_ids)
     return None
 
 
@@ -125,6 +141,30 @@ def format_criteria_name_as_column_name(criteria):
     return f"critère_n{criteria.level}_{column_name}"
 
 
+def get_changed_job_seekers_filter(since):
+    """
+    Match job seekers whose row might have changed since given date.
+
+    Users have no modification date, thus changes made to the job seeker profile
+    itself (address, PE id...) are only caught by a full rebuild.
+    """
+    now = timezone.now()
+    if since.year != now.year:
+        # Every age changes on new year's day.
+        return Q()
+    return (
+        Q(date_joined__gte=since)
+        | Q(last_login__gte=since)
+        # `actif` becomes false 7 days after the last login.
+        | Q(last_login__gte=since + timedelta(days=-7), last_login__lt=now + timedelta(days=-7))
+        | Q(socialaccount__date_joined__gte=since)
+        | Q(job_applications__created_at__gte=since)
+        | Q(job_applications__updated_at__gte=since)
+        | Q(eligibility_diagnoses__created_at__gte=since)
+        | Q(eligibility_diagnoses__updated_at__gte=since)
+    )
+
+
 TABLE_COLUMNS = [
     {
         "name": "id_anonymisé",
@@ -249,3 +289,10 @@ for criteria in AdministrativeCriteria.objects.order_by("id").all():
             "fn": partial(get_latest_diagnosis_criteria, criteria_id=criteria.id),
         }
     ]
+
+
+# Used by the incremental mode of populate_metabase_itou.
+INCREMENTAL_SPEC = {"key": "id_anonymisé", "changed_since": get_changed_job_seekers_filter}
+
+# Columns metabase dashboards filter or join on, indexed once the table is loaded.
+TABLE_INDEXES = [["id_anonymisé"], ["département"], ["date_inscription"]]
@@ -152,3 +152,6 @@ TABLE_COLUMNS += [
         "fn": lambda o: o.is_brsa,
     },
 ]
+
+# Columns metabase dashboards filter or join on, indexed once the table is loaded.
+TABLE_INDEXES = [["id"], ["type"], ["département"]]
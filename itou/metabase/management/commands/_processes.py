@@ -0,0 +1,50 @@
+"""
+Helper running populate_metabase_itou steps concurrently in forked processes.
+"""
+import multiprocessing
+from multiprocessing.connection import wait
+
+from django.db import connections
+
+
+def run_in_processes(tasks, max_workers):
+    """
+    Run `(name, callable)` tasks, each one in its own forked process, with at most `max_workers` processes at a time.
+
+    Forking a new process per task lets tasks be any callable (bound methods, partials, querysets...)
+    without having to pickle them, and each process opens its own database connections.
+
+    All tasks are run even if some of them fail, and an exception is raised at the end if any did.
+    Without concurrency, tasks are simply run one after another in the current process.
+    """
+    if max_workers <= 1:
+        for _, task in tasks:
+            task()
+        return
+
+    context = multiprocessing.get_context("fork")
+    pending = list(tasks)
+    running = []
+    failed_names = []
+
+    while pending or running:
+        while pending and len(running) < max_workers:
+            name, task = pending.pop(0)
+            # Connections must never be shared between processes. Closing ours before forking
+            # makes the child process open its own connection on its first query.
+            connections.close_all()
+            process = context.Process(target=task, name=name)
+            process.start()
+            running.append(process)
+
+        wait([process.sentinel for process in running])
+
+        for process in [process for process in running if not process.is_alive()]:
+            process.join()
+            running.remove(process)
+            if process.exitcode != 0:
+                print(f"Process {process.name} failed with exit code {process.exitcode}.")
+                failed_names.append(process.name)
+
+    if failed_names:
+        raise RuntimeError(f"{len(failed_names)} process(es) failed: {', '.join(failed_names)}")
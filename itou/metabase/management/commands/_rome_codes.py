@@ -12,3 +12,6 @@ TABLE_COLUMNS = [
         "fn": lambda o: o.name,
     },
 ]
+
+# Columns metabase dashboards filter or join on, indexed once the table is loaded.
+TABLE_INDEXES = [["code_rome"]]
@@ -2,6 +2,7 @@ from django.utils import timezone
 
 from itou.job_applications.models import JobApplication, JobApplicationWorkflow
 from itou.metabase.management.commands._utils import (
+    cached_per_object,
     get_address_columns,
     get_choice,
     get_establishment_is_active_column,
@@ -29,10 +30,12 @@ def get_siae_last_ja_transition_date(siae):
     return max(timestamps, default=None)
 
 
+@cached_per_object
 def get_siae_last_month_job_applications(siae):
     return [ja for ja in siae.job_applications_received.all() if ja.created_at > ONE_MONTH_AGO]
 
 
+@cached_per_object
 def get_siae_last_month_hirings(siae):
     return [
         ja
@@ -199,3 +202,6 @@ TABLE_COLUMNS += [
     {"name": "longitude", "type": "float", "comment": "Longitude", "fn": lambda o: o.longitude},
     {"name": "latitude", "type": "float", "comment": "Latitude", "fn": lambda o: o.latitude},
 ]
+
+# Columns metabase dashboards filter or join on, indexed once the table is loaded.
+TABLE_INDEXES = [["id"], ["type"], ["département"]]
@@ -1,4 +1,7 @@
+import hashlib
 import os
+import re
+from functools import partial, wraps
 from operator import attrgetter
 
 from django.conf import settings
@@ -10,14 +13,34 @@ from itou.common_apps.address.departments import DEPARTMENT_TO_REGION, DEPARTMEN
 from itou.job_applications.models import JobApplicationWorkflow
 from itou.metabase.management.commands._database_psycopg2 import MetabaseDatabaseCursor
 from itou.metabase.management.commands._database_tables import (
+    does_table_exist,
+    finalize_new_table,
+    get_create_table_sql,
+    get_custom_table_state,
     get_dry_table_name,
     get_new_table_name,
+    get_table_versions,
+    set_custom_table_state,
     switch_table_atomically,
 )
+from itou.metabase.management.commands._processes import run_in_processes
 
 
 CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
 
+# Custom SQL tables declare their indexes with one such line per index, e.g. `-- index: af_id_structure, type_siae`.
+SQL_INDEX_DIRECTIVE_REGEX = re.compile(r"^--\s*index:(.+)$", re.MULTILINE)
+
+SQL_COMMENT_REGEX = re.compile(r"--.*$", re.MULTILINE)
+# Names following a `from` or a `join`: tables, but also common table expressions
+# and a few false positives such as `extract(year from current_date)`.
+SQL_TABLE_REFERENCE_REGEX = re.compile(r'\b(?:from|join)\s+("[^"]+"|[a-z_]\w*)', re.IGNORECASE)
+SQL_CTE_NAME_REGEX = re.compile(r'("[^"]+"|[a-z_]\w*)\s+as\s*\(', re.IGNORECASE)
+# Results of requests using the current date or time change every day even if their tables don't.
+SQL_CURRENT_TIME_REGEX = re.compile(
+    r"\b(?:current_date|current_timestamp|current_time|localtimestamp|localtime|now\s*\(\))", re.IGNORECASE
+)
+
 
 def convert_boolean_to_int(b):
     # True => 1, False => 0, None => None.
@@ -33,6 +56,28 @@ def compose(f, g):
     return lambda *a, **kw: f(g(*a, **kw))
 
 
+def cached_per_object(fn):
+    """
+    Memoize a method taking a single object as argument, typically a value derived from the object
+    and needed by several columns of its row (latest diagnosis, hiring siae...).
+
+    Results are stored on the object itself, thus they are computed once per row
+    and released along with the object.
+    """
+
+    # Functions of different modules may share the same name.
+    cache_key = f"{fn.__module__}.{fn.__qualname__}"
+
+    @wraps(fn)
+    def wrapper(o):
+        cache = o.__dict__.setdefault("_metabase_cache", {})
+        if cache_key not in cache:
+            cache[cache_key] = fn(o)
+        return cache[cache_key]
+
+    return wrapper
+
+
 def get_choice(choices, key):
     choices = dict(choices)
     # Gettext fixes `can't adapt type '__proxy__'` error
@@ -71,6 +116,7 @@ def get_first_membership_join_date(memberships):
     return None
 
 
+@cached_per_object
 def get_hiring_siae(job_seeker):
     """
     Ideally the job_seeker would have a unique hiring so that we can
@@ -191,48 +237,161 @@ def chunked_queryset(queryset, chunk_size=10000):
     yield queryset.filter(pk__gte=start_pk)
 
 
+def split_queryset(queryset, parts):
+    """
+    Split a queryset into at most `parts` querysets of similar sizes covering distinct primary key ranges.
+    """
+    pks = queryset.order_by("pk").values_list("pk", flat=True)
+    count = pks.count()
+    boundaries = sorted(set([pks[count * i // parts] for i in range(1, parts)])) if count >= parts else []
+    if not boundaries:
+        return [queryset]
+    querysets = [queryset.filter(pk__lt=boundaries[0])]
+    for start_pk, end_pk in zip(boundaries, boundaries[1:]):
+        querysets.append(queryset.filter(pk__gte=start_pk, pk__lt=end_pk))
+    querysets.append(queryset.filter(pk__gte=boundaries[-1]))
+    return querysets
+
+
+def get_sql_request_indexes(sql_request):
+    return [
+        [column.strip() for column in columns.split(",")] for columns in SQL_INDEX_DIRECTIVE_REGEX.findall(sql_request)
+    ]
+
+
+def get_sql_identifier_name(identifier):
+    """
+    PostgreSQL folds unquoted identifiers to lower case.
+    """
+    if identifier.startswith('"'):
+        return identifier.strip('"')
+    return identifier.lower()
+
+
+def get_sql_request_table_references(sql_request):
+    """
+    Names of the tables the sql_request possibly reads from.
+    Names which are not actual tables are harmless as they are eventually ignored by `get_table_versions`.
+    """
+    sql_request = SQL_COMMENT_REGEX.sub("", sql_request)
+    cte_names = {get_sql_identifier_name(name) for name in SQL_CTE_NAME_REGEX.findall(sql_request)}
+    references = {get_sql_identifier_name(name) for name in SQL_TABLE_REFERENCE_REGEX.findall(sql_request)}
+    return references - cte_names
+
+
+def get_build_levels(dependencies):
+    """
+    Group tables into successive levels such that each table only depends on tables of previous levels.
+
+    `dependencies` is a `{table_name: set_of_table_names}` dict, tables keep their order within a level.
+    """
+    levels = []
+    built = set()
+    remaining = dict(dependencies)
+    while remaining:
+        level = [table_name for table_name, upstream in remaining.items() if upstream <= built]
+        if not level:
+            raise ValueError(f"Circular dependency between custom tables: {', '.join(remaining)}")
+        levels.append(level)
+        built.update(level)
+        for table_name in level:
+            del remaining[table_name]
+    return levels
+
+
 def build_custom_table(table_name, sql_request, dry_run):
     """
     Build a new table with given sql_request.
     Minimize downtime by building a temporary table first then swap the two tables atomically.
+    Indexes declared in the sql_request are built before the swap.
+
+    The table is not built again when neither the sql_request nor the tables it reads from
+    changed since its last build, unless the sql_request depends on the current date.
     """
     if dry_run:
         # Note that during a dry run, the dry run version of the current table will be built
         # from the wet run version of the underlying tables.
         table_name = get_dry_table_name(table_name)
 
+    sql_hash = hashlib.sha256(sql_request.encode()).hexdigest()
+
     with MetabaseDatabaseCursor() as (cur, conn):
+        upstream_versions = get_table_versions(cur, get_sql_request_table_references(sql_request) - {table_name})
+        if (
+            not SQL_CURRENT_TIME_REGEX.search(SQL_COMMENT_REGEX.sub("", sql_request))
+            and does_table_exist(cur, table_name)
+            and get_custom_table_state(cur, table_name) == (sql_hash, upstream_versions)
+        ):
+            conn.commit()
+            print(f"Skipping {table_name} which is already up to date.")
+            return
+
+        print(f"Building {table_name} ...")
         cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(get_new_table_name(table_name))))
         conn.commit()
         cur.execute(
-            sql.SQL("CREATE TABLE {} AS {}").format(
-                sql.Identifier(get_new_table_name(table_name)), sql.SQL(sql_request)
+            sql.SQL("{} {} AS {}").format(
+                get_create_table_sql(), sql.Identifier(get_new_table_name(table_name)), sql.SQL(sql_request)
             )
         )
         conn.commit()
+        finalize_new_table(cur, table_name=table_name, indexes=get_sql_request_indexes(sql_request))
+        conn.commit()
 
     switch_table_atomically(table_name=table_name)
 
+    with MetabaseDatabaseCursor() as (cur, conn):
+        set_custom_table_state(cur, table_name, sql_hash, upstream_versions)
+        conn.commit()
+    print(f"Built {table_name}.")
+
+
+def get_custom_table_filenames():
+    """
+    Return a `{table_name: filename}` dict of the SQL requests in `sql` folder, in the order of their filenames.
+    """
+    path = f"{CURRENT_DIR}/sql"
+    return {
+        "_".join(filename.split(".")[0].split("_")[1:]): os.path.join(path, filename)
+        for filename in sorted([f for f in os.listdir(path) if f.endswith(".sql")])
+    }
+
 
-def build_custom_tables(dry_run):
+def build_custom_tables(dry_run, concurrency=1):
     """
-    Build custom tables one by one by playing SQL requests in `sql` folder.
+    Build custom tables by playing SQL requests in `sql` folder.
 
     Typically:
     - 001_fluxIAE_DateDerniereMiseAJour.sql
     - 002_missions_ai_ehpad.sql
     - ...
 
-    The numerical prefixes ensure the order of execution is deterministic.
+    Dependencies between custom tables are inferred from the tables each SQL request reads from:
+    a table is only built once all the custom tables it depends on are built,
+    and up to `concurrency` independent tables are built at the same time.
+    The numerical prefixes ensure the order of execution is deterministic within a level.
 
     The name of the table being created with the query is derived from the filename,
     # e.g. '002_missions_ai_ehpad.sql' => 'missions_ai_ehpad'
     """
-    path = f"{CURRENT_DIR}/sql"
-    for filename in sorted([f for f in os.listdir(path) if f.endswith(".sql")]):
-        print(f"Running {filename} ...")
-        table_name = "_".join(filename.split(".")[0].split("_")[1:])
-        with open(os.path.join(path, filename), "r") as file:
-            sql_request = file.read()
-        build_custom_table(table_name=table_name, sql_request=sql_request, dry_run=dry_run)
-        print("Done.")
+    sql_requests = {}
+    for table_name, filename in get_custom_table_filenames().items():
+        with open(filename, "r") as file:
+            sql_requests[table_name] = file.read()
+
+    dependencies = {
+        table_name: (get_sql_request_table_references(sql_request) & set(sql_requests)) - {table_name}
+        for table_name, sql_request in sql_requests.items()
+    }
+
+    for level in get_build_levels(dependencies):
+        tasks = [
+            (
+                table_name,
+                partial(
+                    build_custom_table, table_name=table_name, sql_request=sql_requests[table_name], dry_run=dry_run
+                ),
+            )
+            for table_name in level
+        ]
+        run_in_processes(tasks, max_workers=concurrency)
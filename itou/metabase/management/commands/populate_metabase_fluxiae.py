@@ -3,13 +3,9 @@ Populate metabase with fluxIAE data and some custom tables for our needs.
 
 For itou data, see the other script `populate_metabase_itou.py`.
 
-At this time this script is only supposed to run manually on your local dev, not in production.
-
-It manipulates large dataframes in memory (~10M rows) and thus is not optimized for production low memory environment.
-
-This script takes ~2 hours to complete.
-
-Refactoring it for low memory use would make it even longer and is actually not trivial. It might be attempted though.
+fluxIAE exports are large (~10M rows), thus they are never loaded entirely in memory: each export is streamed
+in a single pass from its gzip file into the database with `COPY`, dropping sensitive columns on the fly.
+Memory use is bounded whatever the size of the exports, which makes this script suitable for production.
 
 1) Vocabulary.
 
@@ -59,13 +55,28 @@ An EMI does not necessarily have a mission.
 
 """
 import logging
+import os
+from functools import partial
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
-
-from itou.metabase.management.commands._dataframes import store_df
-from itou.metabase.management.commands._utils import build_custom_tables
-from itou.siaes.management.commands._import_siae.utils import get_fluxiae_df, get_fluxiae_referential_filenames, timeit
+from psycopg2 import sql
+
+from itou.metabase.management.commands._database_psycopg2 import MetabaseDatabaseCursor
+from itou.metabase.management.commands._database_tables import (
+    does_table_exist,
+    get_dry_table_name,
+    get_run_manifest,
+    set_run_manifest_step,
+    store_rows,
+)
+from itou.metabase.management.commands._utils import build_custom_tables, get_custom_table_filenames
+from itou.siaes.management.commands._import_siae.utils import (
+    get_filename,
+    get_fluxiae_referential_filenames,
+    get_fluxiae_rows,
+    timeit,
+)
 
 
 if settings.METABASE_SHOW_SQL_REQUESTS:
@@ -75,6 +86,17 @@ if settings.METABASE_SHOW_SQL_REQUESTS:
     mylogger.addHandler(logging.StreamHandler())
 
 
+# Columns the custom SQL tables join on, indexed once each view is loaded.
+FLUXIAE_VIEW_INDEXES = {
+    "fluxIAE_AnnexeFinanciere": [["af_id_annexe_financiere"], ["af_id_structure"]],
+    "fluxIAE_ContratMission": [["contrat_id_ctr"], ["contrat_id_structure"]],
+    "fluxIAE_EtatMensuelIndiv": [["emi_dsm_id"], ["emi_afi_id"]],
+    "fluxIAE_Missions": [["mission_id_mis"], ["mission_id_ctr"]],
+    "fluxIAE_MissionsEtatMensuelIndiv": [["mei_mis_id"], ["mei_dsm_id"]],
+    "fluxIAE_Structure": [["structure_id_siae"]],
+}
+
+
 class Command(BaseCommand):
     """
     Populate metabase database with fluxIAE data.
@@ -88,6 +110,10 @@ class Command(BaseCommand):
 
     When ready:
         django-admin populate_metabase_fluxiae --verbosity=2
+
+    Each completed step is recorded in a run manifest in the metabase database. After a failure,
+    the script can be started again without rebuilding the views whose fluxIAE file did not change:
+        django-admin populate_metabase_fluxiae --verbosity=2 --resume
     """
 
     help = "Populate metabase database with fluxIAE data."
@@ -96,6 +122,12 @@ class Command(BaseCommand):
         parser.add_argument(
             "--dry-run", dest="dry_run", action="store_true", help="Populate alternate tables with sample data"
         )
+        parser.add_argument(
+            "--resume",
+            dest="resume",
+            action="store_true",
+            help="Skip the views already built from the same fluxIAE files according to the run manifest",
+        )
 
     def set_logger(self, verbosity):
         """
@@ -114,10 +146,56 @@ class Command(BaseCommand):
     def log(self, message):
         self.logger.debug(message)
 
+    def get_manifest_step(self, table_name):
+        return get_dry_table_name(table_name) if self.dry_run else table_name
+
+    def record_manifest_step(self, table_name, filename, nrows):
+        with MetabaseDatabaseCursor() as (cur, conn):
+            set_run_manifest_step(
+                cur,
+                step=self.get_manifest_step(table_name),
+                source_filename=os.path.basename(filename),
+                source_size=os.path.getsize(filename),
+                nrows=nrows,
+            )
+            conn.commit()
+
+    def is_manifest_step_completed(self, table_name, filename):
+        step = self.get_manifest_step(table_name)
+        if self.manifest.get(step) != (os.path.basename(filename), os.path.getsize(filename)):
+            return False
+        with MetabaseDatabaseCursor() as (cur, conn):
+            return does_table_exist(cur, step)
+
     @timeit
     def populate_fluxiae_view(self, vue_name, skip_first_row=True):
-        df = get_fluxiae_df(vue_name=vue_name, skip_first_row=skip_first_row, dry_run=self.dry_run)
-        store_df(df=df, table_name=vue_name, dry_run=self.dry_run)
+        filename = get_filename(filename_prefix=vue_name, filename_extension=".csv")
+        if self.resume and self.is_manifest_step_completed(vue_name, filename):
+            self.log(f"Skipping {vue_name} which was already built from {os.path.basename(filename)}.")
+            return
+
+        get_rows = partial(
+            get_fluxiae_rows, vue_name=vue_name, filename=filename, skip_first_row=skip_first_row, dry_run=self.dry_run
+        )
+        nrows = store_rows(
+            get_rows=get_rows,
+            table_name=vue_name,
+            dry_run=self.dry_run,
+            indexes=FLUXIAE_VIEW_INDEXES.get(vue_name),
+        )
+        self.record_manifest_step(vue_name, filename, nrows)
+
+    def build_custom_tables(self):
+        # Custom tables which are already up to date are skipped anyway, see `build_custom_table`.
+        build_custom_tables(dry_run=self.dry_run, concurrency=settings.METABASE_EXTRACTION_CONCURRENCY)
+
+        for table_name, filename in get_custom_table_filenames().items():
+            with MetabaseDatabaseCursor() as (cur, conn):
+                cur.execute(
+                    sql.SQL("SELECT count(*) FROM {}").format(sql.Identifier(self.get_manifest_step(table_name)))
+                )
+                nrows = cur.fetchone()[0]
+            self.record_manifest_step(table_name, filename, nrows)
 
     def populate_fluxiae_referentials(self):
         for filename in get_fluxiae_referential_filenames():
@@ -129,6 +207,10 @@ class Command(BaseCommand):
             self.log("Populating metabase is not allowed in this environment.")
             return
 
+        with MetabaseDatabaseCursor() as (cur, conn):
+            self.manifest = get_run_manifest(cur)
+            conn.commit()
+
         self.populate_fluxiae_referentials()
 
         self.populate_fluxiae_view(vue_name="fluxIAE_AnnexeFinanciere")
@@ -145,11 +227,12 @@ class Command(BaseCommand):
         self.populate_fluxiae_view(vue_name="fluxIAE_Structure")
 
         # Build custom tables by running raw SQL queries on existing tables.
-        build_custom_tables(dry_run=self.dry_run)
+        self.build_custom_tables()
 
-    def handle(self, dry_run=False, **options):
+    def handle(self, dry_run=False, resume=False, **options):
         self.set_logger(options.get("verbosity"))
         self.dry_run = dry_run
+        self.resume = resume
         self.populate_metabase_fluxiae()
         self.log("-" * 80)
         self.log("Done.")
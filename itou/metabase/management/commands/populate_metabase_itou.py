@@ -11,7 +11,9 @@ french speaking only users, and injects the result into metabase.
 
 The itou production database is never modified, only read.
 
-The metabase database tables are trashed and recreated every time.
+The metabase database tables are trashed and recreated every time,
+except in incremental mode where the biggest tables are only updated with the rows which changed
+since the previous run. A full run should still happen regularly to catch deleted objects.
 
 The data is heavily denormalized among tables so that the metabase user
 has all the fields needed and thus never needs to perform joining two tables.
@@ -22,13 +24,15 @@ Its name is "Documentation ITOU METABASE [Master doc]". No direct link here for
 
 import gc
 import logging
-from collections import OrderedDict
+import time
+from collections import Counter, OrderedDict
+from functools import partial
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.core.paginator import Paginator
 from django.utils import timezone
-from psycopg2 import extras as psycopg2_extras, sql
+from psycopg2 import sql
 from tqdm import tqdm
 
 from itou.approvals.models import Approval, PoleEmploiApproval
@@ -46,19 +50,27 @@ from itou.metabase.management.commands import (
     _rome_codes,
     _siaes,
 )
-from itou.metabase.management.commands._database_psycopg2 import MetabaseDatabaseCursor
+from itou.metabase.management.commands._database_psycopg2 import MetabaseCopyWriter, MetabaseDatabaseCursor
 from itou.metabase.management.commands._database_tables import (
+    does_table_exist,
+    finalize_new_table,
+    get_columns_hash,
+    get_create_table_sql,
     get_dry_table_name,
     get_new_table_name,
     get_old_table_name,
+    get_sync_state,
+    set_sync_state,
 )
 from itou.metabase.management.commands._dataframes import get_df_from_rows, store_df
+from itou.metabase.management.commands._processes import run_in_processes
 from itou.metabase.management.commands._utils import (
     anonymize,
     build_custom_tables,
     chunked_queryset,
     compose,
     convert_boolean_to_int,
+    split_queryset,
 )
 from itou.prescribers.models import PrescriberOrganization
 from itou.siaes.models import Siae, SiaeJobDescription
@@ -90,6 +102,12 @@ class Command(BaseCommand):
 
     When ready:
         django-admin populate_metabase_itou --verbosity=2
+
+    To build 4 tables at the same time and split the biggest ones into 4 parallel shards:
+        django-admin populate_metabase_itou --verbosity=2 --concurrency=4 --shards=4
+
+    To only update changed rows of the tables supporting it:
+        django-admin populate_metabase_itou --verbosity=2 --incremental
     """
 
     help = "Populate metabase database."
@@ -98,6 +116,32 @@ class Command(BaseCommand):
         parser.add_argument(
             "--dry-run", dest="dry_run", action="store_true", help="Populate alternate tables with sample data"
         )
+        parser.add_argument(
+            "--concurrency",
+            dest="concurrency",
+            type=int,
+            default=settings.METABASE_EXTRACTION_CONCURRENCY,
+            help="How many tables are built at the same time",
+        )
+        parser.add_argument(
+            "--shards",
+            dest="shards",
+            type=int,
+            default=settings.METABASE_EXTRACTION_SHARDS,
+            help="In how many parts the biggest tables are split to be loaded in parallel",
+        )
+        parser.add_argument(
+            "--profile-columns",
+            dest="profile_columns",
+            action="store_true",
+            help="Report how much CPU time each column costs",
+        )
+        parser.add_argument(
+            "--incremental",
+            dest="incremental",
+            action="store_true",
+            help="Only extract rows which changed since the previous run when possible",
+        )
 
     def set_logger(self, verbosity):
         """
@@ -135,25 +179,164 @@ class Command(BaseCommand):
         self.cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(get_dry_table_name(table_name))))
         self.commit()
 
-    def inject_chunk(self, table_columns, chunk, new_table_name):
+    def inject_chunk(self, table_columns, chunk, writer):
+        """
+        Stream chunk of objects into table.
+        """
+        if not self.profile_columns:
+            for o in chunk:
+                writer.write_row([c["fn"](o) for c in table_columns])
+            return
+
+        for o in chunk:
+            row = []
+            for c in table_columns:
+                start = time.process_time()
+                row.append(c["fn"](o))
+                self.column_cpu_times[c["name"]] += time.process_time() - start
+            writer.write_row(row)
+
+    def report_column_cpu_times(self):
+        """
+        Log how much CPU time each column cost, most expensive first.
+
+        Values cached per row (see `cached_per_object`) are accounted for in the first column needing them.
+        """
+        total = sum(self.column_cpu_times.values())
+        self.log(f"CPU time spent computing columns: {total:.2f}s")
+        for column_name, cpu_time in self.column_cpu_times.most_common():
+            self.log(f"- {column_name}: {cpu_time:.2f}s ({100 * cpu_time / total if total else 0:.1f}%)")
+        self.column_cpu_times.clear()
+
+    def inject_querysets(self, table_columns, querysets, writer):
+        """
+        Stream all objects of given querysets into table, with a progress bar.
+        """
+        if self.dry_run:
+            total_rows = sum(
+                [min(queryset.count(), settings.METABASE_DRY_RUN_ROWS_PER_QUERYSET) for queryset in querysets]
+            )
+        else:
+            total_rows = sum([queryset.count() for queryset in querysets])
+
+        self.log(f"Injecting {total_rows} rows with {len(table_columns)} columns:")
+
+        with tqdm(total=total_rows) as progress_bar:
+            for queryset in querysets:
+                injections = 0
+                total_injections = queryset.count()
+                if self.dry_run:
+                    total_injections = min(total_injections, settings.METABASE_DRY_RUN_ROWS_PER_QUERYSET)
+
+                # Extract rows by batch of settings.METABASE_INSERT_BATCH_SIZE, the writer sends them
+                # to the database whenever its buffer is full.
+                for chunk_qs in chunked_queryset(queryset, chunk_size=settings.METABASE_INSERT_BATCH_SIZE):
+                    injections_left = total_injections - injections
+                    if chunk_qs.count() > injections_left:
+                        chunk_qs = chunk_qs[:injections_left]
+                    self.inject_chunk(table_columns=table_columns, chunk=chunk_qs, writer=writer)
+                    injections += chunk_qs.count()
+                    progress_bar.update(chunk_qs.count())
+
+                # Trigger garbage collection to optimize memory use.
+                gc.collect()
+
+        if self.profile_columns:
+            self.report_column_cpu_times()
+
+    def inject_shard(self, table_columns, table_name, querysets):
+        with MetabaseDatabaseCursor() as (cur, conn):
+            writer = MetabaseCopyWriter(
+                cur=cur, conn=conn, table_name=table_name, column_names=[c["name"] for c in table_columns]
+            )
+            with writer:
+                self.inject_querysets(table_columns=table_columns, querysets=querysets, writer=writer)
+
+    def get_shards(self, querysets, shards):
         """
-        Insert chunk of objects into table.
+        Split querysets into `shards` lists of querysets covering distinct primary key ranges.
         """
-        insert_query = sql.SQL("insert into {new_table_name} ({fields}) values %s").format(
-            new_table_name=sql.Identifier(new_table_name),
-            fields=sql.SQL(",").join(
-                [sql.Identifier(c["name"]) for c in table_columns],
-            ),
+        if shards <= 1:
+            return [querysets]
+        split_querysets = [split_queryset(queryset, parts=shards) for queryset in querysets]
+        shards = [[parts[i] for parts in split_querysets if i < len(parts)] for i in range(shards)]
+        return [shard for shard in shards if shard]
+
+    def update_table(self, table_name, table_columns, querysets, incremental, since):
+        """
+        Incremental counterpart of `populate_table`: only rows whose objects changed since the last
+        extraction are extracted again, streamed into a staging table and upserted into the target table
+        based on the key column.
+
+        Deleted objects are not detected, they disappear on the next full rebuild.
+        """
+        new_table_name = get_new_table_name(table_name)
+        changed_pks = querysets[0].model.objects.filter(incremental["changed_since"](since)).values("pk")
+        querysets = [queryset.filter(pk__in=changed_pks) for queryset in querysets]
+
+        self.log(f"Updating table {table_name} with rows changed since {since}:")
+
+        self.cleanup_tables(table_name)
+        self.cur.execute(
+            sql.SQL("{} {} (LIKE {})").format(
+                get_create_table_sql(), sql.Identifier(new_table_name), sql.Identifier(table_name)
+            )
         )
-        dataset = [[c["fn"](o) for c in table_columns] for o in chunk]
-        psycopg2_extras.execute_values(self.cur, insert_query, dataset, template=None)
         self.commit()
 
-    def populate_table(self, table_name, table_columns, queryset=None, querysets=None, extra_object=None):
+        writer = MetabaseCopyWriter(
+            cur=self.cur,
+            conn=self.conn,
+            table_name=new_table_name,
+            column_names=[c["name"] for c in table_columns],
+        )
+        with writer:
+            self.inject_querysets(table_columns=table_columns, querysets=querysets, writer=writer)
+
+        # Replace the changed rows in a single transaction so that metabase users never miss any row.
+        self.cur.execute(
+            sql.SQL("DELETE FROM {table_name} USING {new_table_name} WHERE {table_key} = {new_table_key}").format(
+                table_name=sql.Identifier(table_name),
+                new_table_name=sql.Identifier(new_table_name),
+                table_key=sql.Identifier(table_name, incremental["key"]),
+                new_table_key=sql.Identifier(new_table_name, incremental["key"]),
+            )
+        )
+        self.cur.execute(
+            sql.SQL("INSERT INTO {} SELECT * FROM {}").format(
+                sql.Identifier(table_name), sql.Identifier(new_table_name)
+            )
+        )
+        self.commit()
+        self.cur.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(table_name)))
+        self.commit()
+        self.cleanup_tables(table_name)
+        self.log("")
+
+    def populate_table(
+        self,
+        table_name,
+        table_columns,
+        queryset=None,
+        querysets=None,
+        extra_object=None,
+        incremental=None,
+        shards=1,
+        indexes=None,
+    ):
         """
         Generic method to populate each table.
         Create table with a temporary name, add column comments,
         inject content and finally swap with the target table.
+
+        In incremental mode, tables providing an `incremental` spec are updated in place instead,
+        unless their columns changed since the last run. The spec is a dict with these keys:
+        - key: name of the column uniquely identifying a row
+        - changed_since: method returning a Q object matching the objects which changed since the given date
+
+        Big tables can be extracted in `shards` primary key ranges loaded in parallel.
+
+        `indexes` (a list of lists of column names) are built before the swap.
         """
         if queryset is not None:
             assert not querysets
@@ -165,41 +348,55 @@ class Command(BaseCommand):
         new_table_name = get_new_table_name(table_name)
         old_table_name = get_old_table_name(table_name)
 
+        # Any change happening during the extraction will be caught by the next incremental run.
+        extraction_started_at = timezone.now()
+
+        table_columns += [
+            {
+                "name": "date_mise_à_jour_metabase",
+                "type": "date",
+                "comment": "Date de dernière mise à jour de Metabase",
+                # As metabase daily updates run typically every night after midnight, the last day with
+                # complete data is yesterday, not today.
+                "fn": lambda o: timezone.now() + timezone.timedelta(days=-1),
+            },
+        ]
+
+        # Transform boolean fields into 0-1 integer fields as
+        # metabase cannot sum or average boolean columns ¯\_(ツ)_/¯
+        for c in table_columns:
+            if c["type"] == "boolean":
+                c["type"] = "integer"
+                c["fn"] = compose(convert_boolean_to_int, c["fn"])
+
+        columns_hash = get_columns_hash(table_columns)
+
         with MetabaseDatabaseCursor() as (cur, conn):
             self.cur = cur
             self.conn = conn
 
-            self.cleanup_tables(table_name)
+            if self.incremental and incremental:
+                sync_state = get_sync_state(self.cur, table_name)
+                if sync_state and sync_state[0] == columns_hash and does_table_exist(self.cur, table_name):
+                    self.update_table(
+                        table_name=table_name,
+                        table_columns=table_columns,
+                        querysets=querysets,
+                        incremental=incremental,
+                        since=sync_state[1],
+                    )
+                    set_sync_state(self.cur, table_name, columns_hash, extraction_started_at)
+                    self.commit()
+                    return
+                self.log(f"Columns of table {table_name} changed or were never synced, rebuilding it entirely.")
 
-            if self.dry_run:
-                total_rows = sum(
-                    [min(queryset.count(), settings.METABASE_DRY_RUN_ROWS_PER_QUERYSET) for queryset in querysets]
-                )
-            else:
-                total_rows = sum([queryset.count() for queryset in querysets])
-
-            table_columns += [
-                {
-                    "name": "date_mise_à_jour_metabase",
-                    "type": "date",
-                    "comment": "Date de dernière mise à jour de Metabase",
-                    # As metabase daily updates run typically every night after midnight, the last day with
-                    # complete data is yesterday, not today.
-                    "fn": lambda o: timezone.now() + timezone.timedelta(days=-1),
-                },
-            ]
-
-            # Transform boolean fields into 0-1 integer fields as
-            # metabase cannot sum or average boolean columns ¯\_(ツ)_/¯
-            for c in table_columns:
-                if c["type"] == "boolean":
-                    c["type"] = "integer"
-                    c["fn"] = compose(convert_boolean_to_int, c["fn"])
+            self.cleanup_tables(table_name)
 
-            self.log(f"Injecting {total_rows} rows with {len(table_columns)} columns into table {table_name}:")
+            self.log(f"Building table {table_name}:")
 
             # Create table.
-            create_table_query = sql.SQL("CREATE TABLE {new_table_name} ({fields_with_type})").format(
+            create_table_query = sql.SQL("{create_table} {new_table_name} ({fields_with_type})").format(
+                create_table=get_create_table_sql(),
                 new_table_name=sql.Identifier(new_table_name),
                 fields_with_type=sql.SQL(",").join(
                     [sql.SQL(" ").join([sql.Identifier(c["name"]), sql.SQL(c["type"])]) for c in table_columns]
@@ -225,26 +422,31 @@ class Command(BaseCommand):
 
             if extra_object:
                 # Insert extra object without counter/tqdm for simplicity.
-                self.inject_chunk(table_columns=table_columns, chunk=[extra_object], new_table_name=new_table_name)
-
-            with tqdm(total=total_rows) as progress_bar:
-                for queryset in querysets:
-                    injections = 0
-                    total_injections = queryset.count()
-                    if self.dry_run:
-                        total_injections = min(total_injections, settings.METABASE_DRY_RUN_ROWS_PER_QUERYSET)
-
-                    # Insert rows by batch of settings.METABASE_INSERT_BATCH_SIZE.
-                    for chunk_qs in chunked_queryset(queryset, chunk_size=settings.METABASE_INSERT_BATCH_SIZE):
-                        injections_left = total_injections - injections
-                        if chunk_qs.count() > injections_left:
-                            chunk_qs = chunk_qs[:injections_left]
-                        self.inject_chunk(table_columns=table_columns, chunk=chunk_qs, new_table_name=new_table_name)
-                        injections += chunk_qs.count()
-                        progress_bar.update(chunk_qs.count())
-
-                    # Trigger garbage collection to optimize memory use.
-                    gc.collect()
+                writer = MetabaseCopyWriter(
+                    cur=self.cur,
+                    conn=self.conn,
+                    table_name=new_table_name,
+                    column_names=[c["name"] for c in table_columns],
+                )
+                with writer:
+                    self.inject_chunk(table_columns=table_columns, chunk=[extra_object], writer=writer)
+
+        # Each shard streams its rows into the new table through its own connections, in parallel
+        # when there are several shards. The new table is swapped in only once every shard succeeded.
+        shards = self.get_shards(querysets, shards=1 if self.dry_run else shards)
+        tasks = [
+            (f"{table_name}_shard_{i}", partial(self.inject_shard, table_columns, new_table_name, shard))
+            for i, shard in enumerate(shards)
+        ]
+        run_in_processes(tasks, max_workers=len(shards))
+
+        with MetabaseDatabaseCursor() as (cur, conn):
+            self.cur = cur
+            self.conn = conn
+
+            self.log(f"Building indexes and statistics of table {table_name}.")
+            finalize_new_table(self.cur, table_name=table_name, indexes=indexes)
+            self.commit()
 
             # Swap new and old table nicely to minimize downtime.
             self.cur.execute(
@@ -259,6 +461,10 @@ class Command(BaseCommand):
             )
             self.commit()
             self.cleanup_tables(table_name)
+
+            # Even full rebuilds record their state, so that the next incremental run can start from there.
+            set_sync_state(self.cur, table_name, columns_hash, extraction_started_at)
+            self.commit()
             self.log("")
 
     def populate_siaes(self):
@@ -278,7 +484,12 @@ class Command(BaseCommand):
             .all()
         )
 
-        self.populate_table(table_name="structures", table_columns=_siaes.TABLE_COLUMNS, queryset=queryset)
+        self.populate_table(
+            table_name="structures",
+            table_columns=_siaes.TABLE_COLUMNS,
+            queryset=queryset,
+            indexes=_siaes.TABLE_INDEXES,
+        )
 
     def populate_job_descriptions(self):
         """
@@ -294,7 +505,10 @@ class Command(BaseCommand):
         )
 
         self.populate_table(
-            table_name="fiches_de_poste", table_columns=_job_descriptions.TABLE_COLUMNS, queryset=queryset
+            table_name="fiches_de_poste",
+            table_columns=_job_descriptions.TABLE_COLUMNS,
+            queryset=queryset,
+            indexes=_job_descriptions.TABLE_INDEXES,
         )
 
     def populate_organizations(self):
@@ -312,6 +526,7 @@ class Command(BaseCommand):
             table_columns=_organizations.TABLE_COLUMNS,
             queryset=queryset,
             extra_object=_organizations.ORG_OF_PRESCRIBERS_WITHOUT_ORG,
+            indexes=_organizations.TABLE_INDEXES,
         )
 
     def populate_job_applications(self):
@@ -320,13 +535,18 @@ class Command(BaseCommand):
         """
         queryset = (
             JobApplication.objects.select_related("to_siae", "sender_siae", "sender_prescriber_organization")
-            .prefetch_related("logs")
+            .with_transition_dates()
             .filter(created_from_pe_approval=False)
             .all()
         )
 
         self.populate_table(
-            table_name="candidatures", table_columns=_job_applications.TABLE_COLUMNS, queryset=queryset
+            table_name="candidatures",
+            table_columns=_job_applications.TABLE_COLUMNS,
+            queryset=queryset,
+            incremental=_job_applications.INCREMENTAL_SPEC,
+            shards=self.shards,
+            indexes=_job_applications.TABLE_INDEXES,
         )
 
     def populate_selected_jobs(self):
@@ -359,7 +579,12 @@ class Command(BaseCommand):
                 break
 
         df = get_df_from_rows(rows)
-        store_df(df=df, table_name=table_name, dry_run=self.dry_run)
+        store_df(
+            df=df,
+            table_name=table_name,
+            dry_run=self.dry_run,
+            indexes=[["id_fiche_de_poste"], ["id_anonymisé_candidature"]],
+        )
 
     def populate_approvals(self):
         """
@@ -377,7 +602,11 @@ class Command(BaseCommand):
         ).all()
 
         self.populate_table(
-            table_name="pass_agréments", table_columns=_approvals.TABLE_COLUMNS, querysets=[queryset1, queryset2]
+            table_name="pass_agréments",
+            table_columns=_approvals.TABLE_COLUMNS,
+            querysets=[queryset1, queryset2],
+            shards=self.shards,
+            indexes=_approvals.TABLE_INDEXES,
         )
 
     def populate_job_seekers(self):
@@ -402,17 +631,34 @@ class Command(BaseCommand):
             .all()
         )
 
-        self.populate_table(table_name="candidats", table_columns=_job_seekers.TABLE_COLUMNS, queryset=queryset)
+        self.populate_table(
+            table_name="candidats",
+            table_columns=_job_seekers.TABLE_COLUMNS,
+            queryset=queryset,
+            incremental=_job_seekers.INCREMENTAL_SPEC,
+            shards=self.shards,
+            indexes=_job_seekers.TABLE_INDEXES,
+        )
 
     def populate_rome_codes(self):
         queryset = Rome.objects.all()
 
-        self.populate_table(table_name="codes_rome", table_columns=_rome_codes.TABLE_COLUMNS, queryset=queryset)
+        self.populate_table(
+            table_name="codes_rome",
+            table_columns=_rome_codes.TABLE_COLUMNS,
+            queryset=queryset,
+            indexes=_rome_codes.TABLE_INDEXES,
+        )
 
     def populate_insee_codes(self):
         queryset = City.objects.all()
 
-        self.populate_table(table_name="communes", table_columns=_insee_codes.TABLE_COLUMNS, queryset=queryset)
+        self.populate_table(
+            table_name="communes",
+            table_columns=_insee_codes.TABLE_COLUMNS,
+            queryset=queryset,
+            indexes=_insee_codes.TABLE_INDEXES,
+        )
 
     def populate_departments(self):
         """
@@ -433,7 +679,7 @@ class Command(BaseCommand):
             rows.append(row)
 
         df = get_df_from_rows(rows)
-        store_df(df=df, table_name=table_name, dry_run=self.dry_run)
+        store_df(df=df, table_name=table_name, dry_run=self.dry_run, indexes=[["code_departement"]])
 
     def report_data_inconsistencies(self):
         """
@@ -456,7 +702,14 @@ class Command(BaseCommand):
             )
 
     def build_custom_tables(self):
-        build_custom_tables(dry_run=self.dry_run)
+        build_custom_tables(dry_run=self.dry_run, concurrency=self.concurrency)
+
+    def run_update(self, update):
+        if VERBOSE_SLACK_MESSAGES:
+            send_slack_message(f"Début de l'étape {update.__name__} :rocket:")
+        update()
+        if VERBOSE_SLACK_MESSAGES:
+            send_slack_message(f"Fin de l'étape {update.__name__} :white_check_mark:")
 
     def populate_metabase_itou(self):
         if not settings.ALLOW_POPULATING_METABASE:
@@ -467,7 +720,8 @@ class Command(BaseCommand):
             ":rocket: Début de la mise à jour quotidienne de Metabase avec les dernières données C1 :rocket:"
         )
 
-        updates = [
+        # These tables do not depend on each other and can be built at the same time.
+        independent_updates = [
             self.populate_siaes,
             self.populate_job_descriptions,
             self.populate_organizations,
@@ -478,24 +732,28 @@ class Command(BaseCommand):
             self.populate_rome_codes,
             self.populate_insee_codes,
             self.populate_departments,
-            self.build_custom_tables,
-            self.report_data_inconsistencies,
         ]
 
-        for update in updates:
-            if VERBOSE_SLACK_MESSAGES:
-                send_slack_message(f"Début de l'étape {update.__name__} :rocket:")
-            update()
-            if VERBOSE_SLACK_MESSAGES:
-                send_slack_message(f"Fin de l'étape {update.__name__} :white_check_mark:")
+        run_in_processes(
+            [(update.__name__, partial(self.run_update, update)) for update in independent_updates],
+            max_workers=self.concurrency,
+        )
+
+        for update in [self.build_custom_tables, self.report_data_inconsistencies]:
+            self.run_update(update)
 
         send_slack_message(
             ":rocket: Fin de la mise à jour quotidienne de Metabase avec les dernières données C1 :rocket:"
         )
 
-    def handle(self, dry_run=False, **options):
+    def handle(self, dry_run=False, incremental=False, concurrency=1, shards=1, profile_columns=False, **options):
         self.set_logger(options.get("verbosity"))
         self.dry_run = dry_run
+        self.profile_columns = profile_columns
+        self.column_cpu_times = Counter()
+        self.incremental = incremental
+        self.concurrency = concurrency
+        self.shards = shards
         self.populate_metabase_itou()
         self.log("-" * 80)
         self.log("Done.")
@@ -1,3 +1,5 @@
+-- index: af_id_annexe_financiere
+-- index: af_id_structure
 /*
 L'objectif est de retravailler les variables de la table fluxIAE_AnnexeFinanciere: 
     
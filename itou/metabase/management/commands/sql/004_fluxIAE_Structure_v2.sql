@@ -1,3 +1,4 @@
+-- index: structure_id_siae
 /*
 
 L'objectif est de rajouter le nom du département et la région de la structure à la table ASP "fluxIAE_Structure"
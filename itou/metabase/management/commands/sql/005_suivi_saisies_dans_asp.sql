@@ -1,3 +1,4 @@
+-- index: af_id_annexe_financiere
 /*
 
 Le besoin des DDETS est d'avoir un suivi en temps réel du retard que 
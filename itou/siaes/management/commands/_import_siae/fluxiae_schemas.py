@@ -0,0 +1,174 @@
+"""
+
+Registry of the column types of fluxIAE exports.
+
+Without it pandas loads every code and label column as an `object` column, i.e. one python string per value,
+which blows up the memory of the biggest views (~7M rows for fluxIAE_EtatMensuelIndiv).
+
+Column kinds:
+- CATEGORY: few distinct values (codes, states...), stored once with integer codes per row.
+- INTEGER: ids, years, months... downcast to the smallest integer type holding all values.
+- DATE: `dd/mm/yyyy` dates.
+- STRING: values kept as python strings, e.g. free text or values later concatenated or validated.
+
+Columns absent from the registry fall back to pandas type inference, see `apply_fluxiae_schema`.
+
+"""
+import pandas as pd
+
+
+CATEGORY = "category"
+INTEGER = "integer"
+DATE = "date"
+STRING = "string"
+
+FLUXIAE_DATE_FORMAT = "%d/%m/%Y"
+
+# Columns of unknown type holding few distinct values compared to their number of rows are made categorical.
+FALLBACK_CATEGORY_MAX_RATIO = 0.5
+
+# Number of rows used to estimate the memory the columns would have used without the registry.
+MEMORY_REPORT_SAMPLE_SIZE = 10000
+
+FLUXIAE_SCHEMAS = {
+    "fluxIAE_AnnexeFinanciere": {
+        "af_id_annexe_financiere": INTEGER,
+        "af_id_structure": INTEGER,
+        "af_numero_annexe_financiere": STRING,
+        "af_numero_avenant_renouvellement": INTEGER,
+        "af_numero_avenant_modification": INTEGER,
+        "af_numero_convention": STRING,
+        "af_mesure_dispositif_code": CATEGORY,
+        "af_etat_annexe_financiere_code": CATEGORY,
+        "af_date_debut_effet": DATE,
+        "af_date_fin_effet": DATE,
+    },
+    "fluxIAE_ContratMission": {
+        "contrat_id_ctr": INTEGER,
+        "contrat_id_pph": INTEGER,
+        "contrat_id_structure": INTEGER,
+        "contrat_mesure_disp_code": CATEGORY,
+        "contrat_date_embauche": DATE,
+        "contrat_date_fin_contrat": DATE,
+        "contrat_date_sortie_definitive": DATE,
+    },
+    "fluxIAE_EtatMensuelIndiv": {
+        "emi_afi_id": INTEGER,
+        "emi_dsm_id": INTEGER,
+        "emi_pph_id": INTEGER,
+        "emi_sme_annee": INTEGER,
+        "emi_sme_mois": INTEGER,
+        "emi_esm_etat_code": CATEGORY,
+        "emi_date_creation": DATE,
+        "emi_date_validation": DATE,
+    },
+    "fluxIAE_Missions": {
+        "mission_id_mis": INTEGER,
+        "mission_id_ctr": INTEGER,
+        "mission_code_rome": CATEGORY,
+        "mission_code_rome_complet": CATEGORY,
+        "mission_descriptif": STRING,
+        "mission_date_creation": DATE,
+        "mission_date_debut": DATE,
+        "mission_date_fin": DATE,
+        "mission_date_modification": DATE,
+    },
+    "fluxIAE_MissionsEtatMensuelIndiv": {
+        "mei_dsm_id": INTEGER,
+        "mei_mis_id": INTEGER,
+    },
+    "fluxIAE_Salarie": {
+        # Only its year is kept, see `anonymize_fluxiae_df`.
+        "salarie_date_naissance": STRING,
+    },
+    "fluxIAE_Structure": {
+        "structure_id_siae": INTEGER,
+        "structure_siret_actualise": STRING,
+        "structure_siret_signature": STRING,
+        "structure_code_naf": STRING,
+        "structure_denomination": STRING,
+        "structure_adresse_mail_corresp_technique": STRING,
+        "structure_adresse_admin_code_insee": STRING,
+        "structure_adresse_admin_commune": STRING,
+        "structure_adresse_admin_cp": STRING,
+        "structure_adresse_gestion_numero": STRING,
+        "structure_adresse_gestion_cplt_num_voie": STRING,
+        "structure_adresse_gestion_type_voie": STRING,
+        "structure_adresse_gestion_nom_voie": STRING,
+        "structure_adresse_gestion_cp": STRING,
+        "structure_adresse_gestion_commune": STRING,
+        "structure_adresse_gestion_telephone": STRING,
+        "structure_adresse_gestion_numero_apt": STRING,
+        "structure_adresse_gestion_entree": STRING,
+        "structure_adresse_gestion_cplt_adresse": STRING,
+    },
+}
+
+
+def get_fluxiae_read_csv_dtype(vue_name, excluded_column_names=()):
+    """
+    Types which `pd.read_csv` can apply while parsing, so that values are never loaded as python strings first.
+    """
+    read_csv_dtypes = {CATEGORY: "category", STRING: str}
+    return {
+        column_name: read_csv_dtypes[kind]
+        for column_name, kind in FLUXIAE_SCHEMAS.get(vue_name, {}).items()
+        if kind in read_csv_dtypes and column_name not in excluded_column_names
+    }
+
+
+def apply_fluxiae_schema(df, vue_name, excluded_column_names=()):
+    """
+    Convert the columns which could not be typed by `pd.read_csv`.
+
+    Columns absent from the registry keep the type inferred by pandas, except that integers are downcast
+    and strings having few distinct values are made categorical.
+    """
+    schema = FLUXIAE_SCHEMAS.get(vue_name, {})
+    unknown_column_names = []
+
+    for column_name in df.columns.tolist():
+        if column_name in excluded_column_names:
+            continue
+        kind = schema.get(column_name)
+        column = df[column_name]
+        if kind == INTEGER:
+            df[column_name] = pd.to_numeric(column, downcast="integer")
+        elif kind == DATE:
+            # `exact=False` ignores the time some exports append to their dates.
+            df[column_name] = pd.to_datetime(column, format=FLUXIAE_DATE_FORMAT, exact=False)
+        elif kind is None:
+            unknown_column_names.append(column_name)
+            if pd.api.types.is_integer_dtype(column):
+                df[column_name] = pd.to_numeric(column, downcast="integer")
+            elif column.dtype == object and column.nunique() <= FALLBACK_CATEGORY_MAX_RATIO * len(column):
+                df[column_name] = column.astype("category")
+
+    if unknown_column_names:
+        print(f"{len(unknown_column_names)} columns of {vue_name} have no registered type: {unknown_column_names}")
+
+    return df
+
+
+def estimate_untyped_memory_usage(column):
+    """
+    Estimate the memory a column would use as typed by pandas without the registry, from a sample of its values.
+    """
+    if pd.api.types.is_numeric_dtype(column) and not isinstance(column.dtype, pd.CategoricalDtype):
+        # Numbers would have been 64 bits numbers.
+        return 8 * len(column)
+    sample = column.sample(n=min(len(column), MEMORY_REPORT_SAMPLE_SIZE), random_state=0)
+    if pd.api.types.is_datetime64_any_dtype(sample):
+        sample = sample.dt.strftime(FLUXIAE_DATE_FORMAT)
+    sample_memory_usage = sample.astype(object).memory_usage(index=False, deep=True)
+    return sample_memory_usage * len(column) // max(len(sample), 1)
+
+
+def print_fluxiae_memory_report(df, vue_name):
+    memory_usage = df.memory_usage(index=False, deep=True).sum()
+    untyped_memory_usage = sum(estimate_untyped_memory_usage(df[column_name]) for column_name in df.columns)
+    saved_ratio = 1 - memory_usage / untyped_memory_usage if untyped_memory_usage else 0
+    print(
+        f"{vue_name} uses {memory_usage / 1024 ** 2:.1f} MB of memory "
+        f"instead of ~{untyped_memory_usage / 1024 ** 2:.1f} MB without types ({saved_ratio:.0%} saved)."
+    )
@@ -6,7 +6,6 @@ All these helpers are specific to SIAE logic (not GEIQ, EA, EATT).
 
 """
 from itou.common_apps.address.departments import department_from_postcode
-from itou.siaes.management.commands._import_siae.utils import geocode_siae
 from itou.siaes.management.commands._import_siae.vue_af import ACTIVE_SIAE_KEYS
 from itou.siaes.management.commands._import_siae.vue_structure import SIRET_TO_ASP_ID
 from itou.siaes.models import Siae
@@ -24,7 +23,7 @@ def should_siae_be_created(siae):
 
 def build_siae(row, kind):
     """
-    Build a siae object from a dataframe row.
+    Build a siae object from a row of `ASP_ID_TO_SIAE_ROW`.
 
     Only for SIAE, not for GEIQ nor EA nor EATT.
     """
@@ -33,7 +32,7 @@ def build_siae(row, kind):
     siae.kind = kind
     siae.naf = row.naf
     siae.source = Siae.SOURCE_ASP
-    siae.name = row["name"]  # row.name surprisingly returns the row index.
+    siae.name = row.name
     assert not siae.name.isnumeric()
 
     siae.phone = row.phone
@@ -68,7 +67,4 @@ def build_siae(row, kind):
     siae.post_code = row.post_code
     siae.department = department_from_postcode(siae.post_code)
 
-    if should_siae_be_created(siae):
-        siae = geocode_siae(siae)
-
     return siae
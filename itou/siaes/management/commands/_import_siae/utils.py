@@ -5,20 +5,34 @@ Various helpers shared by the import_siae, import_geiq and import_ea_eatt script
 """
 import csv
 import gzip
+import hashlib
+import inspect
+import json
 import os
 from functools import wraps
 from time import time
 
 import pandas as pd
+from django.conf import settings
 from django.utils import timezone
 
 from itou.common_apps.address.models import AddressMixin
+from itou.siaes.management.commands._import_siae.fluxiae_schemas import (
+    FLUXIAE_SCHEMAS,
+    apply_fluxiae_schema,
+    get_fluxiae_read_csv_dtype,
+    print_fluxiae_memory_report,
+)
 from itou.siaes.models import Siae
-from itou.utils.apis.geocoding import get_geocoding_data
+from itou.utils.apis.geocoding import GEOCODING_CACHE_STATS, get_batch_geocoding_data
 
 
 CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
 
+# Bump when the loading code of `get_fluxiae_df` changes (other than the schemas and converters
+# which are already part of the snapshot key) to invalidate existing snapshots.
+FLUXIAE_SNAPSHOTS_VERSION = 1
+
 SHOW_IMPORT_SIAE_METHOD_TIMER = False
 
 
@@ -124,21 +138,40 @@ def remap_columns(df, column_mapping):
     return df
 
 
-def could_siae_be_deleted(siae):
-    if siae.members.count() >= 1 or siae.job_applications_received.count() >= 1:
-        return False
-    # An ASP siae can only be deleted when all its antennas have been deleted.
-    if siae.source == Siae.SOURCE_ASP:
-        return siae.convention.siaes.count() == 1
-    return True
+def get_validation_errors_df(df, validity_masks):
+    """
+    Return the rows of the dataframe which fail any validation, with the errors of each row in an `errors` column.
 
+    `validity_masks` maps each error message to a boolean series being True for valid rows,
+    so that each validation runs once over a whole column instead of once per row.
+    """
+    errors = pd.Series("", index=df.index)
+    for error_message, is_valid in validity_masks.items():
+        # Missing values are invalid.
+        is_invalid = ~is_valid.fillna(False).astype(bool)
+        errors[is_invalid] += f"{error_message}; "
+    has_errors = errors != ""
+    return df[has_errors].assign(errors=errors[has_errors])
 
-def geocode_siae(siae):
-    if siae.geocoding_address is None:
-        return siae
 
-    geocoding_data = get_geocoding_data(siae.geocoding_address, post_code=siae.post_code)
+def check_validation_errors(df, validity_masks, description):
+    errors_df = get_validation_errors_df(df, validity_masks)
+    if not errors_df.empty:
+        print(f"FATAL ERROR: {len(errors_df)} invalid rows in {description}:")
+        print(errors_df.to_string())
+    assert errors_df.empty
 
+
+def get_column_to_row(df, column_name):
+    """
+    Map each value of the column to its row, as a namedtuple with one attribute per column.
+    Unlike `df.iterrows()`, `df.itertuples()` does not build a series per row.
+    """
+    assert df[column_name].is_unique
+    return dict(zip(df[column_name], df.itertuples(index=False, name="Row")))
+
+
+def apply_geocoding_data(siae, geocoding_data):
     if geocoding_data:
         siae.geocoding_score = geocoding_data["score"]
         # If the score is greater than API_BAN_RELIABLE_MIN_SCORE, coords are reliable:
@@ -156,6 +189,46 @@ def geocode_siae(siae):
     return siae
 
 
+def geocode_siaes(siaes):
+    """
+    Geocode all siaes at once with the batch geocoding API, which is much faster than one request per siae.
+    """
+    geocodable_siaes = [siae for siae in siaes if siae.geocoding_address is not None]
+    addresses = [(siae.geocoding_address, siae.post_code) for siae in geocodable_siaes]
+    for siae, geocoding_data in zip(geocodable_siaes, get_batch_geocoding_data(addresses)):
+        apply_geocoding_data(siae, geocoding_data)
+    print(f"Geocoding cache: {GEOCODING_CACHE_STATS['hits']} hits, {GEOCODING_CACHE_STATS['misses']} misses.")
+    return siaes
+
+
+def get_structures_diff(db_siaes, df, fields):
+    """
+    Compare db structures to the export, field by field, matching them on their siret.
+
+    Return a `{field: [(siae, old_value, new_value), ...]}` dict of the changed values,
+    with empty values (None, NaN, "") being considered equal.
+    """
+    db_df = pd.DataFrame.from_records(
+        [[siae.siret] + [getattr(siae, field) for field in fields] for siae in db_siaes],
+        columns=["siret"] + fields,
+    )
+    merged_df = db_df.merge(df[["siret"] + fields], on="siret", suffixes=("_db", "_export"))
+    siret_to_siae = {siae.siret: siae for siae in db_siaes}
+
+    diff = {}
+    for field in fields:
+        old_values = merged_df[f"{field}_db"].fillna("")
+        new_values = merged_df[f"{field}_export"].fillna("")
+        changed_df = merged_df[old_values != new_values]
+        diff[field] = [
+            (siret_to_siae[siret], old_value, new_value)
+            for siret, old_value, new_value in zip(
+                changed_df.siret, changed_df[f"{field}_db"], changed_df[f"{field}_export"]
+            )
+        ]
+    return diff
+
+
 def sync_structures(df, source, kinds, build_structure, dry_run):
     """
     Sync structures between db and export.
@@ -167,11 +240,15 @@ def sync_structures(df, source, kinds, build_structure, dry_run):
     - df: dataframe of structures, one row per structure
     - source: either Siae.SOURCE_GEIQ or Siae.SOURCE_EA_EATT
     - kinds: possible kinds of the structures
-    - build_structure: a method building a structure from a dataframe row
+    - build_structure: a method building a structure from a dataframe row, structures are then geocoded in batch
     """
     print(f"Loaded {len(df)} {source} from export.")
 
-    db_sirets = set([siae.siret for siae in Siae.objects.filter(kind__in=kinds)])
+    db_siaes = list(Siae.objects.filter(kind__in=kinds).with_deletability())
+    siret_to_db_siae = {siae.siret: siae for siae in db_siaes}
+    assert len(siret_to_db_siae) == len(db_siaes)
+
+    db_sirets = set(siret_to_db_siae)
     df_sirets = set(df.siret.tolist())
 
     creatable_sirets = df_sirets - db_sirets
@@ -182,37 +259,44 @@ def sync_structures(df, source, kinds, build_structure, dry_run):
     print(f"{len(deletable_sirets)} {source} will be deleted when possible.")
 
     # Create structures which do not exist in database yet.
-    siret_to_row = {row.siret: row for _, row in df.iterrows()}
-    for siret in creatable_sirets:
-        row = siret_to_row[siret]
-        siae = build_structure(row)
-        if not dry_run:
-            siae.save()
+    creatable_df = df[df.siret.isin(creatable_sirets)]
+    creatable_siaes = geocode_siaes([build_structure(row) for _, row in creatable_df.iterrows()])
+    if not dry_run:
+        Siae.objects.bulk_create(creatable_siaes)
+        for siae in creatable_siaes:
             print(f"siae.id={siae.id} has been created.")
 
     # Update structures which already exist in database.
-    for siret in updatable_sirets:
-        siae = Siae.objects.get(siret=siret, kind__in=kinds)
-        if siae.source != source:
-            # If a user/staff created structure already exists in db and its siret is later found in an export,
-            # it makes sense to convert it.
-            print(f"siae.id={siae.id} will be converted to source={source}.")
-            if not dry_run:
-                siae.source = source
-                siae.save()
+    # If a user/staff created structure already exists in db and its siret is later found in an export,
+    # it makes sense to convert it. Other fields may have been edited by users and are left untouched.
+    fields = ["source"]
+    diff = get_structures_diff(
+        db_siaes=[siret_to_db_siae[siret] for siret in updatable_sirets],
+        df=df.assign(source=source),
+        fields=fields,
+    )
+    now = timezone.now()
+    for field, changes in diff.items():
+        print(f"{len(changes)} {source} will have their {field} updated.")
+        for siae, old_value, new_value in changes:
+            print(f"siae.id={siae.id} {field}: {old_value} => {new_value}")
+            setattr(siae, field, new_value)
+            siae.updated_at = now
+        if not dry_run:
+            Siae.objects.bulk_update([siae for siae, _, _ in changes], [field, "updated_at"])
 
     # Delete structures which no longer exist in the latest export.
     deleted_count = 0
     undeletable_count = 0
     for siret in deletable_sirets:
-        siae = Siae.objects.get(siret=siret, kind__in=kinds)
+        siae = siret_to_db_siae[siret]
 
         one_week_ago = timezone.now() - timezone.timedelta(days=7)
         if siae.source == Siae.SOURCE_STAFF_CREATED and siae.created_at >= one_week_ago:
             # When our staff creates a structure, let's give the user sufficient time to join it before deleting it.
             continue
 
-        if could_siae_be_deleted(siae):
+        if siae.is_deletable:
             print(f"siae.id={siae.id} will be deleted.")
             deleted_count += 1
             if not dry_run:
@@ -233,6 +317,40 @@ def sync_structures(df, source, kinds, build_structure, dry_run):
     print(f"{undeletable_count} {source} cannot be deleted as they have data.")
 
 
+# Any column having any of these keywords inside its name will be dropped.
+# E.g. if `courriel` is a deletable keyword, then columns named `referent_courriel`,
+# `representant_courriel` etc will all be dropped.
+FLUXIAE_DELETABLE_KEYWORDS = [
+    "courriel",
+    "telephone",
+    "prenom",
+    "nom_usage",
+    "nom_naissance",
+    "responsable_nom",
+    "urgence_nom",
+    "referent_nom",
+    "representant_nom",
+    "date_naissance",
+    "adr_mail",
+    "nationalite",
+    "titre_sejour",
+    "observations",
+    "salarie_agrement",
+    "salarie_adr_point_remise",
+    "salarie_adr_cplt_point_geo",
+    "salarie_adr_numero_voie",
+    "salarie_codeextensionvoie",
+    "salarie_codetypevoie",
+    "salarie_adr_libelle_voie",
+    "salarie_adr_cplt_distribution",
+    "salarie_adr_qpv_nom",
+]
+
+
+def is_fluxiae_column_deletable(column_name):
+    return any(deletable_keyword in column_name for deletable_keyword in FLUXIAE_DELETABLE_KEYWORDS)
+
+
 def anonymize_fluxiae_df(df):
     """
     Drop and/or anonymize sensitive data in fluxIAE dataframe.
@@ -240,48 +358,87 @@ def anonymize_fluxiae_df(df):
     if "salarie_date_naissance" in df.columns.tolist():
         df["salarie_annee_naissance"] = df.salarie_date_naissance.str[-4:].astype(int)
 
-    # Any column having any of these keywords inside its name will be dropped.
-    # E.g. if `courriel` is a deletable keyword, then columns named `referent_courriel`,
-    # `representant_courriel` etc will all be dropped.
-    deletable_keywords = [
-        "courriel",
-        "telephone",
-        "prenom",
-        "nom_usage",
-        "nom_naissance",
-        "responsable_nom",
-        "urgence_nom",
-        "referent_nom",
-        "representant_nom",
-        "date_naissance",
-        "adr_mail",
-        "nationalite",
-        "titre_sejour",
-        "observations",
-        "salarie_agrement",
-        "salarie_adr_point_remise",
-        "salarie_adr_cplt_point_geo",
-        "salarie_adr_numero_voie",
-        "salarie_codeextensionvoie",
-        "salarie_codetypevoie",
-        "salarie_adr_libelle_voie",
-        "salarie_adr_cplt_distribution",
-        "salarie_adr_qpv_nom",
-    ]
-
     for column_name in df.columns.tolist():
-        for deletable_keyword in deletable_keywords:
-            if deletable_keyword in column_name:
-                del df[column_name]
+        if is_fluxiae_column_deletable(column_name):
+            del df[column_name]
 
     # Better safe than sorry when dealing with sensitive data!
     for column_name in df.columns.tolist():
-        for deletable_keyword in deletable_keywords:
-            assert deletable_keyword not in column_name
+        assert not is_fluxiae_column_deletable(column_name)
 
     return df
 
 
+def get_file_hash(filename):
+    file_hash = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def get_converter_source(converter):
+    """
+    Source code of a converter, so that changing it invalidates the snapshots, or name of a builtin (e.g. `str`).
+    """
+    try:
+        return inspect.getsource(converter)
+    except (OSError, TypeError):
+        return f"{converter.__module__}.{converter.__qualname__}"
+
+
+def is_private_to_current_user(path):
+    """
+    Owned by the current user and neither readable nor writable by anyone else.
+    """
+    stat = os.stat(path)
+    return stat.st_uid == os.getuid() and not stat.st_mode & 0o077
+
+
+def get_fluxiae_snapshots_dir():
+    """
+    Snapshots contain personal data and are unpickled, which can run arbitrary code: they are only used
+    from a directory private to the current user, and not at all unless `settings.FLUXIAE_SNAPSHOTS_DIR` is set.
+    """
+    snapshots_dir = settings.FLUXIAE_SNAPSHOTS_DIR
+    if not snapshots_dir:
+        return None
+    os.makedirs(snapshots_dir, mode=0o700, exist_ok=True)
+    if not is_private_to_current_user(snapshots_dir):
+        print(f"Snapshots disabled: {snapshots_dir} must be private to the current user.")
+        return None
+    return snapshots_dir
+
+
+def get_fluxiae_snapshot_filename(snapshots_dir, vue_name, filename, options):
+    """
+    A snapshot is keyed by the name and the content of its source export, the options it was loaded with,
+    the source code of its converters and the schema of the view, so that an outdated snapshot is never used.
+    """
+    key = hashlib.sha256(get_file_hash(filename).encode())
+    key.update(
+        json.dumps([FLUXIAE_SNAPSHOTS_VERSION, options, FLUXIAE_SCHEMAS.get(vue_name, {})], sort_keys=True).encode()
+    )
+    # e.g. fluxIAE_Structure_14122020_075350.csv.gz => fluxIAE_Structure_14122020_075350
+    source_name = os.path.basename(filename).split(".")[0]
+    return os.path.join(snapshots_dir, f"{source_name}_{key.hexdigest()[:16]}.pkl")
+
+
+def save_fluxiae_snapshot(df, vue_name, snapshot_filename):
+    """
+    Replace any previous snapshot of the view, e.g. one of an older export.
+    """
+    snapshots_dir = os.path.dirname(snapshot_filename)
+    for filename in os.listdir(snapshots_dir):
+        if filename.startswith(f"{vue_name}_"):
+            os.remove(os.path.join(snapshots_dir, filename))
+    # Write to a temporary file first so that an interrupted write never leaves a truncated snapshot behind.
+    tmp_filename = f"{snapshot_filename}.tmp"
+    with os.fdopen(os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "wb") as f:
+        df.to_pickle(f, compression=None)
+    os.replace(tmp_filename, snapshot_filename)
+
+
 def get_fluxiae_df(
     vue_name,
     converters=None,
@@ -294,6 +451,12 @@ def get_fluxiae_df(
     """
     Load fluxIAE CSV file as a dataframe.
     Any sensitive data will be dropped and/or anonymized.
+
+    Columns are typed according to the registry of `fluxiae_schemas.py`,
+    except for those given in `converters` or `parse_dates`.
+
+    Parsing a whole export is slow, so when `settings.FLUXIAE_SNAPSHOTS_DIR` is set the resulting dataframe
+    is saved as a snapshot which is loaded instead as long as the same export is used.
     """
     filename = get_filename(
         filename_prefix=vue_name,
@@ -301,6 +464,22 @@ def get_fluxiae_df(
         description=description,
     )
 
+    snapshot_filename = None
+    snapshots_dir = None if dry_run else get_fluxiae_snapshots_dir()
+    if snapshots_dir:
+        snapshot_options = {
+            "converters": {
+                column_name: get_converter_source(converter) for column_name, converter in (converters or {}).items()
+            },
+            "parse_dates": sorted(parse_dates or []),
+            "skip_first_row": skip_first_row,
+            "anonymize_sensitive_data": anonymize_sensitive_data,
+        }
+        snapshot_filename = get_fluxiae_snapshot_filename(snapshots_dir, vue_name, filename, options=snapshot_options)
+        if os.path.exists(snapshot_filename) and is_private_to_current_user(snapshot_filename):
+            print(f"Loading {vue_name} from snapshot {os.path.basename(snapshot_filename)} ...")
+            return pd.read_pickle(snapshot_filename, compression=None)
+
     # Prepare parameters for pandas.read_csv method.
     kwargs = {}
 
@@ -335,6 +514,9 @@ def get_fluxiae_df(
     if parse_dates:
         kwargs["parse_dates"] = parse_dates
 
+    excluded_column_names = set(converters or []) | set(parse_dates or [])
+    kwargs["dtype"] = get_fluxiae_read_csv_dtype(vue_name, excluded_column_names=excluded_column_names)
+
     df = pd.read_csv(
         filename,
         sep="|",
@@ -359,4 +541,82 @@ def get_fluxiae_df(
     if anonymize_sensitive_data:
         df = anonymize_fluxiae_df(df)
 
+    df = apply_fluxiae_schema(df, vue_name, excluded_column_names=excluded_column_names)
+    print_fluxiae_memory_report(df, vue_name)
+
+    if snapshot_filename:
+        save_fluxiae_snapshot(df, vue_name, snapshot_filename)
+
     return df
+
+
+def get_fluxiae_rows(
+    vue_name,
+    filename=None,
+    description=None,
+    skip_first_row=True,
+    anonymize_sensitive_data=True,
+    dry_run=False,
+):
+    """
+    Stream fluxIAE CSV file line by line in a single pass, without ever loading it entirely in memory.
+
+    The first item yielded is the list of column names, all next items are rows as lists of string values
+    (None for empty values). Any sensitive data will be dropped and/or anonymized, like in `get_fluxiae_df`.
+
+    `filename` defaults to the export of the view found by `get_filename`.
+    """
+    if filename is None:
+        filename = get_filename(
+            filename_prefix=vue_name,
+            filename_extension=".csv",
+            description=description,
+        )
+
+    open_file = gzip.open if filename.endswith(".gz") else open
+
+    with open_file(filename, "rt", encoding="utf-8") as f:
+        if skip_first_row:
+            # Some fluxIAE exports have a leading "DEB***" row, some don't.
+            next(f)
+
+        column_names = next(f).rstrip("\r\n").split("|")
+        # If there is only one column, something went wrong, let's break early.
+        # Most likely an incorrect skip_first_row value.
+        assert len(column_names) >= 2
+
+        kept_indexes = list(range(len(column_names)))
+        birthdate_index = None
+        if anonymize_sensitive_data:
+            kept_indexes = [i for i in kept_indexes if not is_fluxiae_column_deletable(column_names[i])]
+            if "salarie_date_naissance" in column_names:
+                birthdate_index = column_names.index("salarie_date_naissance")
+
+        output_column_names = [column_names[i] for i in kept_indexes]
+        if birthdate_index is not None:
+            output_column_names.append("salarie_annee_naissance")
+
+        # Better safe than sorry when dealing with sensitive data!
+        if anonymize_sensitive_data:
+            for column_name in output_column_names:
+                assert not is_fluxiae_column_deletable(column_name)
+
+        yield output_column_names
+
+        # All fluxIAE exports have a final "FIN***" row which should be ignored: each line is only yielded
+        # once the next one has been read, so that the last one never is.
+        nrows = 0
+        previous_line = None
+        for line in f:
+            if previous_line is not None:
+                # Quoting is disabled for the same reasons as in `get_fluxiae_df`.
+                values = previous_line.rstrip("\r\n").split("|")
+                assert len(values) == len(column_names)
+                row = [values[i] or None for i in kept_indexes]
+                if birthdate_index is not None:
+                    row.append(values[birthdate_index][-4:] or None)
+                yield row
+                nrows += 1
+                if dry_run and nrows == 100:
+                    break
+            previous_line = line
@@ -19,9 +19,15 @@ an "siae_key" throughout the import_siae.py script code.
 """
 from django.utils import timezone
 
-from itou.siaes.management.commands._import_siae.utils import get_fluxiae_df, remap_columns, timeit
+from itou.siaes.management.commands._import_siae.utils import (
+    check_validation_errors,
+    get_column_to_row,
+    get_fluxiae_df,
+    remap_columns,
+    timeit,
+)
 from itou.siaes.models import Siae, SiaeFinancialAnnex
-from itou.utils.validators import validate_af_number
+from itou.utils.validators import AF_NUMBER_REGEXP
 
 
 @timeit
@@ -39,8 +45,6 @@ def get_vue_af_df():
     """
     df = get_fluxiae_df(
         vue_name="fluxIAE_AnnexeFinanciere",
-        converters={"af_id_structure": int},
-        parse_dates=["af_date_debut_effet", "af_date_fin_effet"],
         description="Vue AF",
         skip_first_row=True,
     )
@@ -75,12 +79,17 @@ def get_vue_af_df():
     df["number"] = df.number_prefix + "A" + df.renewal_number.astype(str) + "M" + df.modification_number.astype(str)
 
     # Ensure data quality.
-    for _, row in df.iterrows():
-        assert row.kind in Siae.ASP_MANAGED_KINDS
-        validate_af_number(row.number)
+    check_validation_errors(
+        df,
+        validity_masks={
+            "invalid kind": df.kind.isin(Siae.ASP_MANAGED_KINDS),
+            "invalid number": df.number.str.match(AF_NUMBER_REGEXP),
+        },
+        description="Vue AF",
+    )
 
-    df["start_at"] = df.start_at.apply(timezone.make_aware)
-    df["end_date"] = df.end_date.apply(timezone.make_aware)
+    df["start_at"] = df.start_at.dt.tz_localize(timezone.get_current_timezone())
+    df["end_date"] = df.end_date.dt.tz_localize(timezone.get_current_timezone())
 
     df["ends_in_the_future"] = df.end_date > timezone.now()
     df["has_active_state"] = df.state.isin(SiaeFinancialAnnex.STATES_ACTIVE)
@@ -135,12 +144,7 @@ VUE_AF_DF = get_vue_af_df()
 
 @timeit
 def get_af_number_to_row():
-    af_number_to_row = {}
-    for _, row in VUE_AF_DF.iterrows():
-        af_number = row.number
-        assert af_number not in af_number_to_row
-        af_number_to_row[af_number] = row
-    return af_number_to_row
+    return get_column_to_row(VUE_AF_DF, "number")
 
 
 AF_NUMBER_TO_ROW = get_af_number_to_row()
@@ -152,18 +156,9 @@ def get_siae_key_to_convention_end_date():
     For each siae_key (asp_id+kind) we figure out the convention end date.
     This convention end date (future or past) is eventually stored as siae.convention_end_date.
     """
-    siae_key_to_convention_end_date = {}
-    af_df = VUE_AF_DF.copy()  # Leave the main dataframe untouched!
-    af_df = af_df[af_df.has_active_state]
-    for _, row in af_df.iterrows():
-        convention_end_date = row.end_date
-        siae_key = (row.asp_id, row.kind)
-        if siae_key in siae_key_to_convention_end_date:
-            if convention_end_date > siae_key_to_convention_end_date[siae_key]:
-                siae_key_to_convention_end_date[siae_key] = convention_end_date
-        else:
-            siae_key_to_convention_end_date[siae_key] = convention_end_date
-    return siae_key_to_convention_end_date
+    af_df = VUE_AF_DF[VUE_AF_DF.has_active_state]
+    # The convention end date is the latest end date of its AFs.
+    return af_df.groupby(["asp_id", "kind"]).end_date.max().to_dict()
 
 
 ACTIVE_SIAE_KEYS = [
@@ -13,8 +13,13 @@ It contains almost all data to build a siae from scratch with 2 exceptions:
 """
 import numpy as np
 
-from itou.siaes.management.commands._import_siae.utils import get_fluxiae_df, remap_columns, timeit
-from itou.utils.validators import validate_naf, validate_siret
+from itou.siaes.management.commands._import_siae.utils import (
+    check_validation_errors,
+    get_column_to_row,
+    get_fluxiae_df,
+    remap_columns,
+    timeit,
+)
 
 
 @timeit
@@ -77,13 +82,18 @@ def get_vue_structure_df():
     df = df[df.auth_email.notnull()]
     df = df[df.auth_email != ""]
 
-    for _, row in df.iterrows():
-        validate_siret(row.siret)
-        validate_siret(row.siret_signature)
-        validate_naf(row.naf)
-        assert " " not in row.auth_email
-        assert "@" in row.auth_email
-        assert row.siret[:9] == row.siret_signature[:9]
+    # Same checks as `validate_siret` and `validate_naf`, over whole columns.
+    check_validation_errors(
+        df,
+        validity_masks={
+            "invalid siret": df.siret.str.fullmatch(r"\d{14}"),
+            "invalid siret_signature": df.siret_signature.str.fullmatch(r"\d{14}"),
+            "invalid naf": df.naf.str.fullmatch(r"\d{4}[a-zA-Z]"),
+            "invalid auth_email": ~df.auth_email.str.contains(" ") & df.auth_email.str.contains("@"),
+            "siret and siret_signature have different sirens": df.siret.str[:9] == df.siret_signature.str[:9],
+        },
+        description="Vue Structure",
+    )
 
     return df
 
@@ -96,11 +106,7 @@ def get_asp_id_to_siae_row():
     """
     Provide the row from the "Vue Structure" matching the given asp_id.
     """
-    asp_id_to_siae_row = {}
-    for _, row in VUE_STRUCTURE_DF.iterrows():
-        assert row.asp_id not in asp_id_to_siae_row
-        asp_id_to_siae_row[row.asp_id] = row
-    return asp_id_to_siae_row
+    return get_column_to_row(VUE_STRUCTURE_DF, "asp_id")
 
 
 ASP_ID_TO_SIAE_ROW = get_asp_id_to_siae_row()
@@ -111,11 +117,8 @@ def get_asp_id_to_siret_signature():
     """
     Provide the siret_signature from the "Vue Structure" matching the given asp_id.
     """
-    asp_id_to_siret_signature = {}
-    for _, row in VUE_STRUCTURE_DF.iterrows():
-        assert row.asp_id not in asp_id_to_siret_signature
-        asp_id_to_siret_signature[row.asp_id] = row.siret_signature
-    return asp_id_to_siret_signature
+    assert VUE_STRUCTURE_DF.asp_id.is_unique
+    return VUE_STRUCTURE_DF.set_index("asp_id").siret_signature.to_dict()
 
 
 ASP_ID_TO_SIRET_SIGNATURE = get_asp_id_to_siret_signature()
@@ -144,16 +147,15 @@ def get_siret_to_asp_id():
     use both to have a maximum chance to get a match and avoid leaving
     ghost siaes behind.
     """
-    siret_to_asp_id = {}
-    for _, row in VUE_STRUCTURE_DF.iterrows():
-        siret_to_asp_id[row.siret] = row.asp_id
-        # Current siret has precedence over siret_signature.
-        # FTR necessary subtelty due to a weird edge case in ASP data:
-        # siret=44431048600030 has two different asp_ids (2338, 4440)
-        # one as a siret_signature, the other as a current siret.
-        # (╯°□°)╯︵ ┻━┻
-        if row.siret_signature not in siret_to_asp_id:
-            siret_to_asp_id[row.siret_signature] = row.asp_id
+    # When several rows share the same siret_signature, the first one is kept.
+    signatures_df = VUE_STRUCTURE_DF.drop_duplicates(subset=["siret_signature"], keep="first")
+    siret_to_asp_id = signatures_df.set_index("siret_signature").asp_id.to_dict()
+    # Current siret has precedence over siret_signature.
+    # FTR necessary subtelty due to a weird edge case in ASP data:
+    # siret=44431048600030 has two different asp_ids (2338, 4440)
+    # one as a siret_signature, the other as a current siret.
+    # (╯°□°)╯︵ ┻━┻
+    siret_to_asp_id.update(zip(VUE_STRUCTURE_DF.siret, VUE_STRUCTURE_DF.asp_id))
     return siret_to_asp_id
 
 
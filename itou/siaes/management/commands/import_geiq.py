@@ -7,7 +7,6 @@ from django.core.management.base import BaseCommand
 from itou.common_apps.address.departments import department_from_postcode
 from itou.siaes.management.commands._import_siae.utils import (
     clean_string,
-    geocode_siae,
     get_filename,
     remap_columns,
     sync_structures,
@@ -83,8 +82,6 @@ def build_geiq(row):
     siae.city = row.city
     siae.department = row.department
 
-    siae = geocode_siae(siae)
-
     return siae
 
 
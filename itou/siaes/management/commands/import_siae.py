@@ -17,6 +17,7 @@ name instead of hardcoding column numbers as in `field = row[42]`.
 import logging
 
 from django.core.management.base import BaseCommand
+from django.db.models import Exists, OuterRef
 from django.utils import timezone
 
 from itou.siaes.management.commands._import_siae.convention import (
@@ -27,10 +28,10 @@ from itou.siaes.management.commands._import_siae.convention import (
 )
 from itou.siaes.management.commands._import_siae.financial_annex import get_creatable_and_deletable_afs
 from itou.siaes.management.commands._import_siae.siae import build_siae, should_siae_be_created
-from itou.siaes.management.commands._import_siae.utils import could_siae_be_deleted, timeit
+from itou.siaes.management.commands._import_siae.utils import geocode_siaes, timeit
 from itou.siaes.management.commands._import_siae.vue_af import ACTIVE_SIAE_KEYS
 from itou.siaes.management.commands._import_siae.vue_structure import ASP_ID_TO_SIAE_ROW
-from itou.siaes.models import Siae, SiaeConvention
+from itou.siaes.models import Siae, SiaeConvention, SiaeMembership
 
 
 class Command(BaseCommand):
@@ -61,7 +62,8 @@ class Command(BaseCommand):
         self.logger.debug(message)
 
     def delete_siae(self, siae):
-        assert could_siae_be_deleted(siae)
+        # `siae` must come from a `with_deletability()` queryset.
+        assert siae.is_deletable
         siae.delete()
 
     @timeit
@@ -73,17 +75,23 @@ class Command(BaseCommand):
         Those siaes cannot be joined by any way and thus are useless.
         Let's clean them up when possible.
         """
-        for siae in Siae.objects.filter(source=Siae.SOURCE_USER_CREATED):
-            if not siae.has_members:
-                if could_siae_be_deleted(siae):
-                    self.log(f"siae.id={siae.id} is user created and has no member thus will be deleted")
-                    self.delete_siae(siae)
-                else:
-                    self.log(
-                        f"FATAL ERROR: siae.id={siae.id} is user created and "
-                        f"has no member but has job applications thus cannot be deleted"
-                    )
-                    self.fatal_errors += 1
+        siaes_without_members = (
+            Siae.objects.filter(source=Siae.SOURCE_USER_CREATED)
+            # Same as `Siae.has_members`: unlike `with_has_active_members()`, members must be active users too.
+            .annotate(has_active_users=Exists(SiaeMembership.objects.active().filter(siae=OuterRef("pk"))))
+            .with_deletability()
+            .filter(has_active_users=False)
+        )
+        for siae in siaes_without_members:
+            if siae.is_deletable:
+                self.log(f"siae.id={siae.id} is user created and has no member thus will be deleted")
+                self.delete_siae(siae)
+            else:
+                self.log(
+                    f"FATAL ERROR: siae.id={siae.id} is user created and "
+                    f"has no member but has job applications thus cannot be deleted"
+                )
+                self.fatal_errors += 1
 
     @timeit
     def manage_staff_created_siaes(self):
@@ -120,16 +128,16 @@ class Command(BaseCommand):
 
         old_unconfirmed_siaes = staff_created_siaes.filter(created_at__lt=three_months_ago)
         self.log(f"{old_unconfirmed_siaes.count()} siaes created by staff should be deleted as they are unconfirmed")
-        for siae in old_unconfirmed_siaes:
-            if could_siae_be_deleted(siae):
-                self.log(f"deleted unconfirmed siae.id={siae.id} created by staff a while ago")
-                self.delete_siae(siae)
-            else:
-                self.log(
-                    f"FATAL ERROR: Please fix unconfirmed staff created siae.id={siae.id}"
-                    f" by either deleting it or attaching it to the correct convention"
-                )
-                self.fatal_errors += 1
+        old_unconfirmed_siaes = old_unconfirmed_siaes.with_deletability()
+        for siae in old_unconfirmed_siaes.filter(is_deletable=True):
+            self.log(f"deleted unconfirmed siae.id={siae.id} created by staff a while ago")
+            self.delete_siae(siae)
+        for siae in old_unconfirmed_siaes.filter(is_deletable=False):
+            self.log(
+                f"FATAL ERROR: Please fix unconfirmed staff created siae.id={siae.id}"
+                f" by either deleting it or attaching it to the correct convention"
+            )
+            self.fatal_errors += 1
 
     def update_siae_auth_email(self, siae, new_auth_email):
         assert siae.auth_email != new_auth_email
@@ -191,10 +199,10 @@ class Command(BaseCommand):
         blocked_deletions = 0
         deletions = 0
 
-        for siae in Siae.objects.select_related("convention").all():
+        for siae in Siae.objects.select_related("convention").with_deletability():
             if not siae.grace_period_has_expired:
                 continue
-            if could_siae_be_deleted(siae):
+            if siae.is_deletable:
                 self.delete_siae(siae)
                 deletions += 1
                 continue
@@ -257,6 +265,8 @@ class Command(BaseCommand):
                 assert siae not in creatable_siaes
                 creatable_siaes.append(siae)
 
+        geocode_siaes(creatable_siaes)
+
         self.log("--- beginning of CSV output of all creatable_siaes ---")
         self.log("siret;kind;department;name;address")
         for siae in creatable_siaes:
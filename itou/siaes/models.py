@@ -163,6 +163,35 @@ class SiaeQuerySet(OrganizationQuerySet):
             has_active_members=Exists(SiaeMembership.objects.filter(siae=OuterRef("pk"), is_active=True))
         )
 
+    def with_deletability(self):
+        """
+        A siae can be deleted only if it has neither members nor received job applications.
+        An ASP source siae can additionally be deleted only once all its antennas have been deleted.
+
+        Sub queries compute it for all siaes at once, instead of several queries per siae.
+        """
+        # Avoid a circular import
+        job_application_model = self.model._meta.get_field("jobapplication").related_model
+        # Prefer sub queries to joins for performance reasons.
+        # See `self.with_count_recent_received_job_apps`.
+        return self.annotate(
+            has_any_members=Exists(SiaeMembership.objects.filter(siae=OuterRef("pk"))),
+            has_received_job_applications=Exists(job_application_model.objects.filter(to_siae=OuterRef("pk"))),
+            has_antennas=Exists(
+                Siae.objects.filter(convention_id=OuterRef("convention_id")).exclude(pk=OuterRef("pk"))
+            ),
+        ).annotate(
+            is_deletable=Case(
+                When(
+                    Q(has_any_members=False, has_received_job_applications=False)
+                    & (~Q(source=Siae.SOURCE_ASP) | Q(has_antennas=False)),
+                    then=True,
+                ),
+                default=False,
+                output_field=BooleanField(),
+            )
+        )
+
 
 class Siae(AddressMixin, OrganizationAbstract):
     """
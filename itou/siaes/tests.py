@@ -1,9 +1,13 @@
+import gzip
+import os
+import tempfile
 from datetime import timedelta
 from unittest import mock
 
+import pandas as pd
 from django.conf import settings
 from django.core import mail
-from django.test import RequestFactory, TestCase
+from django.test import RequestFactory, TestCase, override_settings
 from django.utils import timezone
 
 from itou.job_applications.factories import JobApplicationFactory
@@ -18,6 +22,8 @@ from itou.siaes.factories import (
     SiaeWithMembershipAndJobsFactory,
     SiaeWithMembershipFactory,
 )
+from itou.siaes.management.commands._import_siae import utils as import_siae_utils
+from itou.siaes.management.commands._import_siae.fluxiae_schemas import FLUXIAE_SCHEMAS, INTEGER
 from itou.siaes.models import Siae, SiaeJobDescription
 
 
@@ -295,6 +301,31 @@ class SiaeQuerySetTest(TestCase):
         result = Siae.objects.with_has_active_members().get(pk=siae.pk)
         self.assertFalse(result.has_active_members)
 
+    def test_with_deletability(self):
+        siae = SiaeFactory()
+        self.assertTrue(Siae.objects.with_deletability().get(pk=siae.pk).is_deletable)
+
+        # An ASP siae cannot be deleted as long as it has antennas.
+        antenna = SiaeFactory(source=Siae.SOURCE_USER_CREATED, convention=siae.convention)
+        result = Siae.objects.with_deletability().get(pk=siae.pk)
+        self.assertTrue(result.has_antennas)
+        self.assertFalse(result.is_deletable)
+        self.assertTrue(Siae.objects.with_deletability().get(pk=antenna.pk).is_deletable)
+
+        JobApplicationFactory(to_siae=antenna)
+        result = Siae.objects.with_deletability().get(pk=antenna.pk)
+        self.assertTrue(result.has_received_job_applications)
+        self.assertFalse(result.is_deletable)
+
+        siae = SiaeWithMembershipFactory()
+        siae.siaemembership_set.update(is_active=False)
+        result = Siae.objects.with_deletability().get(pk=siae.pk)
+        self.assertTrue(result.has_any_members)
+        self.assertFalse(result.is_deletable)
+
+        siae = SiaeFactory(source=Siae.SOURCE_STAFF_CREATED, convention=None)
+        self.assertTrue(Siae.objects.with_deletability().get(pk=siae.pk).is_deletable)
+
 
 class SiaeJobDescriptionQuerySetTest(TestCase):
     def setUp(self):
@@ -344,3 +375,96 @@ class SiaeJobDescriptionQuerySetTest(TestCase):
         siae_job_description = SiaeJobDescription.objects.with_job_applications_count().get(pk=job_description.pk)
         self.assertTrue(hasattr(siae_job_description, "job_applications_count"))
         self.assertEqual(siae_job_description.job_applications_count, 1)
+
+
+class FluxIAESnapshotTest(TestCase):
+    """
+    Test the snapshots of the dataframes loaded by `get_fluxiae_df`.
+    """
+
+    VUE_NAME = "fluxIAE_Test"
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.export_filename = os.path.join(tmp_dir.name, f"{self.VUE_NAME}_14122020_075350.csv.gz")
+        self.snapshots_dir = os.path.join(tmp_dir.name, "snapshots")
+        self.write_export(["1|Foo", "2|Bar"])
+
+        for patcher in [
+            override_settings(FLUXIAE_SNAPSHOTS_DIR=self.snapshots_dir),
+            mock.patch.object(import_siae_utils, "get_filename", return_value=self.export_filename),
+            mock.patch.object(import_siae_utils, "print", create=True),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def write_export(self, rows):
+        with gzip.open(self.export_filename, "wt") as f:
+            f.write("\n".join(["DEB|20201214", "test_id|test_nom", *rows, "FIN|2"]) + "\n")
+
+    def get_fluxiae_df(self, **kwargs):
+        """
+        Return the dataframe and whether the export has been parsed rather than loaded from a snapshot.
+        """
+        with mock.patch.object(import_siae_utils.pd, "read_csv", wraps=pd.read_csv) as read_csv:
+            df = import_siae_utils.get_fluxiae_df(self.VUE_NAME, **kwargs)
+        return df, read_csv.called
+
+    def test_snapshot_hit(self):
+        df, parsed = self.get_fluxiae_df()
+        self.assertTrue(parsed)
+        self.assertEqual(os.stat(self.snapshots_dir).st_mode & 0o777, 0o700)
+        [snapshot_filename] = os.listdir(self.snapshots_dir)
+        self.assertEqual(os.stat(os.path.join(self.snapshots_dir, snapshot_filename)).st_mode & 0o777, 0o600)
+
+        snapshot_df, parsed = self.get_fluxiae_df()
+        self.assertFalse(parsed)
+        pd.testing.assert_frame_equal(snapshot_df, df)
+
+    def test_snapshot_invalidation(self):
+        self.get_fluxiae_df()
+
+        with self.subTest("new export"):
+            self.write_export(["1|Foo", "2|Bar", "3|Baz"])
+            df, parsed = self.get_fluxiae_df()
+            self.assertTrue(parsed)
+            self.assertEqual(len(df), 3)
+            # The snapshot of the previous export is replaced.
+            self.assertEqual(len(os.listdir(self.snapshots_dir)), 1)
+
+        with self.subTest("schema change"):
+            with mock.patch.dict(FLUXIAE_SCHEMAS, {self.VUE_NAME: {"test_id": INTEGER}}):
+                _, parsed = self.get_fluxiae_df()
+            self.assertTrue(parsed)
+
+        with self.subTest("converter change"):
+            _, parsed = self.get_fluxiae_df(converters={"test_nom": lambda value: value.lower()})
+            self.assertTrue(parsed)
+            _, parsed = self.get_fluxiae_df(converters={"test_nom": lambda value: value.upper()})
+            self.assertTrue(parsed)
+            _, parsed = self.get_fluxiae_df(converters={"test_nom": lambda value: value.upper()})
+            self.assertFalse(parsed)
+
+    def test_snapshots_require_a_private_dir(self):
+        with self.subTest("disabled"), override_settings(FLUXIAE_SNAPSHOTS_DIR=None):
+            self.get_fluxiae_df()
+            _, parsed = self.get_fluxiae_df()
+            self.assertTrue(parsed)
+            self.assertFalse(os.path.exists(self.snapshots_dir))
+
+        with self.subTest("accessible to others"):
+            os.makedirs(self.snapshots_dir, mode=0o700)
+            os.chmod(self.snapshots_dir, 0o755)
+            self.get_fluxiae_df()
+            _, parsed = self.get_fluxiae_df()
+            self.assertTrue(parsed)
+            self.assertEqual(os.listdir(self.snapshots_dir), [])
+
+        with self.subTest("snapshot accessible to others"):
+            os.chmod(self.snapshots_dir, 0o700)
+            self.get_fluxiae_df()
+            [snapshot_filename] = os.listdir(self.snapshots_dir)
+            os.chmod(os.path.join(self.snapshots_dir, snapshot_filename), 0o666)
+            _, parsed = self.get_fluxiae_df()
+            self.assertTrue(parsed)
@@ -1,10 +1,16 @@
+import csv
+import io
 import logging
+from collections import Counter
 
 import httpx
 from django.conf import settings
 from django.contrib.gis.geos import GEOSGeometry
+from django.utils import timezone
 from django.utils.http import urlencode
 
+from itou.utils.models import GeocodingResult
+
 
 logger = logging.getLogger(__name__)
 
@@ -67,11 +73,173 @@ def process_geocoding_data(data):
     }
 
 
+# Hits and misses of the geocoding cache since the start of the process.
+GEOCODING_CACHE_STATS = Counter()
+
+
+def get_geocoding_cache_key(address, post_code=None):
+    return " ".join((address or "").upper().split()), (post_code or "").strip()
+
+
+def get_cached_geocoding_data(keys):
+    """
+    Return a `{key: geocoding_data}` dict of the cached results, among `keys`, which are not older than the TTL.
+    """
+    keys = set(keys)
+    min_fetched_at = timezone.now() - timezone.timedelta(days=settings.API_BAN_GEOCODING_CACHE_TTL_DAYS)
+    cached_results = GeocodingResult.objects.filter(
+        address__in={address for address, _ in keys}, fetched_at__gte=min_fetched_at
+    )
+    cached_geocoding_data = {}
+    for cached_result in cached_results:
+        key = (cached_result.address, cached_result.post_code)
+        if key in keys:
+            geocoding_data = dict(cached_result.result)
+            geocoding_data["coords"] = GEOSGeometry(
+                f"POINT({geocoding_data['longitude']} {geocoding_data['latitude']})"
+            )
+            cached_geocoding_data[key] = geocoding_data
+    return cached_geocoding_data
+
+
+def set_cached_geocoding_data(key_to_geocoding_data):
+    """
+    Store geocoding results in cache, replacing any previous result for the same key.
+    Addresses without result are not cached since it may be due to a transient API error.
+    """
+    key_to_geocoding_data = {key: data for key, data in key_to_geocoding_data.items() if data}
+    if not key_to_geocoding_data:
+        return
+
+    fetched_at = timezone.now()
+    existing_results = {
+        (result.address, result.post_code): result
+        for result in GeocodingResult.objects.filter(address__in={address for address, _ in key_to_geocoding_data})
+    }
+    created_results = []
+    updated_results = []
+    for (address, post_code), geocoding_data in key_to_geocoding_data.items():
+        result = existing_results.get((address, post_code)) or GeocodingResult(address=address, post_code=post_code)
+        result.result = {k: v for k, v in geocoding_data.items() if k != "coords"}
+        result.score = geocoding_data["score"]
+        result.fetched_at = fetched_at
+        (updated_results if result.pk else created_results).append(result)
+
+    GeocodingResult.objects.bulk_update(updated_results, ["result", "score", "fetched_at"])
+    # Another process may have cached the same address meanwhile, any of both results will do.
+    GeocodingResult.objects.bulk_create(created_results, ignore_conflicts=True)
+
+
 def get_geocoding_data(address, post_code=None, limit=1):
     """
     Return a dict containing info about the given `address` or None if no result found.
+
+    Results are cached, see `GeocodingResult`.
+    """
+    key = get_geocoding_cache_key(address, post_code)
+    geocoding_data = get_cached_geocoding_data([key]).get(key)
+    if geocoding_data:
+        GEOCODING_CACHE_STATS["hits"] += 1
+        return geocoding_data
+
+    GEOCODING_CACHE_STATS["misses"] += 1
+    geocoding_data = process_geocoding_data(call_ban_geocoding_api(address, post_code=post_code, limit=limit))
+    set_cached_geocoding_data({key: geocoding_data})
+
+    return geocoding_data
+
+
+def call_ban_batch_geocoding_api(addresses):
+    """
+    Geocode a list of `(address, post_code)` tuples with a single request to the BAN CSV endpoint.
+    https://adresse.data.gouv.fr/api-doc/adresse
+
+    The resulting CSV file is streamed back: yield one dict of result columns per address,
+    in the same order as `addresses`, or None for each address which could not be geocoded.
+    """
+    if not addresses:
+        return
+
+    api_url = f"{settings.API_BAN_BASE_URL}/search/csv/"
+
+    csv_file = io.StringIO()
+    writer = csv.writer(csv_file)
+    writer.writerow(["q", "postcode"])
+    for address, post_code in addresses:
+        # Line breaks would split an address into several CSV rows.
+        writer.writerow([" ".join((address or "").split()), post_code or ""])
+
+    # `post_code` is used to restrict the scope of the search, like in `call_ban_geocoding_api`.
+    data = {"columns": "q", "postcode": "postcode"}
+    files = {"data": ("addresses.csv", csv_file.getvalue().encode(), "text/csv")}
+
+    nrows = 0
+    try:
+        with httpx.stream(
+            "POST", api_url, data=data, files=files, timeout=settings.API_BAN_BATCH_GEOCODING_TIMEOUT
+        ) as r:
+            r.raise_for_status()
+            for row in csv.DictReader(r.iter_lines()):
+                nrows += 1
+                yield row
+    except httpx.HTTPError as e:
+        logger.info("Error while fetching `%s`: %s", api_url, e)
+
+    # Make sure each address gets a result whatever happened.
+    for _ in range(len(addresses) - nrows):
+        yield None
+
+
+def process_batch_geocoding_row(row):
+    """
+    Same as `process_geocoding_data` for a row of the BAN CSV endpoint.
     """
+    if not row:
+        return None
+    if row.get("result_status", "ok") != "ok" or not row.get("result_score"):
+        return None
 
-    geocoding_data = call_ban_geocoding_api(address, post_code=post_code, limit=limit)
+    longitude = float(row["longitude"])
+    latitude = float(row["latitude"])
 
-    return process_geocoding_data(geocoding_data)
+    return {
+        "score": float(row["result_score"]),
+        "address_line_1": row["result_name"],
+        "number": row.get("result_housenumber") or None,
+        "lane": row.get("result_street") or None,
+        "address": row["result_name"],
+        "post_code": row["result_postcode"],
+        "insee_code": row["result_citycode"],
+        "city": row["result_city"],
+        "longitude": longitude,
+        "latitude": latitude,
+        "coords": GEOSGeometry(f"POINT({longitude} {latitude})"),
+    }
+
+
+def get_batch_geocoding_data(addresses, batch_size=None):
+    """
+    Batch version of `get_geocoding_data` for a list of `(address, post_code)` tuples:
+    yield, in the same order, a dict containing info about each address or None if no result found.
+
+    Addresses are sent by batches of `batch_size` addresses, each batch with a single request.
+    Like `get_geocoding_data`, results are cached and only addresses missing from the cache are sent.
+    """
+    batch_size = batch_size or settings.API_BAN_BATCH_GEOCODING_SIZE
+    addresses = list(addresses)
+    for i in range(0, len(addresses), batch_size):
+        batch = addresses[i : i + batch_size]
+        keys = [get_geocoding_cache_key(address, post_code) for address, post_code in batch]
+        cached_geocoding_data = get_cached_geocoding_data(keys)
+        results = [cached_geocoding_data.get(key) for key in keys]
+
+        missing_indexes = [j for j, result in enumerate(results) if result is None]
+        GEOCODING_CACHE_STATS["hits"] += len(batch) - len(missing_indexes)
+        GEOCODING_CACHE_STATS["misses"] += len(missing_indexes)
+
+        rows = call_ban_batch_geocoding_api([batch[j] for j in missing_indexes])
+        for j, row in zip(missing_indexes, rows):
+            results[j] = process_batch_geocoding_row(row)
+        set_cached_geocoding_data({keys[j]: results[j] for j in missing_indexes})
+
+        yield from results
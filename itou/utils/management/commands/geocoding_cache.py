@@ -0,0 +1,65 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from itou.prescribers.models import PrescriberOrganization
+from itou.siaes.models import Siae
+from itou.users.models import User
+from itou.utils.apis.geocoding import GEOCODING_CACHE_STATS, get_batch_geocoding_data
+from itou.utils.models import GeocodingResult
+
+
+class Command(BaseCommand):
+    """
+    Warm or purge the geocoding cache.
+
+    To geocode in advance the addresses of all siaes, prescriber organizations and job seekers,
+    only addresses missing from the cache or outdated are sent to the BAN API:
+        django-admin geocoding_cache --warm
+
+    To delete outdated results:
+        django-admin geocoding_cache --purge
+
+    To delete all results:
+        django-admin geocoding_cache --purge --all
+    """
+
+    help = "Warm or purge the geocoding cache."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--warm", dest="warm", action="store_true", help="Geocode all known addresses")
+        parser.add_argument("--purge", dest="purge", action="store_true", help="Delete outdated results")
+        parser.add_argument("--all", dest="purge_all", action="store_true", help="Delete all results when purging")
+
+    def get_addresses(self):
+        """
+        Addresses as geocoded by the import scripts and by the HEXA address formatting of employee records.
+        """
+        addresses = []
+        for model in [Siae, PrescriberOrganization]:
+            for obj in model.objects.only("address_line_1", "post_code", "city"):
+                if obj.geocoding_address:
+                    addresses.append((obj.geocoding_address, obj.post_code))
+        job_seekers = User.objects.filter(is_job_seeker=True).exclude(address_line_1="").exclude(post_code="")
+        addresses += job_seekers.values_list("address_line_1", "post_code")
+        return addresses
+
+    def handle(self, warm=False, purge=False, purge_all=False, **options):
+        if purge:
+            results = GeocodingResult.objects.all()
+            if not purge_all:
+                min_fetched_at = timezone.now() - timezone.timedelta(days=settings.API_BAN_GEOCODING_CACHE_TTL_DAYS)
+                results = results.filter(fetched_at__lt=min_fetched_at)
+            deleted, _ = results.delete()
+            self.stdout.write(f"{deleted} geocoding results deleted.")
+
+        if warm:
+            addresses = self.get_addresses()
+            self.stdout.write(f"Geocoding {len(addresses)} addresses...")
+            found = len([data for data in get_batch_geocoding_data(addresses) if data])
+            self.stdout.write(f"{found} addresses found.")
+            self.stdout.write(
+                f"Geocoding cache: {GEOCODING_CACHE_STATS['hits']} hits, {GEOCODING_CACHE_STATS['misses']} misses."
+            )
+
+        self.stdout.write(f"{GeocodingResult.objects.count()} geocoding results in cache.")
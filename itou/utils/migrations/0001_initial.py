@@ -0,0 +1,38 @@
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = []
+
+    operations = [
+        migrations.CreateModel(
+            name="GeocodingResult",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("address", models.TextField(verbose_name="Adresse normalisée")),
+                ("post_code", models.CharField(blank=True, max_length=5, verbose_name="Code postal")),
+                ("result", models.JSONField(verbose_name="Résultat du géocodage")),
+                ("score", models.FloatField(verbose_name="Score")),
+                (
+                    "fetched_at",
+                    models.DateTimeField(
+                        db_index=True, default=django.utils.timezone.now, verbose_name="Date de récupération"
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Résultat de géocodage",
+                "verbose_name_plural": "Résultats de géocodage",
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="geocodingresult",
+            constraint=models.UniqueConstraint(
+                fields=("address", "post_code"), name="unique_geocoding_result_address"
+            ),
+        ),
+    ]
@@ -2,6 +2,13 @@
 Result for a call to:
 https://api-adresse.data.gouv.fr/search/?q=10+PL+5+MARTYRS+LYCEE+BUFFON&limit=1&postcode=75015
 """
+import csv
+import email.parser
+import email.policy
+import http.server
+import io
+import threading
+
 
 BAN_GEOCODING_API_RESULT_MOCK = {
     "type": "Feature",
@@ -24,3 +31,92 @@ BAN_GEOCODING_API_RESULT_MOCK = {
         "street": "Pl des Cinq Martyrs du Lycee Buffon",
     },
 }
+
+"""
+Result columns added by the BAN CSV endpoint for the same address:
+https://api-adresse.data.gouv.fr/search/csv/ with `q=10 PL 5 MARTYRS LYCEE BUFFON` and `postcode=75015`
+"""
+
+BAN_BATCH_GEOCODING_API_RESULT_MOCK = {
+    "latitude": "48.838411",
+    "longitude": "2.316754",
+    "result_label": "10 Pl des Cinq Martyrs du Lycee Buffon 75015 Paris",
+    "result_score": "0.587663373207207",
+    "result_type": "housenumber",
+    "result_id": "75115_2048_00010",
+    "result_housenumber": "10",
+    "result_name": "10 Pl des Cinq Martyrs du Lycee Buffon",
+    "result_street": "Pl des Cinq Martyrs du Lycee Buffon",
+    "result_postcode": "75015",
+    "result_city": "Paris",
+    "result_context": "75, Paris, Île-de-France",
+    "result_citycode": "75115",
+    "result_oldcitycode": "",
+    "result_oldcity": "",
+    "result_district": "Paris 15e Arrondissement",
+    "result_status": "ok",
+}
+
+
+class BanBatchGeocodingStandInServer:
+    """
+    Local HTTP server standing in for the BAN `/search/csv/` endpoint in tests.
+
+    `results` maps the `q` column of the uploaded CSV file to result columns,
+    other addresses are not found. Uploaded rows are kept in `received_rows`, one list per request.
+
+    Usage:
+
+        with BanBatchGeocodingStandInServer(results={"10 PL 5 MARTYRS": BAN_BATCH_GEOCODING_API_RESULT_MOCK}) as url:
+            with self.settings(API_BAN_BASE_URL=url):
+                ...
+    """
+
+    def __init__(self, results):
+        self.results = results
+        self.received_rows = []
+        self.server = None
+
+    def get_handler_class(self):
+        stand_in = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                # A multipart body parses as a MIME message once prefixed by its content type.
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                    f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body
+                )
+                form = {
+                    part.get_param("name", header="content-disposition"): part.get_payload(decode=True)
+                    for part in message.iter_parts()
+                }
+                rows = list(csv.DictReader(io.StringIO(form["data"].decode())))
+                stand_in.received_rows.append(rows)
+
+                result_columns = list(BAN_BATCH_GEOCODING_API_RESULT_MOCK)
+                output = io.StringIO()
+                writer = csv.DictWriter(output, fieldnames=["q", "postcode"] + result_columns)
+                writer.writeheader()
+                for row in rows:
+                    result = stand_in.results.get(row["q"], {"result_status": "not-found"})
+                    writer.writerow({**row, **{column: result.get(column, "") for column in result_columns}})
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/csv; charset=utf-8")
+                self.end_headers()
+                self.wfile.write(output.getvalue().encode())
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), self.get_handler_class())
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.server.shutdown()
+        self.server.server_close()
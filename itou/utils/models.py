@@ -1,5 +1,7 @@
 from django.contrib.postgres.fields import DateRangeField
+from django.db import connection, models
 from django.db.models import Func
+from django.utils.timezone import now
 
 
 class DateRange(Func):
@@ -13,3 +15,68 @@ class DateRange(Func):
 
     function = "daterange"
     output_field = DateRangeField()
+
+
+class GeocodingResult(models.Model):
+    """
+    Persistent cache of the results of the BAN geocoding API, see `itou.utils.apis.geocoding`.
+
+    Results are stored as returned by `process_geocoding_data`, except for `coords`
+    which are rebuilt from `longitude` and `latitude`.
+    """
+
+    address = models.TextField(verbose_name="Adresse normalisée")
+    post_code = models.CharField(verbose_name="Code postal", max_length=5, blank=True)
+    result = models.JSONField(verbose_name="Résultat du géocodage")
+    score = models.FloatField(verbose_name="Score")
+    fetched_at = models.DateTimeField(verbose_name="Date de récupération", default=now, db_index=True)
+
+    class Meta:
+        verbose_name = "Résultat de géocodage"
+        verbose_name_plural = "Résultats de géocodage"
+        constraints = [
+            models.UniqueConstraint(fields=["address", "post_code"], name="unique_geocoding_result_address"),
+        ]
+
+    def __str__(self):
+        return f"{self.address} {self.post_code}"
+
+
+def bulk_upsert(model, objs, unique_field, update_fields, batch_size=1000):
+    """
+    Insert model instances, or update the `update_fields` of the existing rows sharing their `unique_field`,
+    with one `INSERT … ON CONFLICT DO UPDATE` query per batch.
+
+    Existing rows whose values did not change are left untouched, so that their triggers are not fired.
+    Return the `unique_field` values of the inserted or updated rows.
+    """
+    fields = [model._meta.get_field(field_name) for field_name in [unique_field, *update_fields]]
+    # A row cannot be updated twice by the same query: like successive `update_or_create`, the last object wins.
+    objs = list({getattr(obj, fields[0].attname): obj for obj in objs}.values())
+    quote_name = connection.ops.quote_name
+    table_name = quote_name(model._meta.db_table)
+    column_names = [quote_name(field.column) for field in fields]
+    unique_column_name, update_column_names = column_names[0], column_names[1:]
+
+    assignments = ", ".join(f"{name} = EXCLUDED.{name}" for name in update_column_names)
+    current_values = ", ".join(f"{table_name}.{name}" for name in update_column_names)
+    excluded_values = ", ".join(f"EXCLUDED.{name}" for name in update_column_names)
+    row_placeholder = f"({', '.join(['%s'] * len(fields))})"
+
+    upserted_values = []
+    with connection.cursor() as cursor:
+        for i in range(0, len(objs), batch_size):
+            batch = objs[i : i + batch_size]
+            params = [
+                field.get_db_prep_save(getattr(obj, field.attname), connection) for obj in batch for field in fields
+            ]
+            cursor.execute(
+                f"INSERT INTO {table_name} ({', '.join(column_names)}) "
+                f"VALUES {', '.join([row_placeholder] * len(batch))} "
+                f"ON CONFLICT ({unique_column_name}) DO UPDATE SET {assignments} "
+                f"WHERE ({current_values}) IS DISTINCT FROM ({excluded_values}) "
+                f"RETURNING {unique_column_name}",
+                params,
+            )
+            upserted_values += [row[0] for row in cursor.fetchall()]
+    return upserted_values
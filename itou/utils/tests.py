@@ -12,25 +12,37 @@ from django.core.exceptions import ValidationError
 from django.core.mail.message import EmailMessage
 from django.template import Context, Template
 from django.test import RequestFactory, SimpleTestCase, TestCase
+from django.utils import timezone
 from factory import Faker
 
 from itou.common_apps.resume.forms import ResumeFormMixin
 from itou.institutions.factories import InstitutionFactory, InstitutionWithMembershipFactory
+from itou.jobs.models import Appellation, Rome
 from itou.prescribers.factories import PrescriberOrganizationWithMembershipFactory
 from itou.siaes.factories import SiaeFactory, SiaeWithMembershipFactory
 from itou.siaes.models import Siae, SiaeMembership
 from itou.users.factories import JobSeekerFactory, PrescriberFactory
 from itou.users.models import User
 from itou.utils.apis.api_entreprise import etablissement_get_or_error
-from itou.utils.apis.geocoding import process_geocoding_data
+from itou.utils.apis.geocoding import (
+    GEOCODING_CACHE_STATS,
+    get_batch_geocoding_data,
+    get_geocoding_data,
+    process_geocoding_data,
+)
 from itou.utils.apis.pole_emploi import PoleEmploiRechercheIndividuCertifieAPI
 from itou.utils.emails import sanitize_mailjet_recipients
 from itou.utils.mocks.api_entreprise import ETABLISSEMENT_API_RESULT_MOCK
-from itou.utils.mocks.geocoding import BAN_GEOCODING_API_RESULT_MOCK
+from itou.utils.mocks.geocoding import (
+    BAN_BATCH_GEOCODING_API_RESULT_MOCK,
+    BAN_GEOCODING_API_RESULT_MOCK,
+    BanBatchGeocodingStandInServer,
+)
 from itou.utils.mocks.pole_emploi import (
     POLE_EMPLOI_RECHERCHE_INDIVIDU_CERTIFIE_API_RESULT_ERROR_MOCK,
     POLE_EMPLOI_RECHERCHE_INDIVIDU_CERTIFIE_API_RESULT_KNOWN_MOCK,
 )
+from itou.utils.models import GeocodingResult, bulk_upsert
 from itou.utils.password_validation import CnilCompositionPasswordValidator
 from itou.utils.perms.context_processors import get_current_organization_and_perms
 from itou.utils.perms.user import KIND_JOB_SEEKER, KIND_PRESCRIBER, KIND_SIAE_STAFF, get_user_info
@@ -270,6 +282,57 @@ class UtilsGeocodingTest(TestCase):
         }
         self.assertEqual(result, expected)
 
+    def test_get_batch_geocoding_data(self):
+        addresses = [
+            ("10 PL 5 MARTYRS LYCEE BUFFON", "75015"),
+            ("NOWHERE", None),
+            # Line breaks are replaced by spaces.
+            ("10 PL 5 MARTYRS\nLYCEE BUFFON", "75015"),
+        ]
+        stand_in_server = BanBatchGeocodingStandInServer(
+            results={"10 PL 5 MARTYRS LYCEE BUFFON": BAN_BATCH_GEOCODING_API_RESULT_MOCK}
+        )
+        with stand_in_server as base_url:
+            with self.settings(API_BAN_BASE_URL=base_url):
+                results = list(get_batch_geocoding_data(addresses, batch_size=2))
+
+        # Same result as `process_geocoding_data` for the same address.
+        expected = process_geocoding_data(BAN_GEOCODING_API_RESULT_MOCK)
+        self.assertEqual(results, [expected, None, expected])
+        # Addresses were sent by batches of 2, the second batch only contained a cached address.
+        self.assertEqual(
+            stand_in_server.received_rows,
+            [[{"q": "10 PL 5 MARTYRS LYCEE BUFFON", "postcode": "75015"}, {"q": "NOWHERE", "postcode": ""}]],
+        )
+
+    @mock.patch("itou.utils.apis.geocoding.call_ban_geocoding_api", return_value=BAN_GEOCODING_API_RESULT_MOCK)
+    def test_get_geocoding_data_cache(self, mock_call_ban_geocoding_api):
+        GEOCODING_CACHE_STATS.clear()
+        expected = process_geocoding_data(BAN_GEOCODING_API_RESULT_MOCK)
+
+        self.assertEqual(get_geocoding_data("10 PL 5 MARTYRS LYCEE BUFFON", post_code="75015"), expected)
+        # Addresses are normalized.
+        self.assertEqual(get_geocoding_data(" 10 pl 5 martyrs  LYCEE BUFFON", post_code="75015"), expected)
+        self.assertEqual(mock_call_ban_geocoding_api.call_count, 1)
+        self.assertEqual(GEOCODING_CACHE_STATS, {"hits": 1, "misses": 1})
+        self.assertEqual(GeocodingResult.objects.get().score, expected["score"])
+
+        # Outdated results are fetched again.
+        GeocodingResult.objects.update(fetched_at=timezone.now() - timezone.timedelta(days=365))
+        self.assertEqual(get_geocoding_data("10 PL 5 MARTYRS LYCEE BUFFON", post_code="75015"), expected)
+        self.assertEqual(mock_call_ban_geocoding_api.call_count, 2)
+        self.assertEqual(GeocodingResult.objects.get().fetched_at.date(), timezone.now().date())
+
+        # Addresses without result are not cached.
+        mock_call_ban_geocoding_api.return_value = None
+        self.assertIsNone(get_geocoding_data("NOWHERE"))
+        self.assertEqual(GeocodingResult.objects.count(), 1)
+
+    def test_get_batch_geocoding_data_error(self):
+        with self.settings(API_BAN_BASE_URL="http://127.0.0.1:1"):
+            results = list(get_batch_geocoding_data([("10 PL 5 MARTYRS LYCEE BUFFON", "75015"), ("NOWHERE", None)]))
+        self.assertEqual(results, [None, None])
+
 
 class UtilsValidatorsTest(TestCase):
     def test_validate_alphanumeric(self):
@@ -774,3 +837,33 @@ class ResumeFormMixinTest(TestCase):
         form = ResumeFormMixin(data={"resume_link": resume_link})
         self.assertTrue(form.is_valid())
         self.assertFalse(form.has_error("resume_link"))
+
+
+class BulkUpsertTest(TestCase):
+    def test_bulk_upsert(self):
+        Rome.objects.create(code="M1805", name="Études et développement informatique", code_isco="2512")
+        Rome.objects.create(code="N1101", name="Conduite d'engins", code_isco="8344")
+        romes = [
+            Rome(code="M1805", name="Études et développement informatique", code_isco="2512"),
+            Rome(code="N1101", name="Conduite d'engins de déplacement des charges", code_isco="8344"),
+            Rome(code="N4105", name="Conduite et livraison par tournées", code_isco="8322"),
+        ]
+
+        # Unchanged rows are not updated.
+        self.assertEqual(
+            bulk_upsert(Rome, romes, unique_field="code", update_fields=["name", "code_isco"]), ["N1101", "N4105"]
+        )
+        self.assertEqual(Rome.objects.count(), 3)
+        self.assertEqual(Rome.objects.get(code="N1101").name, "Conduite d'engins de déplacement des charges")
+
+        self.assertEqual(bulk_upsert(Rome, romes, unique_field="code", update_fields=["name", "code_isco"]), [])
+
+    def test_bulk_upsert_updates_full_text(self):
+        Rome.objects.create(code="M1805", name="Études et développement informatique", code_isco="2512")
+        Appellation.objects.create(code="10001", name="Analyste réseau", rome_id="M1805")
+
+        appellations = [Appellation(code="10001", name="Développeur web", rome_id="M1805")]
+        bulk_upsert(Appellation, appellations, unique_field="code", update_fields=["name", "rome"])
+
+        self.assertEqual(Appellation.objects.autocomplete("analyste").count(), 0)
+        self.assertEqual(Appellation.objects.autocomplete("développeur").count(), 1)
@@ -91,6 +91,10 @@ AF_NUMBER_PREFIX_REGEXPS = [
     r"^EITI\d{2}[A-Z\d]\d{6}$",
 ]
 
+# Whole AF number matching both `AF_NUMBER_PREFIX_REGEXPS` and the suffix checked by `validate_af_number`,
+# to validate many AF numbers at once e.g. with `pandas.Series.str.match`.
+AF_NUMBER_REGEXP = r"^(?:{})A\dM\d$".format("|".join(regexp[1:-1] for regexp in AF_NUMBER_PREFIX_REGEXPS))
+
 
 def validate_af_number(af_number):
     """